@@ -14,11 +14,16 @@
       from a shared synchronized queue and process them);
     * The max depth of crawling, i.e. the max distance of a page from the starting point;
     * A limit to the number of pages crawled;
-    * A delay between two consecutive requests of a single Crawler (to 
-      allow for polite crawling, default is 0.15 seconds)
+    * A delay between two consecutive requests to the same host (to 
+      allow for polite crawling, default is 1.5 seconds)
 
    The actual crawling is made by class Crawler: each instance of Crawler runs
    in a separate thread.
+   Alternatively, passing engine=ENGINE_ASYNC to start_crawling, all the pages
+   are retrieved by non-blocking AsyncFetcher objects driven by a single
+   asyncore event loop, so that thousands of requests can be in flight at the
+   same time without paying for a thread each; with engine=ENGINE_HYBRID, Crawler
+   threads only retrieve pages, which are parsed by a pool of processes.
    A list of pages already visited is used to avoid circular
    redirection between pages.
    
@@ -41,26 +46,255 @@
 from time import time, sleep
 
 from HTMLParser import HTMLParser
-from urllib2 import urlopen, URLError
+from urllib2 import urlopen, URLError, HTTPError
 from urlparse import urlsplit, urlunsplit, urljoin
-from copy import deepcopy
+import json
 
-from hashlib import sha256
+from hashlib import sha256, md5
+import re
+#Compact data structures
+from array import array
+from math import ceil, log
+from struct import unpack
+#Crawl state on disk
+import os
+import sqlite3
+import marshal
+import zlib
+import cPickle
+from tempfile import mkstemp
+#Event loop engine
+import asyncore
+import socket
+import ssl
+from urllib2 import __version__ as urllib2_version
+#Keep-alive connections
+import httplib
+import errno
+from email.utils import parsedate_tz, mktime_tz
 #Threads
-from Queue import Queue     #, Empty
+from Queue import Queue, Empty
+from collections import deque
+from heapq import heappush, heappop
+from bisect import bisect_left
+from itertools import count, imap, izip, islice
+from operator import mul, sub
 import threading
-import thread
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import select
 #Logging
 from datetime import datetime
 import logging
 
 
-DEFAULT_CRAWLER_DELAY = 1.500  #Polite strategy: at least 1.5 seconds between two pages retrieval
+DEFAULT_CRAWLER_DELAY = 1.500  #Polite strategy: at least 1.5 seconds between two pages retrieval from the same host
+DEFAULT_HOST_BURST = 1  #Requests to a host that can be sent back to back after it has been idle long enough
+
+TAGS_SCANNER = re.compile(r"<!--|<[!?]|<(/?)(a|link|form|script|style|img|video|audio|source)(?=[\t\n\r\f />])", re.I)
+COMMENT_CLOSE = re.compile(r"--\s*>")
 
 VIDEO_URLS_TAG = "urls"
 VIDEO_POSTER_TAG = "poster"
 
-threadLock = threading.Lock()
+ENGINE_THREADS = "threads"  #One blocking Crawler thread per concurrent request
+ENGINE_ASYNC = "async"  #Every request multiplexed on a single asyncore event loop
+ENGINE_HYBRID = "hybrid"  #Crawler threads only retrieve pages, parsed by a pool of processes
+ENGINES = (ENGINE_THREADS, ENGINE_ASYNC, ENGINE_HYBRID)
+
+ASYNC_CHUNK_SIZE = 8192
+MAX_REDIRECTS = 10
+ASYNC_LOOP_TIMEOUT = 0.05
+REDIRECT_CODES = (301, 302, 303, 307)
+ASYNC_SCHEMES = ("http", "https")
+POOLED_SCHEMES = ("http", "https")
+ACCEPT_ENCODING = "gzip, deflate"  #Content encodings requested (see ContentDecoder)
+
+DEDUP_EXACT = "exact"  #URLs already queued are remembered exactly
+DEDUP_BLOOM = "bloom"  #URLs already queued are remembered by a Bloom filter (a few URLs may be wrongly skipped)
+DEFAULT_BLOOM_CAPACITY = 1000000
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+
+DEFAULT_URL_CACHE_SIZE = 100000  #Links resolved to absolute URLs remembered
+
+RETAIN_ALL = "all"  #Every page crawled is kept, with its links and resources
+RETAIN_LINKS = "links"  #Pages are kept with their links only (page_graph still works, list_resources finds nothing)
+RETAIN_NONE = "none"  #Pages are only handed to on_page: just their URLs are remembered
+RETENTION_POLICIES = (RETAIN_ALL, RETAIN_LINKS, RETAIN_NONE)
+DEFAULT_PAGE_BUFFER_SIZE = 100  #Pages crawled that iter_crawling holds until they are consumed
+URL_CACHE_MISS = object()
+
+DEFAULT_PAGERANK_DAMPING = 0.85
+DEFAULT_PAGERANK_ITERATIONS = 100
+DEFAULT_PAGERANK_TOLERANCE = 1e-6  #Total change of the ranks below which PageRank iterations stop
+
+SIMHASH_BITS = 64
+SIMHASH_BINARY_FORMAT = "0%db" % SIMHASH_BITS
+SIMHASH_SHINGLE_SIZE = 3  #Words per feature hashed
+SIMHASH_TAGS = re.compile(r"<[^>]*>")
+SIMHASH_WORDS = re.compile(r"\w+")
+SIMHASH_LAST_WORD = re.compile(r"\w+$")
+
+DEFAULT_CHECKPOINT_INTERVAL = 60  #Seconds between two checkpoints of the crawling state
+CHECKPOINT_VERSION = 1
+
+STATS_FETCH = "fetch"  #Waiting for the content of pages
+STATS_PARSE = "parse"  #Extracting links and resources (and, in streaming mode, hashing the content)
+STATS_DEDUP = "dedup"  #Hashing the content of pages and checking it against the pages already crawled
+STATS_ENQUEUE = "enqueue"  #Admitting a batch of URLs into the queue (see CrawlerHandler.enqueue_urls)
+STATS_LOCK_WAIT = "lock_wait"  #Waiting for threadLock, when it is held by another thread
+STATS_QUEUE_WAIT = "queue_wait"  #Waiting for an URL that can be crawled (politeness delay, or an empty queue)
+STATS_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10.)  #Upper bounds, in seconds
+
+DEFAULT_PARSE_BATCH_SIZE = 8  #Pages sent together to a parser process
+DEFAULT_PARSE_BATCH_TIMEOUT = 0.05  #Seconds after which an incomplete batch is sent anyway
+
+DEFAULT_CHUNK_SIZE = 16384  #Bytes read at a time from a response
+DEFAULT_POOL_SIZE = 10  #Idle keep-alive connections kept open for each host
+DEFAULT_POOL_IDLE_TIMEOUT = 5.0  #Seconds after which an idle connection is not reused anymore (servers usually drop it soon after)
+DEFAULT_CONNECT_TIMEOUT = 10.  #Seconds to wait for a connection to a server
+DEFAULT_READ_TIMEOUT = 30.  #Seconds a server can go silent during a request before it's abandoned
+DEFAULT_RETRIES = 2  #Times a request that failed for a transient reason is sent again
+DEFAULT_RETRY_BACKOFF = 1.  #Seconds before the first retry of a request, doubled at each following one
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)  #Responses meaning that the server can't answer right now
+MAX_RETRY_AFTER = 120.  #Seconds a server can ask to wait before a retry (Retry-After): requests needing longer waits are given up
+
+DEFAULT_AIMD_ERROR_RATE = 0.1  #The fraction of transient errors above which concurrency is decreased
+DEFAULT_AIMD_LATENCY_FACTOR = 2.  #Concurrency is decreased when latency grows beyond this multiple of the lowest one seen
+AIMD_DECREASE_FACTOR = 0.5
+USER_AGENT = "Python-urllib/%s" % urllib2_version   #Same agent as urlopen, so servers answer both engines alike
+
+STOP_CRAWLING = None  #Put in the queue once per Crawler thread when crawling is over
+
+PARTITION_POLL_INTERVAL = 0.05  #Seconds a worker of a distributed crawl waits for the coordinator before checking if it's idle
+DEFAULT_WORKERS_TIMEOUT = 60.  #Seconds the coordinator of a distributed crawl waits for all its workers to connect
+
+class CrawlStats(object):
+  ''' Histograms of the time spent in each phase of the crawling (see the STATS_* constants), and counters.
+  
+      Each thread records its measures in its own shard, without any locking: shards are only merged
+      by snapshot, so that the stats can be kept on at a negligible cost.
+  '''
+  
+  def __init__(self):
+    self.__local = threading.local()
+    self.__shards = []
+  
+  def __shard(self):
+    ''' 
+        :private:
+        
+        :return: The (histograms, counters) pair of the current thread.
+    '''
+    try:
+      return self.__local.shard
+    except AttributeError:
+      shard = self.__local.shard = ({}, {})
+      self.__shards.append(shard)
+      return shard
+  
+  def observe(self, phase, seconds):
+    ''' Records the time spent in a phase.
+    '''
+    histograms = self.__shard()[0]
+    histogram = histograms.get(phase)
+    if histogram is None:
+      histogram = histograms[phase] = [0, 0., [0] * (len(STATS_BUCKETS) + 1)]
+    histogram[0] += 1
+    histogram[1] += seconds
+    histogram[2][bisect_left(STATS_BUCKETS, seconds)] += 1
+  
+  def increment(self, counter, value = 1):
+    counters = self.__shard()[1]
+    counters[counter] = counters.get(counter, 0) + value
+  
+  def add(self, snapshot):
+    ''' Adds the measures of a snapshot (f.i. taken in another process) to the current thread's shard.
+    
+        :param snapshot: See snapshot.
+        :type snapshot: dict
+    '''
+    histograms, counters = self.__shard()
+    for (phase, measures) in snapshot["phases"].iteritems():
+      histogram = histograms.get(phase)
+      if histogram is None:
+        histogram = histograms[phase] = [0, 0., [0] * (len(STATS_BUCKETS) + 1)]
+      histogram[0] += measures["count"]
+      histogram[1] += measures["seconds"]
+      previous_total = 0
+      for (i, (_, total)) in enumerate(measures["buckets"]):
+        histogram[2][i] += total - previous_total
+        previous_total = total
+    for (counter, value) in snapshot["counters"].iteritems():
+      counters[counter] = counters.get(counter, 0) + value
+  
+  def snapshot(self):
+    ''' 
+        :return: A dict with two keys: "phases" maps each phase to a dict with the number of measures ("count"),
+        the total time in seconds ("seconds") and the cumulative histogram ("buckets": a list of (upper bound, count) pairs,
+        the last upper bound being infinity); "counters" maps each counter to its value.
+    '''
+    phases = {}
+    counters = {}
+    for (histograms, shard_counters) in list(self.__shards):
+      for (phase, (count, seconds, buckets)) in histograms.items():
+        if phase not in phases:
+          phases[phase] = [0, 0., [0] * len(buckets)]
+        merged = phases[phase]
+        merged[0] += count
+        merged[1] += seconds
+        merged[2] = [a + b for (a, b) in zip(merged[2], buckets)]
+      for (counter, value) in shard_counters.items():
+        counters[counter] = counters.get(counter, 0) + value
+    
+    stats = {}
+    for (phase, (count, seconds, buckets)) in phases.iteritems():
+      cumulative = []
+      total = 0
+      for (upper_bound, bucket_count) in zip(STATS_BUCKETS + (float("inf"),), buckets):
+        total += bucket_count
+        cumulative.append((upper_bound, total))
+      stats[phase] = {"count": count, "seconds": seconds, "buckets": cumulative}
+    return {"phases": stats, "counters": counters}
+
+
+class TimedLock(object):
+  ''' A lock that records in stats (if set) how long threads wait for it, whenever it is held by another thread:
+      acquiring it when it is free costs just one non-blocking attempt.
+  '''
+  
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.stats = None
+  
+  def acquire(self, blocking = True):
+    if self.__lock.acquire(False):
+      return True
+    elif not blocking:
+      return False
+    start = time()
+    self.__lock.acquire()
+    stats = self.stats
+    if stats is not None:
+      stats.observe(STATS_LOCK_WAIT, time() - start)
+    return True
+  
+  def release(self):
+    self.__lock.release()
+  
+  __enter__ = acquire
+  
+  def __exit__(self, *args):
+    self.__lock.release()
+
+
+threadLock = TimedLock()
+
+
+class PageNotModified(URLError):
+  ''' Raised when a page requested with a conditional GET hasn't changed since the previous crawl
+      (see CrawlerHandler.start_crawling's previous_crawl parameter).
+  '''
 
 
 class PageParser(HTMLParser):
@@ -68,6 +302,9 @@ class PageParser(HTMLParser):
      
      The constructor creates a parser object and connects it to the page
      
+     This is also the interface of parser backends (see PARSER_BACKENDS): a subclass can replace the way 
+     html is scanned overriding feed, as long as it calls handle_starttag and handle_endtag for the tags it finds.
+     
     :param page: A reference to the page object that will hold the structured info for the parsed html page.
 
   '''  
@@ -89,72 +326,126 @@ class PageParser(HTMLParser):
        :return: A string containing the URL of the page to be retrieved
     '''    
     
-    logging.info("Crawling page: %s; time:%s\n" % (url, datetime.now())) #Logs current page in order to give signals of its activity
+    logging.info("Crawling page: %s; time:%s\n", url, datetime.now()) #Logs current page in order to give signals of its activity
     try:
-      page = urlopen(url)
+      return self.__handler._open_url(url)
+    except PageNotModified:
+      self.__page._unpack_content(self.__handler._not_modified_content(url))
+      return None
     except URLError:
       logging.error("Error: can't open %s" % url)
       return None
     except Exception:
       logging.error("Error: can't open %s" % url)
       return None   
-    try:  
-      return "\n".join(page.readlines())
-    except KeyError:  #pragma: no cover
-      logging.error("Error")
-      return None
+  
+  def __stream(self, url):
+    ''' 
+       Retrieves a page chunk by chunk, feeding each chunk to the parser and to the content hash as soon as it arrives.
+       Only when the whole page has been read it can be checked against the pages already crawled: if it is a duplicate
+       (or a near duplicate), what has been parsed is discarded.
+       :private:
+       
+       :param url: The URL of the page to be crawled
+    '''
+    logging.info("Crawling page: %s; time:%s\n", url, datetime.now()) #Logs current page in order to give signals of its activity
+    content_hash = sha256()
+    simhash = SimHash() if self.__handler._near_duplicates is not None else None
+    parsing = True
+    parse_time = 0.
+    try:
+      for chunk in self.__handler._iter_url(url):
+        start = time()
+        content_hash.update(chunk)
+        if simhash is not None:
+          simhash.update(chunk)
+        if parsing:
+          parsing = self._feed(chunk, url)
+        parse_time += time() - start
+    except PageNotModified:
+      self.__page._unpack_content(self.__handler._not_modified_content(url))
+      return
+    except Exception:
+      logging.error("Error: can't open %s" % url)
+      self.__discard()
+      return
+    
+    self.__handler._stats.observe(STATS_PARSE, parse_time)
+    fingerprint = simhash.fingerprint() if simhash is not None else None
+    if not self.__handler.check_page_by_hash(content_hash.hexdigest(), url, fingerprint):
+      self.__discard()
+  
+  def _feed(self, html, url):
+    ''' Feeds (part of) a page to the parser.
+        
+        :return: False if the page can't be parsed any further.
+    '''
+    try:
+      self.feed(html)
+      return True
+    except UnicodeDecodeError:
+      logging.error("UnicodeDecodeError, url: %s" % url)
+    except UnicodeEncodeError:
+      logging.error("UnicodeEncodeError, url: %s" % url)
+    return False
+  
+  def __discard(self):
+    ''' Forgets all the links and resources found so far on the page.
+        :private:
+    '''
+    self.__page._clear_content()
   
   def startParsing(self, url):
     ''' Retrieve and parses the page located at the specific URL
+        (in streaming mode, parsing starts as soon as the first chunk of the page is retrieved)
         
         :param url:  The URL of the page to be retrieved and parsed.
     '''
-    html = self.__retrieve(url)
-    
+    if self.__handler._streaming:
+      self.__stream(url)
+    else:
+      self.parse(self.__retrieve(url), url)
+  
+  def parse(self, html, url):
+    ''' Parses a page whose content has already been retrieved
+        
+        :param html: The content of the page (None if it couldn't be retrieved).
+        :param url:  The URL the page was retrieved from.
+    '''
     if html != None and self.__handler.check_page_by_content(html, url):
-      try:
-        self.feed(html)
-      except UnicodeDecodeError:
-        logging.error("UnicodeDecodeError, url: %s" % url)
-      except UnicodeEncodeError:
-        logging.error("UnicodeEncodeError, url: %s" % url)
+      start = time()
+      self._feed(html, url)
+      self.__handler._stats.observe(STATS_PARSE, time() - start)
   
   def handle_starttag(self, tag, attrs):
-    def unzip(list_of_tuples):
-      try:
-        return {name: value  for (name, value) in list_of_tuples}
-      except: #pragma: no cover
-        logging.warning("Invalid Argument for unzip: " + repr(list_of_tuples))
-        return {}
-      
     tag = tag.lower()
     if tag == 'a':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       href = attrs.get('href')
       if href:
         self.__page._links_found.add(href)
     elif tag == 'link':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       href = attrs.get('href')
       if href != None:
         self.__page._css_urls.add(href)  
     elif tag == 'form':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       action = attrs.get('action')
       if action and attrs.get("method") == "get": #Won't follow post, update or delete actions to avoid causing damage!
         self.__page._links_found.add(action)
     elif tag == 'script':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       src = attrs.get('src')
       if src != None:
         self.__page._script_urls.add(src)
     elif tag == 'img':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       src = attrs.get('src')
       if src:
         self.__page._img_urls.add(src)
     elif tag == 'video':
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       src = attrs.get('src')
       
       if src != None:
@@ -174,7 +465,7 @@ class PageParser(HTMLParser):
       self.__page._audios.append(set())
       self.__last_media_tag = "audio"
     elif tag == "source":
-      attrs = unzip(attrs)
+      attrs = dict(attrs)
       src = attrs.get('src')      
       if self.__last_media_tag == "video":
         self.__page._videos[-1][VIDEO_URLS_TAG].add(src)
@@ -193,183 +484,2472 @@ class PageParser(HTMLParser):
       if self.__last_media_tag == "audio":
         self.__last_media_tag = ""
 
+class RegexPageParser(PageParser):
+  '''A faster PageParser backend: instead of tokenizing the whole page, a compiled regular expression jumps
+     straight to the few tags holding links or resources (and to comments, declarations, processing instructions,
+     scripts and styles, whose content must be skipped). Only those tags are parsed, following HTMLParser's own rules 
+     for attributes (and its own methods for declarations and processing instructions).
+     
+    :param page: A reference to the page object that will hold the structured info for the parsed html page.
+  '''
+  
+  def feed(self, data):
+    ''' Scans (a chunk of) html; incomplete tags or comments at the end of data are kept until the next chunk arrives.
+    
+        :param data: The html to parse.
+        :type data: string
+    '''
+    rawdata = self.rawdata = self.rawdata + data
+    i = 0
+    n = len(rawdata)
+    incomplete = False  #True if the scan stopped at the start of a tag, comment or declaration that isn't over yet
+    while i < n:
+      if self.cdata_elem is not None:
+        #Inside a script or style: looks for its end tag
+        match = self.interesting.search(rawdata, i)
+        if match is None:
+          break
+        self.clear_cdata_mode()
+        i = match.end()
+        continue
+      
+      match = TAGS_SCANNER.search(rawdata, i)
+      if match is None:
+        break
+      j = match.start()
+      if match.group() == "<!--":
+        comment_end = COMMENT_CLOSE.search(rawdata, match.end())
+        k = comment_end.end() if comment_end is not None else -1
+      elif match.group() == "<?":
+        k = self.parse_pi(j)
+      elif match.group() == "<!":
+        k = self.parse_html_declaration(j)  #Doctypes, marked sections (f.i. CDATA) and bogus comments
+      elif match.group(1):
+        self.handle_endtag(match.group(2).lower())
+        k = match.end()
+      else:
+        k = self.parse_starttag(j)
+      if k < 0:
+        #Kept whole until the next chunk completes it, whatever it contains (f.i. quoted '>' or other tags)
+        i = j
+        incomplete = True
+        break
+      i = k
+    
+    if i < n and not incomplete:
+      #Only a tag just started at the end of data can still be completed by the next chunk
+      j = rawdata.rfind("<", i)
+      i = j if j >= 0 and rawdata.find(">", j) < 0 else n
+    self.rawdata = rawdata[i:]
+
+
+PARSER_HTML = "html"
+PARSER_REGEX = "regex"
+PARSER_BACKENDS = {PARSER_HTML: PageParser, PARSER_REGEX: RegexPageParser}
+
+
+class PageContent(object):
+  ''' 
+    The links and the static content found on a page by a PageParser.
+  '''
+  
+  def __init__(self):
+    self._clear_content()
+  
+  def _clear_content(self):
+    self._links_found = set()
+    self._css_urls = set()
+    self._script_urls = set()
+    self._img_urls = set()
+    self._videos = []
+    self._audios = []
+  
+  def _pack_content(self):
+    ''' 
+        :return: The content as a tuple of plain lists, compact and cheap to pickle (see _unpack_content).
+    '''
+    return (list(self._links_found), list(self._css_urls), list(self._script_urls), list(self._img_urls),
+            [(list(video[VIDEO_URLS_TAG]), video.get(VIDEO_POSTER_TAG)) for video in self._videos],
+            [list(audio) for audio in self._audios])
+  
+  def _unpack_content(self, content):
+    ''' Fills the content from a tuple created by _pack_content.
+    '''
+    links, css_urls, script_urls, img_urls, videos, audios = content
+    self._links_found = list(links)  #Keeps the order the links were enqueued in
+    self._css_urls = set(css_urls)
+    self._script_urls = set(script_urls)
+    self._img_urls = set(img_urls)
+    self._videos = []
+    for (urls, poster) in videos:
+      video = {VIDEO_URLS_TAG: set(urls)}
+      if poster is not None:
+        video[VIDEO_POSTER_TAG] = poster
+      self._videos.append(video)
+    self._audios = [set(audio) for audio in audios]
+
+
+def parse_pages(parser_class, pages):
+  ''' Parses a batch of pages already retrieved, out of any crawling: 
+      it's run by the worker processes of the hybrid engine.
+      
+      :param parser_class: The PageParser backend to use.
+      
+      :param pages: A list of (url, html) pairs.
+      
+      :return: A list of (url, content, seconds) triples, where content is created by PageContent._pack_content
+      and seconds is the time spent parsing the page.
+  '''
+  parsed_pages = []
+  for (url, html) in pages:
+    start = time()
+    content = PageContent()
+    try:
+      parser_class(content, None)._feed(html, url)
+    except Exception:
+      logging.exception("Error parsing %s" % url)
+      content = PageContent()
+    parsed_pages.append((url, content._pack_content(), time() - start))
+  return parsed_pages
+
+
+def intern_urls(urls):
+  ''' 
+      :return: A tuple of the urls, interned so that the same url found on many pages is stored only once.
+  '''
+  return tuple(intern(url) if type(url) is str else url for url in urls)
+
+
 class Page(object):
   ''' 
     Data structure to represent a page-
     
-    Several different fields keeps track of all the static content linked from the page (see project description)
+    Several different fields keeps track of all the static content linked from the page (see project description).
+    
+    The page is parsed into a temporary PageContent, and then only the links and resources are kept, in slots, 
+    as tuples of interned URLs: videos are (urls, poster) pairs, and audios tuples of URLs.
     
     :param url: The URL of the page to page to be hereby retrieved, parsed and stored.
     
     :param handler: A reference to the CrawlerHandler object coordinating the crawling, used to access 
     its format_and_enqueue_url method to add the links found on the current page to the crawler's queue.
+    
+    :param html: The content of the page, when it has already been retrieved by the caller (used only if fetch is False).
+    
+    :param fetch: If True (default) the page is retrieved from its URL; otherwise html is parsed as it is.
+    
+    :param content: The content of the page, if it has already been parsed elsewhere (see PageContent._pack_content).
   '''   
   
-  def __init__(self, url, handler):
-    # Get lock to synchronize threads
-    threadLock.acquire(True)    
-    self.page_ID = handler._page_index
-    handler._page_index += 1
-    # Free lock to release next thread
-    threadLock.release()    
-          
-    _, self.domain, self.path, _, _ = urlsplit(url)
-    self._links = set()
-    self._links_found = set()
-    self._css_urls = set()
-    self._script_urls = set()
-    self._img_urls = set()
-    self._videos = []
-    self._audios = []
-    self.__handler = handler
-    self._depth = handler._url_depth[url]
+  __slots__ = ("page_ID", "_url", "_depth", "_links", "_css_urls", "_script_urls", "_img_urls", "_videos", "_audios")
+  
+  def __init__(self, url, handler, html = None, fetch = True, content = None):
+    self.page_ID = next(handler._page_ids)  #Atomic, no lock needed
+    self._depth = handler._url_table.depth(url)  #If it is lowered meanwhile, the handler will fix it (see enqueue_urls)
     self._url = url
     
-    parser = PageParser(self, self.__handler)
-    parser.startParsing(url)
-    
-    for link_url in self._links_found:
-      self.enqueue_link(link_url)
-
-#DEBUG
-    logging.debug(str(self._links))
-    logging.debug(str(self._img_urls))
-    logging.debug(str(self._script_urls))
-    logging.debug(str(self._css_urls))
+    page_content = PageContent()
+    if content is not None:
+      page_content._unpack_content(content)
+    else:
+      parser = handler._page_parser(page_content, handler)
+      if fetch:
+        parser.startParsing(url)
+      else:
+        parser.parse(html, url)
     
+    #Links are formatted without holding any lock, and then enqueued all together
+    path = self.path
+    links = []
+    linked = set()
+    for link_url in page_content._links_found:
+      link_url = handler.format_url(link_url, path)
+      if link_url is not None and link_url not in linked:
+        linked.add(link_url)
+        links.append(link_url)  #Keeps the order the links were found in, so that a packed page is enqueued the same way
     
+    self._links = tuple(handler.enqueue_urls(links, self._depth + 1))  #Interned by the handler's UrlTable
+    self._css_urls = intern_urls(page_content._css_urls)
+    self._script_urls = intern_urls(page_content._script_urls)
+    self._img_urls = intern_urls(page_content._img_urls)
+    self._videos = tuple((intern_urls(video[VIDEO_URLS_TAG]), video.get(VIDEO_POSTER_TAG)) for video in page_content._videos)
+    self._audios = tuple(intern_urls(audio) for audio in page_content._audios)
 
-  def enqueue_link(self, url):
-    ''' Takes a link, properly format it, and then keeps track of it for future crawling.
-        
-        If the URL belongs to another domain, it is neglected (see CrawlerHandler.format_and_enqueue_url specifications)
-        If it belongs to this domain, it may or may not have been added to the queue
-        (it's note this page's responsability); however, it will be linked from this page)
-        
-        :param url: The URL to be enqueued.
-    '''
+#DEBUG (formatted only if debug logging is enabled)
+    logging.debug("%s", self._links)
+    logging.debug("%s", self._img_urls)
+    logging.debug("%s", self._script_urls)
+    logging.debug("%s", self._css_urls)
     
-    page_url = self.__handler.format_and_enqueue_url(url, self.path, self._depth + 1)
-    if page_url is None:
-      return  #pragma: no cover
-    else:
-      self._links.add(page_url)      
+  @property
+  def domain(self):
+    return urlsplit(self._url)[1]
+  
+  @property
+  def path(self):
+    return urlsplit(self._url)[2]
+  
+  @property
+  def url(self):
+    return self._url
+  
+  @property
+  def depth(self):
+    return self._depth
+  
+  @property
+  def links(self):
+    ''' The URLs on the same domain linked by the page, in the order they were found.
+    '''
+    return self._links
+  
+  def _pack_content(self):
+    ''' 
+        :return: The content of the page, in the same format as PageContent._pack_content (with the links already formatted).
+    '''
+    return (list(self._links), list(self._css_urls), list(self._script_urls), list(self._img_urls),
+            [(list(urls), poster) for (urls, poster) in self._videos],
+            [list(audio) for audio in self._audios])
 
-class Crawler(threading.Thread):
-  ''' A breadth-first crawler.
+class AsyncFetcher(asyncore.dispatcher):
+  ''' Non-blocking retrieval of a single page, driven by an asyncore event loop.
       
-      Each crawler object can be run in a separate thread, and access the same synchronized Queue
-      to find the next pages to crawl and to enqueue the URLs of the next pages to be crawled.
+      The page is requested with a plain HTTP/1.0 GET (over SSL for https URLs), 
+      redirections are followed just like urlopen does, and once the transfer is over 
+      the callback is invoked exactly once.
       
-      :param threadID: The ID of the thread in which the crawler is going to be run.
+      Only the transfer is non-blocking: the host name is resolved (with socket.getaddrinfo) when the fetcher is created,
+      on the thread running the event loop, so a slow DNS resolver stalls all the transfers in flight meanwhile.
       
-      :param handler: A reference to the CrawlerHandler object coordinating the crawling.
+      :param url: The URL of the page to be retrieved.
+      
+      :param callback: Called as callback(url, html, status, headers) when the transfer is over; html is None
+      if the page couldn't be retrieved, status is the HTTP status of the last response (None on network errors),
+      and headers a dict of its headers (with lowercase names).
+      
+      :param socket_map: The asyncore map of the event loop that will drive the transfer.
+      
+      :param redirects: Maximum number of redirections still allowed.
+      
+      :param original_url: The URL originally requested, reported to the callback (defaults to url).
+      
+      :param max_body_size: If set, the transfer is aborted as soon as the response grows larger than this number of bytes.
+      
+      :param headers: Extra headers to be sent with the request (and with the ones following redirections).
+      :type headers: dict or None
+      
+      :param connect_timeout: The seconds to wait for the connection (None to wait forever): see check_timeout.
+      :type connect_timeout: float or None
+      
+      :param read_timeout: The seconds the server can go silent once connected (None to wait forever): see check_timeout.
+      :type read_timeout: float or None
   '''
+  
+  def __init__(self, url, callback, socket_map, redirects = MAX_REDIRECTS, original_url = None, max_body_size = None,
+               headers = None, connect_timeout = None, read_timeout = None):
+    asyncore.dispatcher.__init__(self, map = socket_map)
+    self.__url = url
+    self.__original_url = original_url if original_url is not None else url
+    self.__callback = callback
+    self.__socket_map = socket_map
+    self.__redirects = redirects
+    self.__max_body_size = max_body_size
+    self.__headers = headers
+    self.__connect_timeout = connect_timeout
+    self.__read_timeout = read_timeout
+    self.__deadline = time() + connect_timeout if connect_timeout is not None else None
+    self.__chunks = []
+    self.__received = 0
+    self.__header_size = None
+    self.__too_large = False
+    self.__done = False
     
-  def __init__(self, threadID, handler):
-    self.__threadID = threadID
-    self.__handler = handler
-    threading.Thread.__init__(self)
+    parts = urlsplit(url)
+    self.__secure = parts.scheme == "https"
+    self.__handshake_done = not self.__secure
+    self.__host = parts.hostname
+    self.__request = ("GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: %s\r\nConnection: close\r\n%s\r\n" % 
+                      (urlunsplit(('', '', parts.path or '/', parts.query, '')), parts.netloc.rpartition("@")[2], USER_AGENT,
+                       "".join("%s: %s\r\n" % header for header in (headers or {}).items())))
     
-  def run(self):
-    ''' Starts the crawler.
+    logging.info("Crawling page: %s; time:%s\n", url, datetime.now()) #Logs current page in order to give signals of its activity
+    try:
+      port = parts.port or (443 if self.__secure else 80)
+      #Blocking: see the class description (IPv6 addresses are resolved too)
+      (family, _, _, _, address) = socket.getaddrinfo(self.__host, port, 0, socket.SOCK_STREAM)[0]
+      self.create_socket(family, socket.SOCK_STREAM)
+      self.connect(address)
+    except Exception:
+      if self.socket is not None:
+        self.close()
+      self.__finish(None)
+  
+  def writable(self):
+    return not self.connected or not self.__handshake_done or len(self.__request) > 0
+  
+  def check_timeout(self, now):
+    ''' Aborts the transfer if the connection hasn't been established within connect_timeout, 
+        or if nothing has been received for read_timeout seconds since: the event loop must call it periodically.
+        
+        :param now: The current time.
+        :type now: float
+        
+        :return: True if the transfer has been aborted.
     '''
-
-    return self.__crawl_next()  #pragma: no cover (recursive thread call not traced)
+    if self.__done or self.__deadline is None or now < self.__deadline:
+      return False
+    logging.error("Timed out: %s" % self.__url)
+    self.handle_error()
+    return True
+  
+  def __extend_deadline(self):
+    ''' The server has been heard from: it has read_timeout seconds more.
+        :private:
+    '''
+    self.__deadline = time() + self.__read_timeout if self.__read_timeout is not None else None
     
-  def quit(self):
-    '''Force the thread to exit.
+  def handle_connect(self):
+    self.__extend_deadline()
+    if self.__secure:
+      context = ssl.create_default_context()
+      self.socket = context.wrap_socket(self.socket, server_hostname = self.__host, do_handshake_on_connect = False)
+  
+  def __handshake(self):
+    ''' Advances the SSL handshake as far as the socket allows without blocking.
+        :private:
+    '''
+    try:
+      self.socket.do_handshake()
+      self.__handshake_done = True
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+      pass
+  
+  def handle_write(self):
+    if not self.__handshake_done:
+      return self.__handshake()
+    sent = self.send(self.__request)
+    self.__request = self.__request[sent:]
+  
+  def handle_read(self):
+    if not self.__handshake_done:
+      return self.__handshake()
+    try:
+      self.__receive()
+      while self.__secure and self.socket.pending(): #Data already decrypted won't wake up select
+        self.__receive()
+    except ssl.SSLWantReadError:
+      pass
+    except ssl.SSLError:
+      #Many servers close SSL connections without a close_notify: truncated bodies are caught by __finish
+      self.handle_close()
     
-       :raise SystemExit: Always raises a SystemExit to be sure to silently kill the thread: must be caught or the main program will exit as well
+    if self.__max_body_size is not None and self.__received - (self.__header_size or 0) > self.__max_body_size:
+      logging.error("Page larger than %d bytes: %s" % (self.__max_body_size, self.__url))
+      self.__too_large = True  #Not a network error: the status received is reported
+      self.handle_close()
+  
+  def __receive(self):
+    ''' Reads the next chunk of the response.
+        :private:
     '''
-    if self.is_alive():
-      self._Thread__stop()
-      thread.exit()
+    chunk = self.recv(ASYNC_CHUNK_SIZE)
+    self.__extend_deadline()
+    self.__received += len(chunk)
+    self.__chunks.append(chunk)
+    if self.__header_size is None:
+      header_end = "".join(self.__chunks).find("\r\n\r\n")
+      if header_end >= 0:
+        self.__header_size = header_end + 4
   
-  def __crawl_next(self):
-    ''' Takes the next URL from the queue (if any, otherwise it waits until one is available)
-        and tries crawl the resource pointed to. 
-        
+  def handle_close(self):
+    self.close()
+    self.__finish("".join(self.__chunks))
+  
+  def handle_error(self):
+    self.close()
+    self.__finish(None)
+  
+  handle_expt = handle_error
+  
+  def __finish(self, response):
+    ''' Parses the raw response, following redirections, and hands the page content to the callback.
         :private:
+        
+        :param response: The raw HTTP response (None on network errors).
     '''
-    #Crawls at most one page every crawler_delay ms
-    sleep( min(time() - self.__handler._last_crawl_time, self.__handler._crawler_delay))
-
-    #Updates crawl time 
-    self.__handler._last_crawl_time = time()
-    
-    page_url = self.__handler._queue.get(True) #Wait until an element is available for removal from the queue
-
-#    try:
-#      page_url = self.__handler._queue.get()
-#    except Empty:
-#      logging.info("Thread %d releasing" % self.__threadID)
-#      return
-    
-    logging.debug("Thread %d crawling %s" % (self.__threadID, page_url))
-    page = Page(page_url, self.__handler)
+    if self.__done:
+      return
+    self.__done = True
     
-    #Updates last crawl time 
-    self.__handler._last_crawl_time = time()
-    
-    self.__handler._site[page.page_ID] = page
-    self.__handler._url_to_page_id[page_url] = page.page_ID
-    self.__handler._queue.task_done()
+    html = None
+    status = None
+    headers = {}
+    if response:
+      head, _, body = response.partition("\r\n\r\n")
+      lines = head.split("\r\n")
+      try:
+        status = int(lines[0].split()[1])
+      except (IndexError, ValueError):
+        status = None
+      for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+      
+      if self.__too_large:
+        pass
+      elif status in REDIRECT_CODES and "location" in headers and self.__redirects > 0:
+        AsyncFetcher(urljoin(self.__url, headers["location"]), self.__callback, self.__socket_map, 
+                     self.__redirects - 1, self.__original_url, self.__max_body_size, self.__headers,
+                     self.__connect_timeout, self.__read_timeout)
+        return
+      elif status is not None and 200 <= status < 300:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+          body = dechunk(body)
+          html = body
+        elif not headers.get("content-length", "").isdigit() or len(body) >= int(headers["content-length"]):
+          html = body
+        
+    if html is None and status != 304:
+      logging.error("Error: can't open %s" % self.__url)
+    self.__callback(self.__original_url, html, status, headers)
 
-    return self.__crawl_next() #pragma: no cover (recursive thread call not traced)
 
-    
+def dechunk(body):
+  ''' Decodes a body sent with chunked transfer encoding.
   
-class CrawlerHandler(object):
-  ''' The main crawler, the object handling all the high-level crawling process. 
+      :param body: The raw body of the response.
+      :type body: string
+      
+      :return: The decoded body (what could be decoded of it, if it is truncated).
   '''
-  
-  def __init__(self):
-    self._page_index = 0
-    
+  chunks = []
+  position = 0
+  while True:
+    line_end = body.find("\r\n", position)
+    if line_end < 0:
+      break
+    try:
+      size = int(body[position:line_end].split(";")[0], 16)
+    except ValueError:
+      break
+    if size == 0:
+      break
+    chunks.append(body[line_end + 2: line_end + 2 + size])
+    position = line_end + 4 + size
+  return "".join(chunks)
 
-  def check_page_by_content(self, html, url):
-    ''' Check if a page has already been visited by its content: if two different urls lead to the same identical page,
-        it will be caught here, and no further processing of the page will be 
-        :param html: The content of the page.
-        :type html: string
-        :param url: The url of the page.
-        :type url: string
-    '''
-    page_hash = sha256(html).hexdigest()
-    #print page_hash, self.__queued_pages_hashs
-    if page_hash in self.__queued_pages_hashs:
-      self.__queued_pages_hashs[page_hash].append(url)
-      return False
+class ContentDecoder(object):
+  ''' Decodes incrementally a body sent with a Content-Encoding among the ones in ACCEPT_ENCODING, so that 
+      it can be parsed as it arrives, without buffering the compressed body first.
+      
+      Bodies sent with "deflate" should be zlib streams, but some servers send raw deflate data instead: both are accepted.
+      
+      :param encoding: The value of the Content-Encoding header of the response (None if the body isn't encoded).
+      :type encoding: string or None
+      
+      :param chunk_size: The maximum size of each decoded chunk, so that a small chunk received can't be inflated 
+      at once into a huge one.
+      :type chunk_size: integer or DEFAULT_CHUNK_SIZE
+      
+      :raise URLError: If the encoding isn't supported.
+  '''
+  
+  def __init__(self, encoding, chunk_size = DEFAULT_CHUNK_SIZE):
+    self.__chunk_size = max(1, chunk_size)
+    self.__encoding = (encoding or "identity").strip().lower()
+    if self.__encoding in ("gzip", "x-gzip"):
+      self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif self.__encoding == "deflate":
+      self.__decompressor = zlib.decompressobj()
+    elif self.__encoding == "identity":
+      self.__decompressor = None
     else:
-      self.__queued_pages_hashs[page_hash] = [url]
-      return True    
-    
-
-  def format_and_enqueue_url(self, page_url, current_path, current_depth):       
-    ''' Enqueue a url to a page to be retrieved, if it hasn't been enqueued yet
-        and if it is "valid", meaning it's in the same domain as the main page
-        
-        :param page_url: the original URL to be enqueued
-        
-        :param current_path: the path of current page (for relative URLs)
+      raise URLError("Unsupported content encoding: %s" % encoding)
+    self.__started = False
+  
+  def decode(self, data):
+    ''' 
+        :param data: The next chunk of the body, as received.
+        :type data: string
         
-        :param current_depth: depth of the current page (distance from the starting page)
+        :return: A generator of the chunks of the body decoded so far from it, each of at most chunk_size bytes
+        (the rest of data is only decoded as they are consumed).
         
-        :return:
-          -  None <=> the URL is located in a different domain
-          -  The formatted absolute URL, otherwise
-    '''    
-    
-    (scheme, domain, path, _, _) = urlsplit(page_url)
-    if scheme == '':
-      scheme = self.__home_scheme
-    elif scheme != self.__home_scheme and not ((scheme == "http" and self.__home_scheme == "https") or (scheme == "https" and self.__home_scheme == "http")):
-      return None
-#      elif scheme == 'https':
-#        scheme = 'http'
-    if domain == '':
-      domain = self.__home_domain
+        :raise URLError: If the body is corrupted.
+    '''
+    if self.__decompressor is None:
+      if data:
+        yield data
+      return
+    while True:
+      try:
+        decoded = self.__decompressor.decompress(data, self.__chunk_size)
+      except zlib.error as e:
+        if self.__started or self.__encoding != "deflate":
+          raise URLError("Can't decode the %s body: %s" % (self.__encoding, e))
+        self.__started = True  #The zlib header is at the beginning: if raw deflate fails as well, the body is corrupted
+        self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        continue
+      self.__started = True
+      if decoded:
+        yield decoded
+      data = self.__decompressor.unconsumed_tail
+      if not data and len(decoded) < self.__chunk_size:
+        return  #Otherwise more output might be pending, even with no input left
+  
+  def flush(self):
+    ''' 
+        :return: What is left of the body, once all of it has been received.
+    '''
+    if self.__decompressor is None:
+      return ""
+    return self.__decompressor.flush()
+
+
+def decode_chunks(chunks, response_headers, sizes, chunk_size = DEFAULT_CHUNK_SIZE):
+  ''' Decodes the chunks of a body as they arrive (see ContentDecoder).
+  
+      :param chunks: An iterable of the chunks of the body, as received (f.i. ConnectionPool.iter_content).
+      
+      :param response_headers: The headers of the response, with lowercase names: they need only be set
+      once the first chunk has arrived.
+      :type response_headers: dict
+      
+      :param sizes: A [bytes received, bytes decoded] pair, updated as chunks are decoded.
+      :type sizes: list
+      
+      :param chunk_size: The maximum size of each decoded chunk.
+      :type chunk_size: integer or DEFAULT_CHUNK_SIZE
+      
+      :return: A generator of the decoded chunks.
+      
+      :raise URLError: If the body can't be decoded.
+  '''
+  decoder = None
+  try:
+    for chunk in chunks:
+      if decoder is None:
+        decoder = ContentDecoder(response_headers.get("content-encoding"), chunk_size)
+      sizes[0] += len(chunk)
+      for decoded in decoder.decode(chunk):
+        sizes[1] += len(decoded)
+        yield decoded
+    if decoder is not None:
+      chunk = decoder.flush()
+      if chunk:
+        sizes[1] += len(chunk)
+        yield chunk
+  finally:
+    if hasattr(chunks, "close"):
+      chunks.close()  #Gives the connection back as soon as the transfer is over (or closes it, if it's interrupted)
+
+
+def is_transient(error):
+  ''' 
+      :param error: The exception raised retrieving a page.
+      :type error: Exception
+      
+      :return: True if sending the same request again might succeed: the network failed (or timed out),
+      or the server answered with one of RETRY_STATUS_CODES.
+  '''
+  if isinstance(error, HTTPError):
+    return error.code in RETRY_STATUS_CODES
+  return isinstance(error, URLError) and isinstance(error.reason, (socket.error, httplib.HTTPException))
+
+
+def parse_retry_after(value):
+  ''' 
+      :param value: The value of a Retry-After header: a number of seconds, or an HTTP date.
+      :type value: string or None
+      
+      :return: The number of seconds to wait (0 if value is missing or malformed).
+  '''
+  if not value:
+    return 0
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+  date = parsedate_tz(value)
+  if date is None:
+    return 0
+  return max(0, mktime_tz(date) - time())
+
+
+class ConnectionPool(object):
+  ''' A thread-safe pool of keep-alive HTTP(S) connections, grouped by host.
+      
+      A single pool is shared by the CrawlerHandler and all its Crawler threads, so that 
+      consecutive requests to the same host reuse an open connection instead of paying 
+      for a new TCP (and SSL) handshake each time.
+      
+      :param pool_size: The maximum number of idle connections kept open for each host; when they
+      are all in use, further requests open new connections, which are closed once they are done.
+      
+      :param idle_timeout: Connections idle for longer than this number of seconds are closed instead of being reused.
+      
+      :param connect_timeout: The seconds to wait for a connection to be established (None to wait forever).
+      
+      :param read_timeout: The seconds to wait for each part of a response (None to wait forever).
+  '''
+  
+  def __init__(self, pool_size = DEFAULT_POOL_SIZE, idle_timeout = DEFAULT_POOL_IDLE_TIMEOUT,
+               connect_timeout = DEFAULT_CONNECT_TIMEOUT, read_timeout = DEFAULT_READ_TIMEOUT):
+    self.__pool_size = max(0, int(pool_size))
+    self.__idle_timeout = idle_timeout
+    self.__connect_timeout = connect_timeout
+    self.__read_timeout = read_timeout
+    self.__idle_connections = {}  #Maps (scheme, host) to a list of (connection, last time used) pairs
+    self.__lock = threading.Lock()
+    self.connections_opened = 0
+    self.requests_sent = 0
+  
+  def fetch(self, url):
+    ''' Retrieves the content of a page, following redirections just like urlopen does.
+    
+        :param url: The URL of the page (must use one of POOLED_SCHEMES).
+        :type url: string
+        
+        :return: The body of the response.
+        
+        :raise URLError: If the page can't be retrieved (HTTPError for error responses).
+    '''
+    return "".join(self.iter_content(url))
+  
+  def iter_content(self, url, chunk_size = DEFAULT_CHUNK_SIZE, headers = None, response_headers = None):
+    ''' Retrieves the content of a page chunk by chunk, following redirections just like urlopen does.
+        The connection goes back to the pool once the whole body has been read; if the iteration
+        is stopped earlier, it is closed instead.
+    
+        :param url: The URL of the page (must use one of POOLED_SCHEMES).
+        :type url: string
+        
+        :param chunk_size: The maximum size of each chunk, in bytes.
+        :type chunk_size: integer or DEFAULT_CHUNK_SIZE
+        
+        :param headers: Extra headers to be sent with the request (and with the ones following redirections).
+        :type headers: dict or None
+        
+        :param response_headers: If set, it is filled with the headers of the last response (with lowercase names).
+        :type response_headers: dict or None
+        
+        :return: A generator of the chunks of the body of the response.
+        
+        :raise URLError: If the page can't be retrieved (HTTPError for error responses).
+    '''
+    for _ in xrange(MAX_REDIRECTS + 1):
+      (scheme, netloc, path, query, _) = urlsplit(url)
+      connection, response = self.__request(scheme, netloc, urlunsplit(('', '', path or '/', query, '')), headers)
+      location = response.getheader("location")
+      if response_headers is not None:
+        response_headers.clear()
+        response_headers.update(response.getheaders())
+      body_read = False
+      try:
+        if 200 <= response.status < 300:
+          chunk = self.__read(response, chunk_size)
+          while chunk:
+            yield chunk
+            chunk = self.__read(response, chunk_size)
+          body_read = True
+          return
+        
+        self.__read(response)
+        body_read = True
+        if response.status in REDIRECT_CODES and location:
+          url = urljoin(url, location)
+        else:
+          raise HTTPError(url, response.status, response.reason, response.msg, None)
+      finally:
+        if body_read and not response.will_close:
+          self.__release(scheme, netloc, connection)
+        else:
+          connection.close()
+    raise URLError("Too many redirections: %s" % url)
+  
+  def close(self):
+    ''' Closes all the idle connections.
+    '''
+    with self.__lock:
+      idle_connections = self.__idle_connections
+      self.__idle_connections = {}
+    for connections in idle_connections.values():
+      for (connection, _) in connections:
+        connection.close()
+  
+  def __request(self, scheme, netloc, path, headers = None):
+    ''' Sends a GET request on a pooled connection; if a reused connection turns out to have been
+        dropped by the server in the meantime, the request is sent again on a different one.
+        Timeouts are never resent here: the server might still be processing the request.
+        :private:
+        
+        :return: The connection and the response, whose body is still to be read.
+    '''
+    request_headers = {"User-Agent": USER_AGENT}
+    if headers:
+      request_headers.update(headers)
+    while True:
+      connection, reused = self.__acquire(scheme, netloc)
+      try:
+        if connection.sock is None:
+          connection.connect()  #Within connect_timeout
+          connection.sock.settimeout(self.__read_timeout)
+        connection.request("GET", path, headers = request_headers)
+        response = connection.getresponse()
+      except (socket.error, httplib.HTTPException) as e:
+        connection.close()
+        dropped = isinstance(e, httplib.BadStatusLine) or (not isinstance(e, socket.timeout) and 
+                                                            e.args and e.args[0] in (errno.ECONNRESET, errno.EPIPE))
+        if reused and dropped:
+          continue
+        raise URLError(e)
+      
+      self.requests_sent += 1
+      return connection, response
+  
+  def __read(self, response, size = None):
+    ''' Reads (part of) the body of a response.
+        :private:
+        
+        :raise URLError: If the connection fails while reading.
+    '''
+    try:
+      return response.read(size)
+    except (socket.error, httplib.HTTPException) as e:
+      raise URLError(e)
+  
+  def __acquire(self, scheme, netloc):
+    ''' Takes an idle connection to a host out of the pool, or opens a new one if none is available.
+        :private:
+        
+        :return: The connection, and True if it has already been used.
+    '''
+    now = time()
+    with self.__lock:
+      idle_connections = self.__idle_connections.get((scheme, netloc), [])
+      while len(idle_connections) > 0:
+        connection, last_used = idle_connections.pop()
+        if now - last_used < self.__idle_timeout:
+          return connection, True
+        connection.close()
+      self.connections_opened += 1
+    
+    if scheme == "https":
+      return httplib.HTTPSConnection(netloc, timeout = self.__connect_timeout, context = ssl.create_default_context()), False
+    else:
+      return httplib.HTTPConnection(netloc, timeout = self.__connect_timeout), False
+  
+  def __release(self, scheme, netloc, connection):
+    ''' Puts a connection back into the pool, or closes it if the pool for its host is full.
+        :private:
+    '''
+    with self.__lock:
+      idle_connections = self.__idle_connections.setdefault((scheme, netloc), [])
+      if len(idle_connections) < self.__pool_size:
+        idle_connections.append((connection, time()))
+        return
+    connection.close()
+
+
+class ResponseCache(object):
+  ''' An on-disk cache of the pages retrieved, to crawl them again offline (see CrawlerHandler.start_crawling's replay parameter).
+      
+      Bodies are content addressed: each one is stored once, in a file named after its sha256 hash, no matter how many URLs
+      lead to it, while an SQLite index maps URLs to hashes. When the bodies grow larger than max_size, the least recently
+      used ones are evicted, together with the URLs leading to them.
+      
+      It can be shared by all the Crawler threads.
+      
+      :param path: The folder of the cache (created if it doesn't exist); a cache can be reopened across runs.
+      :type path: string
+      
+      :param max_size: The maximum total size of the bodies, in bytes (None for no limit).
+      :type max_size: integer or None
+  '''
+  
+  def __init__(self, path, max_size = None):
+    self.__path = path
+    self.__max_size = max_size
+    self.__lock = threading.Lock()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.__index = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread = False, isolation_level = None)
+    self.__index.execute("PRAGMA journal_mode = WAL")
+    self.__index.execute("PRAGMA synchronous = NORMAL")
+    self.__index.execute("CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, size INTEGER, used INTEGER)")
+    self.__index.execute("CREATE INDEX IF NOT EXISTS bodies_used ON bodies (used)")
+    self.__index.execute("CREATE TABLE IF NOT EXISTS urls (url BLOB PRIMARY KEY, hash TEXT)")
+    self.__size, self.__clock = self.__index.execute("SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM bodies").fetchone()
+  
+  def __len__(self):
+    ''' 
+        :return: The number of URLs cached.
+    '''
+    with self.__lock:
+      return self.__index.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+  
+  def size(self):
+    ''' 
+        :return: The total size of the bodies cached, in bytes.
+    '''
+    with self.__lock:
+      return self.__size
+  
+  def put(self, url, body):
+    ''' Stores the body retrieved from an URL (bodies larger than max_size are not cached).
+    
+        :param url: The URL the body was retrieved from.
+        :type url: string
+        
+        :param body: The body of the response.
+        :type body: string
+    '''
+    if self.__max_size is not None and len(body) > self.__max_size:
+      return
+    body_hash = sha256(body).hexdigest()
+    with self.__lock:
+      self.__clock += 1
+      if self.__index.execute("UPDATE bodies SET used = ? WHERE hash = ?", (self.__clock, body_hash)).rowcount == 0:
+        body_path = self.__body_path(body_hash)
+        if not os.path.isdir(os.path.dirname(body_path)):
+          os.makedirs(os.path.dirname(body_path))
+        with open(body_path, "wb") as body_file:
+          body_file.write(body)
+        self.__index.execute("INSERT INTO bodies (hash, size, used) VALUES (?, ?, ?)", (body_hash, len(body), self.__clock))
+        self.__size += len(body)
+      self.__index.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)", (self.__key(url), body_hash))
+      
+      while self.__max_size is not None and self.__size > self.__max_size:
+        self.__evict()
+  
+  def get(self, url):
+    ''' 
+        :param url: The URL of a page.
+        :type url: string
+        
+        :return: The body cached for the URL, or None if it isn't in the cache.
+    '''
+    with self.__lock:
+      row = self.__index.execute("SELECT hash FROM urls WHERE url = ?", (self.__key(url),)).fetchone()
+      if row is None:
+        return None
+      self.__clock += 1
+      self.__index.execute("UPDATE bodies SET used = ? WHERE hash = ?", (self.__clock, row[0]))
+      try:
+        with open(self.__body_path(row[0]), "rb") as body_file:
+          return body_file.read()
+      except IOError: #pragma: no cover
+        return None
+  
+  def close(self):
+    with self.__lock:
+      self.__index.close()
+  
+  def __evict(self):
+    ''' Deletes the least recently used body, and all the URLs leading to it (must be called holding the lock).
+        :private:
+    '''
+    body_hash, size = self.__index.execute("SELECT hash, size FROM bodies ORDER BY used LIMIT 1").fetchone()
+    self.__index.execute("DELETE FROM urls WHERE hash = ?", (body_hash,))
+    self.__index.execute("DELETE FROM bodies WHERE hash = ?", (body_hash,))
+    self.__size -= size
+    try:
+      os.remove(self.__body_path(body_hash))
+    except OSError: #pragma: no cover
+      pass
+  
+  def __body_path(self, body_hash):
+    ''' 
+        :private:
+    '''
+    return os.path.join(self.__path, "bodies", body_hash[:2], body_hash)
+  
+  def __key(self, url):
+    ''' 
+        :private:
+    '''
+    return sqlite3.Binary(marshal.dumps(url))
+
+
+class UrlTable(object):
+  ''' Interns the URLs met during crawling: each URL is mapped to an integer ID, and the state of
+      each URL (depth, ID of the page crawled, queued flag, number of links to it) is kept in array-backed columns indexed by ID,
+      which is much more compact than a dict per field. All the references to an URL can share 
+      the same string object (see url).
+      
+      Adding URLs is not synchronized: it must be done holding threadLock.
+  '''
+  
+  def __init__(self):
+    self.__ids = {}
+    self.__urls = []
+    self.__depths = array('i')
+    self.__page_ids = array('l')
+    self.__queued = bytearray()
+    self.__in_links = array('i')
+  
+  def __len__(self):
+    return len(self.__urls)
+  
+  def __contains__(self, url):
+    return url in self.__ids
+  
+  def __iter__(self):
+    ''' Iterates over the URLs, in the order of their IDs.
+    '''
+    return iter(self.__urls)
+  
+  def add(self, url, depth):
+    ''' Interns an URL, or updates its depth if it is found at a lower depth than before.
+    
+        :param url: The URL.
+        :type url: string
+        
+        :param depth: The depth at which the URL has been found.
+        :type depth: integer
+        
+        :return: The ID of the URL.
+    '''
+    url_id = self.__ids.get(url)
+    if url_id is None:
+      url_id = self.__ids[url] = len(self.__urls)
+      self.__urls.append(url)
+      self.__depths.append(depth)
+      self.__page_ids.append(-1)
+      self.__queued.append(0)
+      self.__in_links.append(0)
+    elif depth < self.__depths[url_id]:
+      self.__depths[url_id] = depth
+    return url_id
+  
+  def get_id(self, url):
+    ''' 
+        :return: The ID of an URL, or None if it has never been added.
+    '''
+    return self.__ids.get(url)
+  
+  def url(self, url_id):
+    ''' 
+        :return: The interned string for the URL with the given ID.
+    '''
+    return self.__urls[url_id]
+  
+  def depth(self, url):
+    return self.__depths[self.__ids[url]]
+  
+  def is_queued(self, url_id):
+    return self.__queued[url_id] == 1
+  
+  def set_queued(self, url_id):
+    self.__queued[url_id] = 1
+  
+  def page_id(self, url):
+    ''' 
+        :return: The ID of the page crawled at an URL, or None if it hasn't been crawled.
+    '''
+    url_id = self.__ids.get(url)
+    if url_id is None or self.__page_ids[url_id] < 0:
+      return None
+    return self.__page_ids[url_id]
+  
+  def set_page_id(self, url, page_id):
+    self.__page_ids[self.__ids[url]] = page_id
+  
+  def in_links(self, url_id):
+    ''' 
+        :return: The number of links to the URL with the given ID found so far.
+    '''
+    return self.__in_links[url_id]
+  
+  def add_in_link(self, url_id):
+    self.__in_links[url_id] += 1
+
+
+def in_links_score(url, depth, in_links):
+  ''' A score for CrawlerHandler's url_score: among the URLs at the same depth, the ones linked by more pages are crawled first.
+  '''
+  return in_links
+
+
+def pattern_score(patterns):
+  ''' Creates a score for CrawlerHandler's url_score from regular expressions: among the URLs at the same depth, 
+      the ones matching the patterns with the highest scores are crawled first.
+      
+      :param patterns: A list of (regular expression, score) pairs: each URL gets the score of the first pattern found in it (or 0).
+      :type patterns: list
+  '''
+  patterns = [(re.compile(pattern), score) for (pattern, score) in patterns]
+  def score(url, depth, in_links):
+    for (pattern, value) in patterns:
+      if pattern.search(url):
+        return value
+    return 0
+  return score
+
+
+def resolution_base(base, href):
+  ''' The part of base that matters to resolve href against it: relative references that don't start with a query
+      or a fragment only depend on the "directory" of base, so links found on different pages in the same directory 
+      are resolved the same way.
+      
+      :param base: A path, or an absolute URL with a path.
+      
+      :param href: A link found on the page at base.
+  '''
+  if not href or href[0] in "?#":
+    return base
+  slash = base.rfind("/")
+  if slash < 0 or (slash > 0 and base[slash - 1] == "/"):  #No directory (f.i. "http://host")
+    return base
+  return base[:slash + 1]
+
+
+class UrlCache(object):
+  ''' A bounded cache of the links already resolved, keyed by (base, href) pairs: most pages of a site share the same
+      navigation and the same assets, which would otherwise be parsed and joined again on every page.
+      
+      Entries are kept in two generations, so that the least recently used are evicted cheaply: hits are looked up
+      in the young generation first, and moved there from the old one; once the young generation is full, the old one is
+      dropped and the young one takes its place. It can be shared by threads without locking (at worst an entry is lost).
+      
+      :param capacity: The maximum number of entries.
+      :type capacity: integer or DEFAULT_URL_CACHE_SIZE
+  '''
+  
+  def __init__(self, capacity = DEFAULT_URL_CACHE_SIZE):
+    self.__generation_size = max(1, int(capacity) // 2)
+    self.__young = {}
+    self.__old = {}
+  
+  def __len__(self):
+    return len(self.__young) + len(self.__old)
+  
+  def get(self, key):
+    ''' 
+        :return: The value cached for key, or URL_CACHE_MISS.
+    '''
+    value = self.__young.get(key, URL_CACHE_MISS)
+    if value is URL_CACHE_MISS:
+      value = self.__old.get(key, URL_CACHE_MISS)
+      if value is not URL_CACHE_MISS:
+        self.put(key, value)
+    return value
+  
+  def put(self, key, value):
+    young = self.__young
+    young[key] = value
+    if len(young) >= self.__generation_size:
+      self.__old, self.__young = young, {}
+
+
+class BloomFilter(object):
+  ''' A Bloom filter of strings: a compact set that can only tell for sure if a string has NOT been added, 
+      while strings never added are reported as present with probability error_rate.
+      
+      :param capacity: The number of strings that are expected to be added.
+      :type capacity: integer
+      
+      :param error_rate: The false positive rate once _capacity_ strings have been added.
+      :type error_rate: float
+  '''
+  
+  def __init__(self, capacity = DEFAULT_BLOOM_CAPACITY, error_rate = DEFAULT_BLOOM_ERROR_RATE):
+    capacity = max(1, int(capacity))
+    self.__size = max(8, int(ceil(-capacity * log(error_rate) / log(2) ** 2))) #Number of bits
+    self.__hashes = max(1, int(round(float(self.__size) / capacity * log(2))))
+    self.__bits = bytearray((self.__size + 7) // 8)
+  
+  def __positions(self, string):
+    ''' The bits set for a string, computed by double hashing from a single md5 digest.
+        :private:
+    '''
+    h1, h2 = unpack("<QQ", md5(string).digest())
+    return [(h1 + i * h2) % self.__size for i in xrange(self.__hashes)]
+  
+  def add(self, string):
+    bits = self.__bits
+    for position in self.__positions(string):
+      bits[position >> 3] |= 1 << (position & 7)
+  
+  def __contains__(self, string):
+    bits = self.__bits
+    for position in self.__positions(string):
+      if not bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+  
+  def memory_size(self):
+    ''' 
+        :return: The number of bytes used to store the filter's bits.
+    '''
+    return len(self.__bits)
+
+
+class SimHash(object):
+  ''' Computes the SimHash fingerprint of the text of a page, fed chunk by chunk like hashlib objects:
+      pages whose text is almost the same have fingerprints that differ only in a few bits.
+      
+      Tags are stripped, and the features hashed are the distinct shingles of SIMHASH_SHINGLE_SIZE consecutive words,
+      so that the cost is linear in the size of the page.
+      
+      :param data: The first chunk of the page (optional).
+      :type data: string
+  '''
+  
+  def __init__(self, data = None):
+    self.__tail = ""  #What could be the beginning of a tag or of a word split between two chunks
+    self.__words = deque(maxlen = SIMHASH_SHINGLE_SIZE)
+    self.__shingles = set()
+    if data:
+      self.update(data)
+  
+  def update(self, data):
+    data = self.__tail + data
+    tag_start = data.rfind("<")
+    if tag_start > data.rfind(">"):
+      end = tag_start
+    else:
+      last_word = SIMHASH_LAST_WORD.search(data)
+      end = last_word.start() if last_word else len(data)
+    self.__tail = data[end:]
+    self.__add_words(data[:end])
+  
+  def fingerprint(self):
+    ''' 
+        :return: The SIMHASH_BITS bits fingerprint of the text fed so far.
+    '''
+    if not self.__tail.startswith("<"):
+      self.__add_words(self.__tail)
+    self.__tail = ""
+    if len(self.__shingles) == 0 and len(self.__words) > 0:
+      self.__shingles.add(self.__shingle_hash())  #Pages shorter than a shingle
+    if len(self.__shingles) == 0:
+      return 0
+    #Each bit is set if it's set in the majority of the shingles' hashes
+    half = len(self.__shingles) / 2.
+    bits = [format(shingle, SIMHASH_BINARY_FORMAT) for shingle in self.__shingles]
+    return int("".join("1" if column.count("1") > half else "0" for column in zip(*bits)), 2)
+  
+  def __add_words(self, text):
+    ''' 
+        :private:
+    '''
+    for word in SIMHASH_WORDS.findall(SIMHASH_TAGS.sub(" ", text).lower()):
+      self.__words.append(word)
+      if len(self.__words) == SIMHASH_SHINGLE_SIZE:
+        self.__shingles.add(self.__shingle_hash())
+  
+  def __shingle_hash(self):
+    ''' 
+        :private:
+    '''
+    return unpack("<Q", md5(" ".join(self.__words)).digest()[:8])[0]
+
+
+def hamming_distance(fingerprint_1, fingerprint_2):
+  return bin(fingerprint_1 ^ fingerprint_2).count("1")
+
+
+class NearDuplicateIndex(object):
+  ''' An index of SimHash fingerprints, to find those within max_distance bits of a given one.
+      
+      Fingerprints are split in max_distance + 1 bands: two fingerprints differing in at most max_distance bits
+      must have at least one band in common, so only the fingerprints sharing a band are compared, and lookups
+      take close to constant time (as long as max_distance is small compared to SIMHASH_BITS).
+      
+      Adding fingerprints is not synchronized: it must be done holding threadLock.
+      
+      :param max_distance: The maximum number of bits in which near duplicates can differ.
+      :type max_distance: integer
+  '''
+  
+  def __init__(self, max_distance):
+    self.__max_distance = max_distance
+    bands = max_distance + 1
+    self.__bands = [(SIMHASH_BITS * i // bands, (1 << (SIMHASH_BITS * (i + 1) // bands - SIMHASH_BITS * i // bands)) - 1)
+                    for i in xrange(bands)]  #(shift, mask) pairs
+    self.__tables = [{} for _ in xrange(bands)]
+  
+  def add(self, fingerprint):
+    for ((shift, mask), table) in zip(self.__bands, self.__tables):
+      table.setdefault((fingerprint >> shift) & mask, []).append(fingerprint)
+  
+  def find(self, fingerprint):
+    ''' 
+        :return: A fingerprint in the index within max_distance bits of the given one, or None if there is none.
+    '''
+    for ((shift, mask), table) in zip(self.__bands, self.__tables):
+      for candidate in table.get((fingerprint >> shift) & mask, ()):
+        if hamming_distance(candidate, fingerprint) <= self.__max_distance:
+          return candidate
+    return None
+
+
+class ResourceIndex(object):
+  ''' Answers which resources are used by the pages reachable from a given page, without walking the whole site every time.
+      
+      Pages are grouped in strongly connected components (found with an iterative version of Tarjan's algorithm, so that
+      long chains of links don't hit the recursion limit): all the pages in a component reach exactly the same pages, 
+      so the resources are collected once per component, by walking the (much smaller) graph of the components,
+      and then cached.
+      
+      :param resources: Maps the ID of each page to the (images, css, scripts) triple of sets of its resources.
+      :type resources: dict
+      
+      :param links: Maps the ID of each page to the IDs of the pages it links to.
+      :type links: dict
+  '''
+  
+  def __init__(self, resources, links):
+    self.__component = {}  #Maps page IDs to the ID of their component
+    self.__component_resources = []  #The resources of the pages in each component
+    self.__component_links = []  #The other components each component links to
+    self.__cache = {}
+    self.__find_components(resources, links)
+  
+  def resources(self, page_id):
+    ''' 
+        :param page_id: The ID of a page in the index.
+        
+        :return: The (images, css, scripts) triple of frozensets of the resources of all the pages reachable from the page.
+    '''
+    component = self.__component[page_id]
+    cached = self.__cache.get(component)
+    if cached is None:
+      images, css, scripts = set(), set(), set()
+      visited = set([component])
+      stack = [component]
+      while len(stack) > 0:
+        current = stack.pop()
+        component_images, component_css, component_scripts = self.__component_resources[current]
+        images.update(component_images)
+        css.update(component_css)
+        scripts.update(component_scripts)
+        for linked in self.__component_links[current]:
+          if not linked in visited:
+            visited.add(linked)
+            stack.append(linked)
+      cached = self.__cache[component] = (frozenset(images), frozenset(css), frozenset(scripts))
+    return cached
+  
+  def __find_components(self, resources, links):
+    ''' Tarjan's algorithm, with an explicit stack of (page, iterator over its links) pairs instead of recursion.
+        :private:
+    '''
+    order = {}  #The order in which pages are first visited
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in resources:
+      if root in order:
+        continue
+      order[root] = lowlink[root] = len(order)
+      stack.append(root)
+      on_stack.add(root)
+      work = [(root, iter(links[root]))]
+      while len(work) > 0:
+        page_id, linked_pages = work[-1]
+        for linked in linked_pages:
+          if not linked in order:
+            order[linked] = lowlink[linked] = len(order)
+            stack.append(linked)
+            on_stack.add(linked)
+            work.append((linked, iter(links[linked])))
+            break
+          elif linked in on_stack:
+            lowlink[page_id] = min(lowlink[page_id], order[linked])
+        else:
+          #All the links of page_id have been followed
+          work.pop()
+          if len(work) > 0:
+            parent = work[-1][0]
+            lowlink[parent] = min(lowlink[parent], lowlink[page_id])
+          if lowlink[page_id] == order[page_id]:
+            self.__add_component(page_id, stack, on_stack, resources, links)
+  
+  def __add_component(self, root, stack, on_stack, resources, links):
+    ''' Pops a whole component from Tarjan's stack.
+        :private:
+    '''
+    component = len(self.__component_resources)
+    members = []
+    while True:
+      page_id = stack.pop()
+      on_stack.discard(page_id)
+      self.__component[page_id] = component
+      members.append(page_id)
+      if page_id == root:
+        break
+    
+    images, css, scripts = set(), set(), set()
+    for page_id in members:
+      page_images, page_css, page_scripts = resources[page_id]
+      images.update(page_images)
+      css.update(page_css)
+      scripts.update(page_scripts)
+    self.__component_resources.append((images, css, scripts))
+    #Components are found in reverse topological order: the ones linked to have already been numbered
+    self.__component_links.append(set(self.__component[linked] for page_id in members for linked in links[page_id]) - set([component]))
+
+
+class LinkGraph(object):
+  ''' The links among the pages crawled, in compressed sparse row (CSR) form: the pages are numbered from 0 (their nodes, 
+      in the order of their page IDs), and the nodes linked by node i are targets[offsets[i]:offsets[i + 1]], 
+      so that the whole graph takes two arrays of integers, however many pages and links it has.
+      The analyses below walk the arrays with as few operations per link as possible (most of the per-link work
+      of PageRank is done by builtins), so that graphs with millions of pages are analysed in seconds.
+      
+      :param urls: The URL of each node.
+      :type urls: list
+      
+      :param page_ids: The page ID of each node.
+      :type page_ids: array
+      
+      :param offsets: The position in targets of the links of each node (one more than the nodes, the last one is the number of links).
+      :type offsets: array
+      
+      :param targets: The nodes linked by each node, one node after the other.
+      :type targets: array
+      
+      :param root: The node of the home page, if it has been crawled.
+      :type root: integer or None
+  '''
+  
+  def __init__(self, urls, page_ids, offsets, targets, root = None):
+    self.urls = urls
+    self.page_ids = page_ids
+    self.offsets = offsets
+    self.targets = targets
+    self.root = root
+    self.__nodes = None  #Maps URLs to nodes, built when first needed
+    self.__reverse = None  #The graph of the links reversed, built when first needed
+  
+  def __len__(self):
+    return len(self.urls)
+  
+  def links_count(self):
+    return len(self.targets)
+  
+  def node(self, url):
+    ''' 
+        :return: The node of the page at an URL, or None if it isn't in the graph.
+    '''
+    if self.__nodes is None:
+      self.__nodes = dict(izip(self.urls, count()))
+    return self.__nodes.get(url)
+  
+  def successors(self, node):
+    ''' 
+        :return: The nodes linked by a node.
+    '''
+    return self.targets[self.offsets[node]: self.offsets[node + 1]]
+  
+  def predecessors(self, node):
+    ''' 
+        :return: The nodes linking a node.
+    '''
+    reverse_offsets, sources = self.__reversed()
+    return sources[reverse_offsets[node]: reverse_offsets[node + 1]]
+  
+  def out_degrees(self):
+    ''' 
+        :return: The number of links from each node.
+    '''
+    return array('i', imap(sub, islice(self.offsets, 1, None), self.offsets))
+  
+  def in_degrees(self):
+    ''' 
+        :return: The number of links to each node.
+    '''
+    reverse_offsets = self.__reversed()[0]
+    return array('i', imap(sub, islice(reverse_offsets, 1, None), reverse_offsets))
+  
+  def depths(self, source = None):
+    ''' The length of the shortest path from a node to every other one (breadth-first).
+    
+        :param source: The starting node (by default, the home page).
+        :type source: integer or None
+        
+        :return: The depth of each node, -1 for the ones that can't be reached.
+    '''
+    if source is None:
+      source = self.root
+    depths = array('i', [-1]) * len(self)
+    if source is None:
+      return depths
+    offsets, targets = self.offsets, self.targets
+    depths[source] = depth = 0
+    level = [source]
+    while len(level) > 0:
+      depth += 1
+      next_level = []
+      for node in level:
+        for target in targets[offsets[node]: offsets[node + 1]]:
+          if depths[target] < 0:
+            depths[target] = depth
+            next_level.append(target)
+      level = next_level
+    return depths
+  
+  def components(self):
+    ''' The weakly connected components of the graph (pages connected by links, in either direction).
+    
+        :return: The component of each node: components are numbered from 0, in the order of their first node.
+    '''
+    offsets, targets = self.offsets, self.targets
+    reverse_offsets, sources = self.__reversed()
+    labels = array('i', [-1]) * len(self)
+    component = 0
+    for root in xrange(len(self)):
+      if labels[root] >= 0:
+        continue
+      labels[root] = component
+      stack = [root]
+      while len(stack) > 0:
+        node = stack.pop()
+        for neighbours in (targets[offsets[node]: offsets[node + 1]], sources[reverse_offsets[node]: reverse_offsets[node + 1]]):
+          for neighbour in neighbours:
+            if labels[neighbour] < 0:
+              labels[neighbour] = component
+              stack.append(neighbour)
+      component += 1
+    return labels
+  
+  def pagerank(self, damping = DEFAULT_PAGERANK_DAMPING, max_iterations = DEFAULT_PAGERANK_ITERATIONS, 
+               tolerance = DEFAULT_PAGERANK_TOLERANCE):
+    ''' The PageRank of every node, by power iteration: the rank of pages with no links is spread evenly over all the pages.
+    
+        :param damping: The probability of following a link, rather than jumping to a random page.
+        :type damping: float or DEFAULT_PAGERANK_DAMPING
+        
+        :param max_iterations: The maximum number of iterations.
+        :type max_iterations: integer or DEFAULT_PAGERANK_ITERATIONS
+        
+        :param tolerance: Iterations stop as soon as the ranks change less than this (the sum of the absolute changes).
+        :type tolerance: float or DEFAULT_PAGERANK_TOLERANCE
+        
+        :return: The rank of each node (they add up to 1).
+    '''
+    size = len(self)
+    if size == 0:
+      return array('d')
+    reverse_offsets, sources = self.__reversed()
+    out_degrees = self.out_degrees()
+    dangling = [node for (node, degree) in enumerate(out_degrees) if degree == 0]
+    shares = array('d', (damping / degree if degree > 0 else 0. for degree in out_degrees))
+    ranks = array('d', [1. / size]) * size
+    bounds = zip(reverse_offsets, islice(reverse_offsets, 1, None))
+    for _ in xrange(max_iterations):
+      #The rank each node passes along each of its links, and then the contribution of every link to its target
+      passed = array('d', imap(mul, ranks, shares))
+      contributions = map(passed.__getitem__, sources)
+      base = ((1. - damping) + damping * sum(imap(ranks.__getitem__, dangling))) / size
+      new_ranks = array('d', [base + sum(contributions[start: end]) for (start, end) in bounds])
+      change = sum(imap(abs, imap(sub, new_ranks, ranks)))
+      ranks = new_ranks
+      if change < tolerance:
+        break
+    return ranks
+  
+  def __reversed(self):
+    ''' The graph with every link reversed, in CSR form: the nodes linking node i are sources[offsets[i]:offsets[i + 1]].
+        :private:
+        
+        :return: The (offsets, sources) pair.
+    '''
+    if self.__reverse is None:
+      size = len(self)
+      offsets, targets = self.offsets, self.targets
+      reverse_offsets = array('i', [0]) * (size + 1)
+      for target in targets:
+        reverse_offsets[target + 1] += 1
+      for node in xrange(size):
+        reverse_offsets[node + 1] += reverse_offsets[node]
+      positions = array('i', reverse_offsets)
+      sources = array('i', [0]) * len(targets)
+      for node in xrange(size):
+        for target in targets[offsets[node]: offsets[node + 1]]:
+          sources[positions[target]] = node
+          positions[target] += 1
+      self.__reverse = (reverse_offsets, sources)
+    return self.__reverse
+
+
+class PolitenessFrontier(object):
+  ''' The queue of the URLs to be crawled, scheduled so that every host is crawled politely, and the most valuable URLs first.
+      
+      Each URL is queued with a priority (the lower, the sooner it is crawled; URLs with the same priority are crawled
+      in the order they were queued). URLs are kept in a heap per host, and each host has a token bucket refilled 
+      at a rate of one token every crawler_delay seconds: the hosts waiting for a token are kept in a heap ordered 
+      by the time their next token is available, and the hosts that can be crawled right away in a heap ordered 
+      by the priority of their best URL, so that get() always hands out the best URL among those that can be crawled 
+      right away: each host receives at most one request every crawler_delay seconds, while different hosts are crawled in parallel.
+      
+      It exposes the same interface as Queue.Queue (put, get, task_done, join, empty), so that it can be shared
+      by all the Crawler threads.
+      
+      :param crawler_delay: The minimum delay between two requests to the same host (0 for no delay).
+      :type crawler_delay: float or DEFAULT_CRAWLER_DELAY
+      
+      :param burst: The size of each token bucket, i.e. how many requests can be sent back to back to a host that has been idle.
+      :type burst: integer or DEFAULT_HOST_BURST
+      
+      :param memory_limit: If set, at most this number of URLs are kept in memory: the others are spilled to an SQLite
+      database on disk, and loaded back (in the order they were queued, host by host) when their host's URLs in memory run out.
+      Priorities are then only enforced among the URLs in memory.
+      :type memory_limit: integer or None
+      
+      :param spill_path: The path of the database for the spilled URLs (by default a temporary file); it is deleted by close().
+      :type spill_path: string or None
+      
+      :param budget: If set, the number of URLs handed out: once the last one has been, all the URLs still queued 
+      (and the ones queued later) are discarded, so that crawling stops as soon as the pages in progress are done.
+      :type budget: integer or None
+      
+      :param credits: If set, a budget shared with other queues: it is called before each URL is handed out, and once 
+      it returns False the URLs still queued are discarded, just like when budget has been spent.
+      :type credits: function or None
+  '''
+  
+  def __init__(self, crawler_delay = DEFAULT_CRAWLER_DELAY, burst = DEFAULT_HOST_BURST, memory_limit = None, spill_path = None,
+               budget = None, credits = None):
+    self.crawler_delay = crawler_delay
+    self.__rate = 1. / crawler_delay if crawler_delay > 0 else None   #Tokens per second
+    self.__burst = max(1, burst)
+    self.__host_queues = {}  #Maps each host with queued URLs to a heap of (priority, sequence number, URL) 
+    self.__keys = {}  #Maps each URL in memory to its current (priority, sequence number): other heap entries are stale
+    self.__sequence = count()
+    self.__buckets = {}  #Maps each host to a [tokens, last refill time] pair
+    self.__waiting_hosts = []  #Heap of (ready time, host) for the hosts waiting for a token
+    self.__ready_hosts = []  #Heap of ((priority, sequence number), host) for the hosts in __ready, by their best URL
+    self.__ready = set()  #The hosts that can be crawled right away
+    self.__size = 0
+    self.__memory_limit = max(1, memory_limit) if memory_limit is not None else None
+    self.__spill_path = spill_path
+    self.__spill_db = None
+    self.__spilled = {}  #Number of URLs on disk for each host
+    self.__in_memory = 0
+    self.__budget = max(0, budget) if budget is not None else None
+    self.__credits = credits
+    self.__stops = 0
+    self.__unfinished_tasks = 0
+    self.__lock = threading.Lock()
+    self.__not_empty = threading.Condition(self.__lock)
+    self.__all_tasks_done = threading.Condition(self.__lock)
+  
+  def put(self, url, priority = 0):
+    ''' Adds an URL to the queue of its host (or STOP_CRAWLING, that will be handed out before any URL).
+        Once the budget has been spent, URLs are ignored.
+    
+        :param url: The URL to be crawled.
+        :type url: string
+        
+        :param priority: URLs with lower priorities are handed out first.
+        :type priority: any comparable value (the same type for every URL) or 0
+    '''
+    with self.__lock:
+      if url is STOP_CRAWLING:
+        self.__unfinished_tasks += 1
+        self.__stops += 1
+        self.__not_empty.notify_all()
+        return
+      if self.__budget == 0:
+        return
+      self.__unfinished_tasks += 1
+      host = urlsplit(url)[1]
+      new_host = host not in self.__host_queues
+      if new_host:
+        self.__host_queues[host] = []
+      if self.__memory_limit is not None and (self.__in_memory >= self.__memory_limit or self.__spilled.get(host)):
+        self.__spill(host, url, priority) #Once a host has URLs on disk, the following ones must go after them
+      else:
+        self.__push(host, url, priority)
+        self.__in_memory += 1
+      self.__size += 1
+      if new_host:
+        self.__schedule(host, time())
+      self.__not_empty.notify()
+  
+  def reprioritize(self, url, priority):
+    ''' Lowers the priority of an URL already queued, f.i. because it has been found at a lower depth.
+        Nothing changes if its priority isn't lower, or if it isn't in memory (it has been handed out, or spilled to disk).
+        
+        :return: True if the priority has been lowered.
+    '''
+    with self.__lock:
+      key = self.__keys.get(url)
+      if key is None or not priority < key[0]:
+        return False
+      self.__push(urlsplit(url)[1], url, priority)  #The previous entry is now stale
+      return True
+  
+  def get(self, block = True):
+    ''' Removes and returns the best URL whose host can be crawled right away.
+    
+        :param block: If True (default) waits until such an URL is available, otherwise raises Empty.
+        :type block: boolean
+        
+        :raise Empty: If block is False and no URL can be crawled right away.
+    '''
+    with self.__not_empty:
+      while True:
+        if self.__stops > 0:
+          self.__stops -= 1
+          return STOP_CRAWLING
+        
+        now = time()
+        while len(self.__waiting_hosts) > 0 and self.__waiting_hosts[0][0] <= now:
+          self.__set_ready(heappop(self.__waiting_hosts)[1])
+        
+        while len(self.__ready_hosts) > 0:
+          key, host = heappop(self.__ready_hosts)
+          if host not in self.__ready or self.__head(host)[:2] != key:
+            continue  #Stale: the host's best URL has been handed out, or a better one has been queued since
+          if self.__credits is not None and not self.__credits():
+            self.__budget = 0
+            self.__discard()
+            if self.__unfinished_tasks <= 0:
+              self.__all_tasks_done.notify_all()
+            break
+          self.__ready.remove(host)
+          (_, _, url) = heappop(self.__host_queues[host])
+          del self.__keys[url]
+          self.__size -= 1
+          self.__in_memory -= 1
+          self.__consume_token(host, now)
+          if self.__head(host) is not None:
+            self.__schedule(host, now)
+          else:
+            del self.__host_queues[host]
+          if self.__budget is not None:
+            self.__budget -= 1
+            if self.__budget == 0:
+              self.__discard()
+          return url
+        
+        if not block:
+          raise Empty
+        timeout = self.__waiting_hosts[0][0] - now if len(self.__waiting_hosts) > 0 else None
+        self.__not_empty.wait(timeout)
+  
+  def get_nowait(self):
+    return self.get(False)
+  
+  def wait_time(self):
+    ''' 
+        :return: The number of seconds until an URL can be handed out (0 if there is one right now), 
+        or None if the queue is empty.
+    '''
+    with self.__lock:
+      if self.__stops > 0 or len(self.__ready) > 0:
+        return 0
+      elif len(self.__waiting_hosts) == 0:
+        return None
+      else:
+        return max(0, self.__waiting_hosts[0][0] - time())
+  
+  def task_done(self):
+    ''' Marks an URL previously handed out as processed (see Queue.task_done).
+    '''
+    with self.__all_tasks_done:
+      self.__unfinished_tasks -= 1
+      if self.__unfinished_tasks <= 0:
+        self.__all_tasks_done.notify_all()
+  
+  def unfinished_tasks(self):
+    ''' 
+        :return: The number of URLs put in the queue that haven't been processed yet (see task_done).
+    '''
+    with self.__lock:
+      return self.__unfinished_tasks
+  
+  def join(self):
+    ''' Blocks until every URL put in the queue has been handed out and processed.
+    '''
+    with self.__all_tasks_done:
+      while self.__unfinished_tasks > 0:
+        self.__all_tasks_done.wait()
+  
+  def empty(self):
+    with self.__lock:
+      return self.__size == 0 and self.__stops == 0
+  
+  def qsize(self):
+    with self.__lock:
+      return self.__size
+  
+  def spilled_size(self):
+    ''' 
+        :return: The number of URLs currently stored on disk.
+    '''
+    with self.__lock:
+      return self.__size - self.__in_memory
+  
+  def stop(self):
+    ''' Drops all the URLs queued, and ignores the ones put from now on, just like when the budget has been spent:
+        the URLs already handed out can still be processed.
+    '''
+    with self.__lock:
+      self.__budget = 0
+      self.__discard()
+      if self.__unfinished_tasks <= 0:
+        self.__all_tasks_done.notify_all()
+  
+  def close(self):
+    ''' Closes and deletes the database of the spilled URLs, if any; the URLs still queued on disk are lost.
+    '''
+    with self.__lock:
+      if self.__spill_db is not None:
+        self.__spill_db.close()
+        self.__spill_db = None
+        os.remove(self.__spill_path)
+        for host in self.__spilled:
+          self.__size -= self.__spilled[host]
+        self.__spilled = {}
+  
+  def __push(self, host, url, priority):
+    ''' Adds an URL to its host's heap in memory.
+        :private:
+    '''
+    key = (priority, next(self.__sequence))
+    self.__keys[url] = key
+    host_queue = self.__host_queues[host]
+    heappush(host_queue, key + (url,))
+    if host in self.__ready and host_queue[0][1] == key[1]:
+      heappush(self.__ready_hosts, (key, host))  #It's the host's new best URL
+  
+  def __head(self, host):
+    ''' Drops the stale entries at the top of a host's heap (loading its URLs on disk, if there are no more in memory).
+        :private:
+        
+        :return: The (priority, sequence number, URL) entry of the host's best URL, or None if it has no more URLs.
+    '''
+    host_queue = self.__host_queues[host]
+    while len(host_queue) > 0 and self.__keys.get(host_queue[0][2]) != host_queue[0][:2]:
+      heappop(host_queue)
+    if len(host_queue) == 0:
+      if not self.__spilled.get(host):
+        return None
+      self.__load_spilled(host)
+    return host_queue[0]
+  
+  def __schedule(self, host, now):
+    ''' Makes a host with queued URLs ready, or puts it among the hosts waiting for a token.
+        :private:
+    '''
+    ready_time = self.__ready_time(host, now)
+    if ready_time <= now:
+      self.__set_ready(host)
+    else:
+      heappush(self.__waiting_hosts, (ready_time, host))
+  
+  def __set_ready(self, host):
+    '''
+        :private:
+    '''
+    self.__ready.add(host)
+    heappush(self.__ready_hosts, (self.__head(host)[:2], host))
+  
+  def __discard(self):
+    ''' Drops all the URLs queued, once the budget has been spent: they are considered processed.
+        :private:
+    '''
+    self.__unfinished_tasks -= self.__size
+    self.__size = self.__in_memory = 0
+    self.__host_queues = {}
+    self.__keys = {}
+    self.__waiting_hosts = []
+    self.__ready_hosts = []
+    self.__ready = set()
+    if self.__spill_db is not None:
+      self.__spill_db.execute("DELETE FROM frontier")
+    self.__spilled = {}
+  
+  def __spill(self, host, url, priority):
+    ''' Stores an URL on disk, at the end of its host's queue.
+        :private:
+    '''
+    if self.__spill_db is None:
+      if self.__spill_path is None:
+        handle, self.__spill_path = mkstemp(".db", "frontier")
+        os.close(handle)
+      self.__spill_db = sqlite3.connect(self.__spill_path, check_same_thread = False, isolation_level = None)
+      self.__spill_db.execute("PRAGMA journal_mode = OFF")  #It's just scratch space
+      self.__spill_db.execute("PRAGMA synchronous = OFF")
+      self.__spill_db.execute("DROP TABLE IF EXISTS frontier")
+      self.__spill_db.execute("CREATE TABLE frontier (id INTEGER PRIMARY KEY AUTOINCREMENT, host BLOB, url BLOB, priority BLOB)")
+      self.__spill_db.execute("CREATE INDEX frontier_host ON frontier (host, id)")
+    #marshal keeps both str and unicode URLs as they are
+    self.__spill_db.execute("INSERT INTO frontier (host, url, priority) VALUES (?, ?, ?)", 
+                            (sqlite3.Binary(marshal.dumps(host)), sqlite3.Binary(marshal.dumps(url)), 
+                             sqlite3.Binary(marshal.dumps(priority))))
+    self.__spilled[host] = self.__spilled.get(host, 0) + 1
+  
+  def __load_spilled(self, host):
+    ''' Moves the oldest URLs of a host from disk back to its heap in memory 
+        (as many as the memory limit allows, but at least one).
+        :private:
+    '''
+    limit = max(1, self.__memory_limit - self.__in_memory)
+    key = sqlite3.Binary(marshal.dumps(host))
+    rows = self.__spill_db.execute("SELECT id, url, priority FROM frontier WHERE host = ? ORDER BY id LIMIT ?", (key, limit)).fetchall()
+    self.__spill_db.execute("DELETE FROM frontier WHERE host = ? AND id <= ?", (key, rows[-1][0]))
+    for (_, url, priority) in rows:
+      self.__push(host, marshal.loads(str(url)), marshal.loads(str(priority)))
+    self.__in_memory += len(rows)
+    self.__spilled[host] -= len(rows)
+  
+  def __refill(self, host, now):
+    ''' Refills the token bucket of a host for the time elapsed since its last refill.
+        :private:
+        
+        :return: The bucket, as a [tokens, last refill time] pair.
+    '''
+    bucket = self.__buckets.get(host)
+    if bucket is None:
+      bucket = self.__buckets[host] = [self.__burst, now]
+    else:
+      bucket[0] = min(self.__burst, bucket[0] + (now - bucket[1]) * self.__rate)
+      bucket[1] = now
+    return bucket
+  
+  def __ready_time(self, host, now):
+    ''' The time at which a host will have a token available.
+        :private:
+    '''
+    if self.__rate is None:
+      return now
+    tokens = self.__refill(host, now)[0]
+    return now if tokens >= 1 else now + (1 - tokens) / self.__rate
+  
+  def __consume_token(self, host, now):
+    ''' Takes a token from the bucket of a host (called only once its ready time has come).
+        :private:
+    '''
+    if self.__rate is not None:
+      self.__refill(host, now)[0] -= 1
+
+
+class ParsePool(object):
+  ''' Parses pages in a pool of worker processes, for the hybrid engine: HTMLParser holds the GIL,
+      so once parsing is the bottleneck adding Crawler threads doesn't help, while processes can use all the cores.
+      
+      Pages are sent to the workers in batches; each worker returns the compact content of its pages 
+      (see parse_pages), which is used to create the Page objects in this process.
+      
+      :param handler: A reference to the CrawlerHandler object coordinating the crawling.
+      
+      :param processes: The number of worker processes (if None, the number of cores).
+      :type processes: integer or None
+      
+      :param batch_size: The number of pages sent together to a worker.
+      :type batch_size: integer or DEFAULT_PARSE_BATCH_SIZE
+      
+      :param batch_timeout: Incomplete batches are sent anyway after this number of seconds.
+      :type batch_timeout: float or DEFAULT_PARSE_BATCH_TIMEOUT
+  '''
+  
+  def __init__(self, handler, processes = None, batch_size = DEFAULT_PARSE_BATCH_SIZE, batch_timeout = DEFAULT_PARSE_BATCH_TIMEOUT):
+    self.__handler = handler
+    self.__batch_size = max(1, int(batch_size))
+    self.__batch_timeout = batch_timeout
+    self.__batch = []
+    self.__timer = None
+    self.__lock = threading.Lock()
+    self.__pool = multiprocessing.Pool(processes)
+  
+  def parse(self, url, html):
+    ''' Queues a page to be parsed: once it has been parsed, the page is stored in the handler's site
+        and its URL is marked as done in the handler's queue.
+        
+        :param url: The URL of the page.
+        :param html: The content of the page.
+    '''
+    with self.__lock:
+      self.__batch.append((url, html))
+      if len(self.__batch) >= self.__batch_size:
+        batch = self.__take_batch()
+      else:
+        batch = None
+        if self.__timer is None:
+          self.__timer = threading.Timer(self.__batch_timeout, self.flush)
+          self.__timer.daemon = True
+          self.__timer.start()
+    if batch:
+      self.__submit(batch)
+  
+  def flush(self):
+    ''' Sends the pages queued so far to the workers, even if the batch is incomplete.
+    '''
+    with self.__lock:
+      batch = self.__take_batch()
+    if batch:
+      self.__submit(batch)
+  
+  def close(self):
+    ''' Waits for all the pages queued to be parsed, and then terminates the worker processes.
+    '''
+    self.flush()
+    self.__pool.close()
+    self.__pool.join()
+  
+  def __take_batch(self):
+    ''' Empties the current batch (must be called holding the lock).
+        :private:
+    '''
+    if self.__timer is not None:
+      self.__timer.cancel()
+      self.__timer = None
+    batch = self.__batch
+    self.__batch = []
+    return batch
+  
+  def __submit(self, batch):
+    ''' 
+        :private:
+    '''
+    self.__pool.apply_async(parse_pages, (self.__handler._page_parser, batch), callback = self.__store_pages)
+  
+  def __store_pages(self, parsed_pages):
+    ''' Creates the pages parsed by a worker (run in the pool's result handler thread).
+        :private:
+    '''
+    for (url, content, seconds) in parsed_pages:
+      self.__handler._stats.observe(STATS_PARSE, seconds)
+      try:
+        self.__handler._store_page(Page(url, self.__handler, content = content))
+      except Exception:
+        logging.exception("Error storing %s" % url)
+      finally:
+        self.__handler._queue.task_done()
+
+
+class ConcurrencyController(object):
+  ''' Adapts the number of requests in flight to what the site can sustain, with additive increase / multiplicative decrease
+      (the same way TCP adapts its window): requests are measured in rounds of as many requests as are currently allowed, 
+      and after each round one more request is allowed, unless the round had too many transient errors (see is_transient)
+      or its mean latency grew well beyond the lowest one seen, a sign that the server is queueing requests:
+      then the concurrency is halved.
+      
+      :param max_concurrency: The maximum number of requests in flight (f.i. the number of Crawler threads).
+      :type max_concurrency: integer
+      
+      :param min_concurrency: The minimum number of requests in flight, where crawling starts.
+      :type min_concurrency: integer or 1
+      
+      :param max_error_rate: See DEFAULT_AIMD_ERROR_RATE.
+      :type max_error_rate: float or DEFAULT_AIMD_ERROR_RATE
+      
+      :param latency_factor: See DEFAULT_AIMD_LATENCY_FACTOR.
+      :type latency_factor: float or DEFAULT_AIMD_LATENCY_FACTOR
+  '''
+  
+  def __init__(self, max_concurrency, min_concurrency = 1, max_error_rate = DEFAULT_AIMD_ERROR_RATE,
+               latency_factor = DEFAULT_AIMD_LATENCY_FACTOR):
+    self.__max_concurrency = max(1, max_concurrency)
+    self.__min_concurrency = max(1, min(min_concurrency, self.__max_concurrency))
+    self.__max_error_rate = max_error_rate
+    self.__latency_factor = latency_factor
+    self.limit = self.__min_concurrency
+    self.__active = 0
+    self.__slot_free = threading.Condition(threading.Lock())
+    self.__samples = 0
+    self.__errors = 0
+    self.__latency = 0.
+    self.__lowest_latency = None
+  
+  def acquire(self):
+    ''' Waits until one more request can be sent, and counts it as in flight.
+    '''
+    with self.__slot_free:
+      while self.__active >= self.limit:
+        self.__slot_free.wait()
+      self.__active += 1
+  
+  def release(self):
+    ''' Marks a request counted by acquire as over.
+    '''
+    with self.__slot_free:
+      self.__active -= 1
+      self.__slot_free.notify()
+  
+  def record(self, latency, failed):
+    ''' Measures a request, adapting the concurrency at the end of each round.
+    
+        :param latency: The seconds the request took.
+        :type latency: float
+        
+        :param failed: True if it failed for a transient reason.
+        :type failed: boolean
+        
+        :return: The number of requests allowed in flight.
+    '''
+    with self.__slot_free:
+      self.__samples += 1
+      self.__errors += 1 if failed else 0
+      self.__latency += latency
+      if self.__samples < self.limit:
+        return self.limit
+      
+      latency = self.__latency / self.__samples
+      error_rate = float(self.__errors) / self.__samples
+      self.__samples = self.__errors = 0
+      self.__latency = 0.
+      if self.__lowest_latency is None or latency < self.__lowest_latency:
+        self.__lowest_latency = latency
+      if error_rate > self.__max_error_rate or latency > self.__lowest_latency * self.__latency_factor:
+        self.limit = max(self.__min_concurrency, int(self.limit * AIMD_DECREASE_FACTOR))
+      elif self.limit < self.__max_concurrency:
+        self.limit += 1
+        self.__slot_free.notify()
+      return self.limit
+
+
+class Crawler(threading.Thread):
+  ''' A breadth-first crawler.
+      
+      Each crawler object can be run in a separate thread, and access the same synchronized PolitenessFrontier
+      to find the next pages to crawl and to enqueue the URLs of the next pages to be crawled.
+      
+      :param threadID: The ID of the thread in which the crawler is going to be run.
+      
+      :param handler: A reference to the CrawlerHandler object coordinating the crawling.
+  '''
+    
+  def __init__(self, threadID, handler):
+    self.__threadID = threadID
+    self.__handler = handler
+    threading.Thread.__init__(self)
+    
+  def run(self):
+    ''' Starts the crawler: it keeps taking URLs from the queue (waiting until one is available)
+        and crawling the resources pointed to, until it finds STOP_CRAWLING in the queue.
+    '''
+    queue = self.__handler._queue
+    stats = self.__handler._stats
+    concurrency = self.__handler._concurrency
+    while True:
+      start = time()
+      if concurrency is not None:
+        concurrency.acquire()  #Only as many threads as the site can sustain crawl at the same time
+      page_url = queue.get(True) #Wait until an element is available for removal from the queue
+      stats.observe(STATS_QUEUE_WAIT, time() - start)
+      done = True
+      try:
+        if page_url is STOP_CRAWLING:
+          logging.debug("Thread %d releasing", self.__threadID)
+          return
+        done = self.__crawl(page_url)
+      except Exception:
+        logging.exception("Thread %d failed crawling %s" % (self.__threadID, page_url))
+      finally:
+        if concurrency is not None:
+          concurrency.release()
+        if done:
+          queue.task_done()
+  
+  def __crawl(self, page_url):
+    ''' Tries to crawl the resource pointed to by an URL taken from the queue. 
+        
+        :private:
+        
+        :return: False if the page has been handed over to the handler's ParsePool, that will mark it as done once parsed.
+    '''
+    logging.debug("Thread %d crawling %s", self.__threadID, page_url)
+    parse_pool = self.__handler._parse_pool
+    if parse_pool is None:
+      self.__handler._store_page(Page(page_url, self.__handler))
+      return True
+    
+    logging.info("Crawling page: %s; time:%s\n", page_url, datetime.now())
+    try:
+      html = self.__handler._open_url(page_url)
+    except PageNotModified:
+      content = self.__handler._not_modified_content(page_url)
+      self.__handler._store_page(Page(page_url, self.__handler, content = content))
+      return True
+    except Exception:
+      logging.error("Error: can't open %s" % page_url)
+      html = None
+    if html is None or not self.__handler.check_page_by_content(html, page_url):
+      #Nothing to parse
+      self.__handler._store_page(Page(page_url, self.__handler, None, fetch = False))
+      return True
+    parse_pool.parse(page_url, html)
+    return False
+
+
+def url_partition(url, partitions):
+  ''' The worker owning an URL in a distributed crawl (see CrawlerHandler.start_distributed_crawling):
+      the same in every process, on every machine.
+      
+      :param url: The URL.
+      :type url: string
+      
+      :param partitions: The number of workers.
+      :type partitions: integer
+  '''
+  if isinstance(url, unicode):
+    url = url.encode("utf-8")
+  return (zlib.crc32(url) & 0xffffffff) % partitions
+
+
+class CoordinatorLink(object):
+  ''' The connections of a worker of a distributed crawl to its coordinator (see CrawlerHandler.start_distributed_crawling).
+  
+      On the control connection the coordinator sends the batches of URLs owned by the worker, while the worker sends
+      the URLs it finds that are owned by other workers (in one batch per owner for each page), and tells the coordinator
+      whenever it runs out of pages to crawl. On the other connection the worker's threads ask the coordinator to check 
+      the content of their pages against the pages crawled by all the workers, one request at a time.
+      
+      :param address: The address the coordinator listens on.
+      :type address: (host, port) pair
+      
+      :param authkey: The key shared with the coordinator (see multiprocessing.connection).
+      :type authkey: string or None
+  '''
+  
+  def __init__(self, address, authkey = None):
+    self.__control = Client(address, authkey = authkey)
+    self.__control.send(("control",))
+    self.index, self.partitions, self.settings = self.__control.recv()
+    self.__requests = Client(address, authkey = authkey)
+    self.__requests.send(("requests", self.index))
+    self.__outbox = {}  #Maps each worker to the URLs to be forwarded to it
+    self.__outbox_lock = threading.Lock()
+    self.__send_lock = threading.Lock()
+    self.__request_lock = threading.Lock()
+  
+  def owner(self, url):
+    return url_partition(url, self.partitions)
+  
+  def forward(self, owner, url, depth, new_link):
+    ''' Adds an URL found by this worker to the next batch for the worker owning it (see flush).
+    '''
+    with self.__outbox_lock:
+      self.__outbox.setdefault(owner, []).append((url, depth, new_link))
+  
+  def flush(self):
+    ''' Sends the URLs forwarded so far, in one batch for each worker owning them.
+    '''
+    with self.__outbox_lock:
+      outbox, self.__outbox = self.__outbox, {}
+    for (owner, batch) in outbox.iteritems():
+      self.send(("links", owner, batch))
+  
+  def send(self, message):
+    with self.__send_lock:
+      self.__control.send(message)
+  
+  def poll(self, timeout):
+    return self.__control.poll(timeout)
+  
+  def receive(self):
+    return self.__control.recv()
+  
+  def request(self, *message):
+    ''' Sends a request to the coordinator and waits for its answer.
+    '''
+    with self.__request_lock:
+      self.__requests.send(message)
+      return self.__requests.recv()
+  
+  def close(self):
+    self.__control.close()
+    self.__requests.close()
+
+
+def crawl_partition(address, authkey = None):
+  ''' Runs a worker of a distributed crawl, until its coordinator stops it (see CrawlerHandler.start_distributed_crawling):
+      the coordinator starts its local workers itself, while workers on other machines are started by calling this function.
+      
+      :param address: The address the coordinator listens on.
+      :type address: (host, port) pair
+      
+      :param authkey: The key shared with the coordinator.
+      :type authkey: string or None
+  '''
+  link = CoordinatorLink(address, authkey)
+  try:
+    CrawlerHandler(**link.settings["handler_parameters"])._crawl_partition(link)
+  finally:
+    link.close()
+
+  
+class CrawlerHandler(object):
+  ''' The main crawler, the object handling all the high-level crawling process. 
+  '''
+  
+  def __init__(self, pool_size = DEFAULT_POOL_SIZE, pool_idle_timeout = DEFAULT_POOL_IDLE_TIMEOUT,
+               chunk_size = None, max_body_size = None, parser_backend = PARSER_HTML,
+               parse_processes = None, parse_batch_size = DEFAULT_PARSE_BATCH_SIZE,
+               dedup = DEDUP_EXACT, bloom_capacity = DEFAULT_BLOOM_CAPACITY, bloom_error_rate = DEFAULT_BLOOM_ERROR_RATE,
+               frontier_memory_limit = None, frontier_spill_path = None, response_cache = None,
+               near_duplicate_threshold = None, url_cache_size = DEFAULT_URL_CACHE_SIZE, url_score = None, compression = True,
+               on_page = None, retention = RETAIN_ALL, connect_timeout = DEFAULT_CONNECT_TIMEOUT, read_timeout = DEFAULT_READ_TIMEOUT,
+               retries = DEFAULT_RETRIES, retry_backoff = DEFAULT_RETRY_BACKOFF, adaptive_concurrency = False):
+    ''' 
+        :param pool_size: The maximum number of idle keep-alive connections kept open for each host.
+        :type pool_size: integer or DEFAULT_POOL_SIZE
+        
+        :param pool_idle_timeout: Idle connections older than this number of seconds are not reused.
+        :type pool_idle_timeout: float or DEFAULT_POOL_IDLE_TIMEOUT
+        
+        :param chunk_size: If set, pages are retrieved in streaming mode: each chunk of chunk_size bytes is parsed
+        (and hashed) as soon as it arrives, instead of buffering the whole page first.
+        :type chunk_size: integer or None
+        
+        :param max_body_size: If set, the retrieval of pages larger than this number of bytes is aborted,
+        and they are treated as pages that couldn't be retrieved.
+        :type max_body_size: integer or None
+        
+        :param parser_backend: How links and resources are extracted from html: either one of the keys of PARSER_BACKENDS 
+        (PARSER_HTML, the default, uses a full HTMLParser, PARSER_REGEX a much faster regex scanner), or a PageParser subclass.
+        :type parser_backend: string, PageParser subclass or PARSER_HTML
+        
+        :param parse_processes: The number of processes parsing pages with the hybrid engine (if None, the number of cores).
+        :type parse_processes: integer or None
+        
+        :param parse_batch_size: The number of pages sent together to a parsing process with the hybrid engine.
+        :type parse_batch_size: integer or DEFAULT_PARSE_BATCH_SIZE
+        
+        :param dedup: How URLs already queued are remembered: DEDUP_EXACT interns every URL met in a UrlTable, while DEDUP_BLOOM
+        only interns the URLs queued, and checks them with a Bloom filter (saving memory on large crawls, at the cost of skipping 
+        a fraction bloom_error_rate of the URLs).
+        :type dedup: string or DEDUP_EXACT
+        
+        :param bloom_capacity: The number of URLs expected to be queued (DEDUP_BLOOM only).
+        :type bloom_capacity: integer or DEFAULT_BLOOM_CAPACITY
+        
+        :param bloom_error_rate: The rate of URLs wrongly considered already queued (DEDUP_BLOOM only).
+        :type bloom_error_rate: float or DEFAULT_BLOOM_ERROR_RATE
+        
+        :param frontier_memory_limit: If set, the maximum number of URLs to be crawled kept in memory: 
+        the others are spilled to disk (see PolitenessFrontier).
+        :type frontier_memory_limit: integer or None
+        
+        :param frontier_spill_path: The path of the database where URLs are spilled (by default, a temporary file).
+        :type frontier_spill_path: string or None
+        
+        :param response_cache: If set, every page retrieved is stored in this cache, and crawling can be replayed from it 
+        (see start_crawling).
+        :type response_cache: ResponseCache or None
+        
+        :param near_duplicate_threshold: If set, pages whose SimHash similarity (the fraction of equal bits in their fingerprints)
+        with a page already crawled is at least this value are treated as copies of that page, and their links aren't followed.
+        :type near_duplicate_threshold: float (between 0 and 1) or None
+        
+        :param url_cache_size: The number of links resolved to absolute URLs that are remembered, so that the links
+        shared by many pages (f.i. navigation and assets) are parsed only once (see UrlCache).
+        :type url_cache_size: integer or DEFAULT_URL_CACHE_SIZE
+        
+        :param url_score: URLs are crawled by depth, the shallowest first; if set, a function f(url, depth, in_links) scoring 
+        the URLs at the same depth, the highest scores first (f.i. in_links_score or pattern_score). URLs are scored when they 
+        are queued, and again each time a new link to them is found, as long as they haven't been crawled.
+        :type url_score: function or None
+        
+        :param compression: If True, pages are requested with an Accept-Encoding header (see ACCEPT_ENCODING), 
+        and decoded as they arrive: the number of bytes received and decoded are reported by stats.
+        :type compression: boolean or True
+        
+        :param on_page: If set, a function called with each Page as soon as it has been crawled (and its links queued), 
+        while crawling goes on: it's called by the Crawler threads, so it may be called by several threads at once, 
+        and it should return quickly. Copies of pages already crawled are passed too, with no links nor resources.
+        :type on_page: function or None
+        
+        :param retention: Which pages are kept once they have been crawled (and passed to on_page): RETAIN_ALL keeps them all, 
+        RETAIN_LINKS only their links (enough for page_graph), RETAIN_NONE none of them, so that memory doesn't grow 
+        with the pages crawled (only the URLs met are remembered), and pages can only be consumed by on_page or iter_crawling.
+        :type retention: string or RETAIN_ALL
+        
+        :param connect_timeout: The seconds to wait for a connection to a server (None to wait forever).
+        :type connect_timeout: float or DEFAULT_CONNECT_TIMEOUT
+        
+        :param read_timeout: The seconds a server can go silent during a request before it's abandoned (None to wait forever).
+        :type read_timeout: float or DEFAULT_READ_TIMEOUT
+        
+        :param retries: The times a request is sent again when it fails for a transient reason (see is_transient),
+        as long as no part of the page has been received yet.
+        :type retries: integer or DEFAULT_RETRIES
+        
+        :param retry_backoff: The seconds before the first retry of a request, doubled at each following one.
+        :type retry_backoff: float or DEFAULT_RETRY_BACKOFF
+        
+        :param adaptive_concurrency: If True, the number of requests in flight (the threads crawling, or the connections
+        of the async engine) is adapted to the latency and the errors of the site (see ConcurrencyController): 
+        the _threads_ parameter of start_crawling is then the maximum.
+        :type adaptive_concurrency: boolean or False
+    '''
+    self._page_ids = count()  #The IDs of the pages crawled, taken with next() (atomic)
+    self._connection_pool = ConnectionPool(pool_size, pool_idle_timeout, connect_timeout, read_timeout)
+    self._read_timeout = read_timeout
+    self.__retries = max(0, int(retries))
+    self.__retry_backoff = retry_backoff
+    self.__connect_timeout = connect_timeout
+    self.__adaptive_concurrency = adaptive_concurrency
+    self._concurrency = None  #The ConcurrencyController of the crawl in progress, if adaptive
+    self._streaming = chunk_size is not None
+    self._chunk_size = max(1, int(chunk_size)) if self._streaming else DEFAULT_CHUNK_SIZE
+    self._max_body_size = max_body_size
+    if parser_backend in PARSER_BACKENDS:
+      self._page_parser = PARSER_BACKENDS[parser_backend]
+    elif isinstance(parser_backend, type) and issubclass(parser_backend, PageParser):
+      self._page_parser = parser_backend
+    else:
+      logging.warning("Unknown parser backend %s, falling back to %s" % (parser_backend, PARSER_HTML))
+      self._page_parser = PageParser
+    self.__parse_processes = parse_processes
+    self.__parse_batch_size = parse_batch_size
+    self._parse_pool = None
+    self.__dedup = dedup
+    self.__bloom_capacity = bloom_capacity
+    self.__bloom_error_rate = bloom_error_rate
+    self.__frontier_memory_limit = frontier_memory_limit
+    self.__frontier_spill_path = frontier_spill_path
+    self.__prefetched_pages = {}
+    self.__previous_pages = {}
+    self._validators = {}  #Maps URLs to their (ETag, Last-Modified) pair
+    self._response_cache = response_cache
+    self.__replay = False
+    self.__near_duplicate_threshold = near_duplicate_threshold
+    if near_duplicate_threshold is not None:
+      self.__near_duplicate_distance = int((1. - near_duplicate_threshold) * SIMHASH_BITS)
+    else:
+      self.__near_duplicate_distance = None
+    self._near_duplicates = None
+    self.__resource_index = None  #Built by list_resources once crawling is over
+    self._stats = CrawlStats()
+    self.__url_cache_size = url_cache_size
+    self.__formatted_urls = UrlCache(url_cache_size)  #Depends on the home page: emptied when crawling starts
+    self.__joined_urls = UrlCache(url_cache_size)
+    self.__url_score = url_score
+    self._compression = compression
+    self.__partition = None  #The CoordinatorLink of a worker of a distributed crawl
+    self._on_page = on_page
+    self.__page_sink = None  #Set by iter_crawling
+    if retention not in RETENTION_POLICIES:
+      logging.warning("Unknown retention policy %s, falling back to %s" % (retention, RETAIN_ALL))
+      retention = RETAIN_ALL
+    self.__retention = retention
+    self._queue = None
+    
+
+  def check_page_by_content(self, html, url):
+    ''' Check if a page has already been visited by its content: if two different urls lead to the same identical page,
+        it will be caught here, and no further processing of the page will be 
+        :param html: The content of the page.
+        :type html: string
+        :param url: The url of the page.
+        :type url: string
+    '''
+    start = time()
+    fingerprint = SimHash(html).fingerprint() if self._near_duplicates is not None else None
+    return self.__check_page_by_hash(sha256(html).hexdigest(), url, fingerprint, start)
+  
+  def check_page_by_hash(self, page_hash, url, fingerprint = None):
+    ''' Same as check_page_by_content, for pages whose content hash has already been computed
+        (f.i. incrementally, while the page was being retrieved).
+        :param page_hash: The sha256 hex digest of the content of the page.
+        :type page_hash: string
+        :param url: The url of the page.
+        :type url: string
+        :param fingerprint: The SimHash fingerprint of the page, if near duplicates are detected.
+        :type fingerprint: integer or None
+    '''
+    return self.__check_page_by_hash(page_hash, url, fingerprint, time())
+  
+  def __check_page_by_hash(self, page_hash, url, fingerprint, start):
+    ''' See check_page_by_hash: the time elapsed since start is recorded as the time spent checking the page.
+        :private:
+    '''
+    if self.__partition is not None:
+      new_page = self.__partition.request("hash", page_hash, url, fingerprint)  #Checked against every worker's pages
+    else:
+      with threadLock:
+        new_page = self.__add_page_hash(page_hash, url, fingerprint)
+    
+    if not new_page:
+      self._stats.increment("duplicate_pages")
+    self._stats.observe(STATS_DEDUP, time() - start)
+    return new_page
+  
+  def __add_page_hash(self, page_hash, url, fingerprint):
+    ''' Must be called holding threadLock.
+        :private:
+        
+        :return: True if the page is not a copy of a page already crawled.
+    '''
+    if page_hash in self.__queued_pages_hashs:
+      self.__queued_pages_hashs[page_hash].append(url)
+      return False
+    
+    if fingerprint is not None and self._near_duplicates is not None:
+      original = self._near_duplicates.find(fingerprint)
+      if original is not None:
+        self.__near_duplicate_pages[original].append(url)
+        return False
+      self._near_duplicates.add(fingerprint)
+      self.__near_duplicate_pages[fingerprint] = [url]
+    
+    self.__queued_pages_hashs[page_hash] = [url]
+    return True
+    
+
+  def format_and_enqueue_url(self, page_url, current_path, current_depth):       
+    ''' Enqueue a url to a page to be retrieved, if it hasn't been enqueued yet
+        and if it is "valid", meaning it's in the same domain as the main page
+        (see format_url and enqueue_urls, to enqueue many URLs at once)
+        
+        :param page_url: the original URL to be enqueued
+        
+        :param current_path: the path of current page (for relative URLs)
+        
+        :param current_depth: depth of the current page (distance from the starting page)
+        
+        :return:
+          -  None <=> the URL is located in a different domain
+          -  The formatted absolute URL, otherwise
+    '''    
+    page_url = self.format_url(page_url, current_path)
+    if page_url is None:
+      return None
+    return self.enqueue_urls([page_url], current_depth)[0]
+  
+  def format_url(self, page_url, current_path):
+    ''' Turns a link into the absolute URL that is crawled (without query and fragment), 
+        if it is "valid", meaning it's in the same domain as the main page. No lock is held,
+        and links already formatted are remembered (see UrlCache).
+        
+        :param page_url: the original URL
+        
+        :param current_path: the path of current page (for relative URLs)
+        
+        :return:
+          -  None <=> the URL is located in a different domain
+          -  The formatted absolute URL, otherwise
+    '''
+    key = (resolution_base(current_path, page_url), page_url)
+    formatted_url = self.__formatted_urls.get(key)
+    if formatted_url is URL_CACHE_MISS:
+      self._stats.increment("url_cache_misses")
+      formatted_url = self.__format_url(page_url, current_path)
+      self.__formatted_urls.put(key, formatted_url)
+    else:
+      self._stats.increment("url_cache_hits")
+    return formatted_url
+  
+  def __format_url(self, page_url, current_path):
+    ''' See format_url.
+        :private:
+    '''
+    (scheme, domain, path, _, _) = urlsplit(page_url)
+    if scheme == '':
+      scheme = self.__home_scheme
+    elif scheme != self.__home_scheme and not ((scheme == "http" and self.__home_scheme == "https") or (scheme == "https" and self.__home_scheme == "http")):
+      return None
+#      elif scheme == 'https':
+#        scheme = 'http'
+    if domain == '':
+      domain = self.__home_domain
       path = urljoin(current_path, path)
     elif not domain.endswith(self.__home_domain):
       return None  
@@ -378,34 +2958,374 @@ class CrawlerHandler(object):
     #Removes trailing slash
     if page_url[-1] == "/": #pragma: no cover
       page_url = page_url[:-1]
-
-    if page_url in self._url_depth:
-        current_depth = self._url_depth[page_url] = min(self._url_depth[page_url], current_depth)
+    return page_url
+  
+  def enqueue_urls(self, urls, current_depth):
+    ''' Enqueues a batch of URLs already formatted (see format_url), all found at the same depth, 
+        taking threadLock only once: each URL is queued unless it has already been, or it's too deep.
+        
+        When an URL is found at a lower depth than before, its depth is updated (and so is its priority, if it's still queued), 
+        and if its page has already been crawled, so is the depth of the pages it links (that may now be queued, if they were too deep).
+        
+        :param urls: The formatted URLs.
+        :type urls: list
+        
+        :param current_depth: The depth at which the URLs have been found.
+        :type current_depth: integer
+        
+        :return: The list of the URLs, in the same order, sharing the same string with every other link to them.
+    '''
+    if len(urls) == 0:
+      return []
+    start = time()
+    relaxed_pages = []
+    with threadLock:
+      urls = [self.__admit_url(page_url, current_depth, relaxed_pages, current_depth > 0) for page_url in urls]  #The home page is not a link
+      self.__relax_depths(relaxed_pages)
+    if self.__partition is not None:
+      self.__partition.flush()
+    self._stats.observe(STATS_ENQUEUE, time() - start)
+    return urls
+  
+  def __admit_url(self, page_url, current_depth, relaxed_pages, new_link):
+    ''' Enqueues an URL (see enqueue_urls): must be called holding threadLock.
+        :private:
+        
+        :param relaxed_pages: The pages already crawled whose URL is found at a lower depth are appended here.
+        :type relaxed_pages: list
+        
+        :param new_link: False if the link has already been counted among the links to the URL.
+        :type new_link: boolean
+        
+        :return: The interned URL, if it is in the url table.
+    '''
+    if self.__partition is not None:
+      owner = self.__partition.owner(page_url)
+      if owner != self.__partition.index:
+        self.__partition.forward(owner, page_url, current_depth, new_link)  #Admitted by the worker owning it
+        self._stats.increment("urls_forwarded")
+        return page_url
+    
+    url_id = self._url_table.get_id(page_url)
+    rescore = False
+    if url_id is not None:
+      if current_depth < self._url_table.depth(page_url):
+        self._url_table.add(page_url, current_depth)
+        page = self._site.get(self._url_table.page_id(page_url))
+        if page is not None:  #Pages not retained can't be relaxed
+          relaxed_pages.append(page)
+        rescore = True
+      current_depth = self._url_table.depth(page_url)
+    elif self.__bloom_filter is None:
+      url_id = self._url_table.add(page_url, current_depth)
+    if new_link and url_id is not None:
+      self._url_table.add_in_link(url_id)
+      rescore = rescore or self.__url_score is not None
+    
+    if self.__bloom_filter is None:
+      queued = self._url_table.is_queued(url_id)
     else:
-        self._url_depth[page_url] = current_depth
-
-    # Get lock to synchronize threads
-    threadLock.acquire(True) 
+      #Only URLs actually queued are interned 
+      queued = page_url in self.__bloom_filter
+        
+    if (page_url != '' and
+        (self._max_page_depth is None or current_depth <= self._max_page_depth) and
+        not queued):           
+      
+      if self.__bloom_filter is not None:
+        self.__bloom_filter.add(page_url)
+        url_id = self._url_table.add(page_url, current_depth)
+        if new_link:
+          self._url_table.add_in_link(url_id)
+      self._url_table.set_queued(url_id)    #marks the url as visited
+      page_url = self._url_table.url(url_id)
+      self._queue.put(page_url, self.__priority(url_id, current_depth)) #Common access to the containing class queue  for all Crawler instances
+      self._stats.increment("urls_enqueued")
+    elif url_id is not None:
+      page_url = self._url_table.url(url_id) #Shares the same string for every link to this URL
+      if rescore and queued:
+        self._queue.reprioritize(page_url, self.__priority(url_id, current_depth))  #Unless it has already been handed out
+    return page_url
+  
+  def __priority(self, url_id, depth):
+    ''' The priority of an URL in the queue: its depth, and then its score (see url_score in the constructor).
+        :private:
+    '''
+    if self.__url_score is None:
+      return depth
+    return (depth, -self.__url_score(self._url_table.url(url_id), depth, self._url_table.in_links(url_id)))
+  
+  def __relax_depths(self, pages):
+    ''' Lowers the depth of the pages already crawled whose URL has been found at a lower depth (after they had been crawled,
+        which can happen when many threads crawl the site), and then of all the pages they link, 
+        so that every depth is still the distance from the home page: must be called holding threadLock.
+        :private:
+        
+        :param pages: The pages to be checked (emptied).
+        :type pages: list
+    '''
+    while len(pages) > 0:
+      page = pages.pop()
+      depth = self._url_table.depth(page._url)
+      if depth < page._depth:
+        page._depth = depth
+        for link_url in page._links:
+          self.__admit_url(link_url, depth + 1, pages, False)
+  
+  def _open_url(self, url):
+    ''' Retrieves the content of a page (see _iter_url).
+        
+        :param url: The URL of the page.
+        :type url: string
+        
+        :return: The content of the page.
+        
+        :raise URLError: If the page can't be retrieved.
+    '''
+    return "".join(self._iter_url(url))
+  
+  def _iter_url(self, url):
+    ''' Retrieves the content of a page in chunks of at most _chunk_size bytes: pages on POOLED_SCHEMES 
+        go through the shared keep-alive connection pool, while any other URL (f.i. file://) is opened with urlopen.
+        
+        :param url: The URL of the page.
+        :type url: string
+        
+        :return: A generator of the chunks of the page.
+        
+        :raise URLError: If the page can't be retrieved, or if it is larger than _max_body_size.
+    '''
+    html = self.__prefetched_pages.pop(url, None)
+    if isinstance(html, PageNotModified):
+      raise html
+    
+    #Only the time spent retrieving chunks is measured, not the time the caller spends on each one
+    #(pages already retrieved, f.i. the home page, were measured the first time)
+    fetch_time = 0.
+    sizes = [0, 0]  #Bytes received and decoded
+    networked = html is None and not self.__replay and urlsplit(url)[0] in POOLED_SCHEMES
+    concurrency = self._concurrency if networked else None
+    attempt = 0
+    try:
+      while True:
+        start = time()
+        attempt_start_time = fetch_time
+        received = False
+        try:
+          for chunk in self.__iter_chunks(url, html, sizes):
+            fetch_time += time() - start
+            received = True
+            yield chunk
+            start = time()
+          fetch_time += time() - start
+        except PageNotModified:
+          raise
+        except Exception as e:
+          fetch_time += time() - start
+          transient = networked and is_transient(e)
+          if concurrency is not None:
+            concurrency.record(fetch_time - attempt_start_time, transient)
+          if isinstance(e, URLError) and isinstance(e.reason, socket.timeout):
+            self._stats.increment("timeouts")
+          if not transient or received or attempt >= self.__retries:
+            raise
+          #Nothing has been handed to the caller yet: the request can be sent again
+          headers = getattr(e, "hdrs", None)
+          delay = self.__retry_delay(attempt, headers.get("retry-after") if headers is not None else None)
+          if delay is None:
+            raise
+          sleep(delay)
+          attempt += 1
+          self._stats.increment("retries")
+          continue
+        if concurrency is not None:
+          concurrency.record(fetch_time - attempt_start_time, False)
+        break
+    except PageNotModified:
+      raise
+    except Exception:
+      self._stats.increment("fetch_errors")
+      raise
+    finally:
+      if html is None:
+        self._stats.observe(STATS_FETCH, fetch_time)
+        self._stats.increment("bytes_fetched", sizes[0])
+        self._stats.increment("bytes_decoded", sizes[1])
+  
+  def __retry_delay(self, attempt, retry_after):
+    ''' 
+        :private:
+        
+        :param attempt: The number of retries already sent for a request.
+        :type attempt: integer
+        
+        :param retry_after: The Retry-After header of the response, if any (see parse_retry_after).
+        :type retry_after: string or None
+        
+        :return: The seconds to wait before sending the request again: the backoff, but never less than the delay
+        between two requests to the same host, nor than the server asked for; None if the server asked for more than
+        MAX_RETRY_AFTER seconds.
+    '''
+    wait = parse_retry_after(retry_after)
+    if wait > MAX_RETRY_AFTER:
+      return None
+    return max(self.__retry_backoff * 2 ** attempt, self._queue.crawler_delay, wait)
+  
+  def __iter_chunks(self, url, html, sizes):
+    ''' See _iter_url.
+        :private:
+        
+        :param html: The content of the page, if it has already been retrieved.
+        
+        :param sizes: A [bytes received, bytes decoded] pair, updated as chunks arrive (see decode_chunks).
+    '''
+    response_headers = None
+    cached_chunks = None  #The chunks to be stored in the response cache
+    if self.__replay:
+      html = self._response_cache.get(url)
+      if html is None:
+        raise URLError("Not in the response cache: %s" % url)
+      chunks = (html[i: i + self._chunk_size] for i in xrange(0, len(html), self._chunk_size))
+    elif html is not None:
+      chunks = (html[i: i + self._chunk_size] for i in xrange(0, len(html), self._chunk_size))
+    elif urlsplit(url)[0] in POOLED_SCHEMES:
+      response_headers = {}
+      chunks = self._connection_pool.iter_content(url, self._chunk_size, self._request_headers(url), response_headers)
+    else:
+      page = urlopen(url, timeout = self._read_timeout)
+      chunks = iter(lambda: page.read(self._chunk_size), "")
+    #Pages are hashed, parsed, cached and limited to _max_body_size once decoded
+    chunks = decode_chunks(chunks, response_headers if response_headers is not None else {}, sizes, self._chunk_size)
+    if self._response_cache is not None and html is None:
+      cached_chunks = []
+    
+    try:
+      for chunk in chunks:
+        if self._max_body_size is not None and sizes[1] > self._max_body_size:
+          chunks.close()
+          raise URLError("Page larger than %d bytes: %s" % (self._max_body_size, url))
+        if cached_chunks is not None:
+          cached_chunks.append(chunk)
+        yield chunk
+    except HTTPError as e:
+      if e.code == 304 and url in self.__previous_pages:
+        raise PageNotModified("Not modified since the previous crawl: %s" % url)
+      raise
+    
+    if response_headers is not None:
+      self._store_validators(url, response_headers)
+    if cached_chunks is not None:
+      self._response_cache.put(url, "".join(cached_chunks))
+  
+  def __decode_body(self, url, body, headers):
+    ''' Decodes the body of a page retrieved by an AsyncFetcher, slice by slice so that _max_body_size is enforced 
+        on the decoded body without ever decoding much more than it.
+        :private:
+        
+        :param headers: The headers of the response, with lowercase names.
+        :type headers: dict
+        
+        :return: The decoded body, or None if it can't be decoded or it is too large.
+    '''
+    sizes = [0, 0]
+    chunks = []
+    try:
+      for chunk in decode_chunks((body[i: i + ASYNC_CHUNK_SIZE] for i in xrange(0, len(body), ASYNC_CHUNK_SIZE)), headers, sizes,
+                                 ASYNC_CHUNK_SIZE):
+        if self._max_body_size is not None and sizes[1] > self._max_body_size:
+          raise URLError("Page larger than %d bytes: %s" % (self._max_body_size, url))
+        chunks.append(chunk)
+    except URLError as e:
+      logging.error("Error: can't open %s: %s", url, e)
+      return None
+    finally:
+      self._stats.increment("bytes_fetched", sizes[0])
+      self._stats.increment("bytes_decoded", sizes[1])
+    return "".join(chunks)
+  
+  def _request_headers(self, url):
+    ''' 
+        :return: The headers to be sent with the request for an URL: the conditional ones (see _conditional_headers),
+        and Accept-Encoding if compression is enabled (see CrawlerHandler constructor).
+    '''
+    headers = self._conditional_headers(url)
+    if self._compression:
+      headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return headers
+  
+  def _conditional_headers(self, url):
+    ''' 
+        :return: The headers that make the request for an URL conditional on the version retrieved by the 
+        previous crawl (see start_crawling), if any.
+    '''
+    headers = {}
+    previous_page = self.__previous_pages.get(url)
+    if previous_page is not None:
+      etag, last_modified = previous_page[2]
+      if etag is not None:
+        headers["If-None-Match"] = etag
+      if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+  
+  def _store_validators(self, url, response_headers):
+    ''' Keeps the ETag and Last-Modified headers of a page just retrieved, so that it can be requested
+        with a conditional GET when crawling again (they are saved by checkpoint).
         
-    if (page_url != '' and
-        (self.__max_pages_to_crawl is None or len(self.__queued_pages_urls) < self.__max_pages_to_crawl) and
-        (self._max_page_depth is None or current_depth <= self._max_page_depth) and
-        not page_url in self.__queued_pages_urls):           
-      
-      self._queue.put(page_url) #Common access to the containing class queue  for all Crawler instances
-      self.__queued_pages_urls[page_url] = True    #marks the url as visited
-      
-      # Free lock to release next thread
-      threadLock.release()  
-      
-      return page_url
+        :param response_headers: The headers of the response, with lowercase names.
+        :type response_headers: dict
+    '''
+    validators = (response_headers.get("etag"), response_headers.get("last-modified"))
+    if validators != (None, None):
+      with threadLock:
+        self._validators[url] = validators
+  
+  def _not_modified_content(self, url):
+    ''' The content of a page that hasn't changed since the previous crawl, that can be reused without parsing it again.
+        Its content hash is checked just like for the pages retrieved (see check_page_by_hash).
+        
+        :return: The content (see PageContent._pack_content), empty if the page is a duplicate.
+    '''
+    content, page_hash, validators = self.__previous_pages[url]
+    self._stats.increment("not_modified_pages")
+    with threadLock:
+      self._validators[url] = validators
+    if page_hash is None or self.check_page_by_hash(page_hash, url):
+      return content
     else:
-      # Free lock to release next thread
-      threadLock.release()
+      return PageContent()._pack_content()
+    
+  def _store_page(self, page, restored = False):
+    ''' Adds a page that has been crawled to the site (as far as the retention policy allows), and hands it to on_page.
+    
+        :param page: The page just crawled.
+        :type page: Page
         
-    return page_url
-              
-  def start_crawling(self, url, threads = 1, max_page_depth = None, max_pages_to_crawl = None, crawler_delay = DEFAULT_CRAWLER_DELAY):
+        :param restored: True if the page has been restored from a checkpoint: it has already been handed to on_page.
+        :type restored: boolean
+    '''
+    with threadLock:
+      if self.__retention != RETAIN_NONE:
+        self._site[page.page_ID] = page
+      self._url_table.set_page_id(page._url, page.page_ID)
+      self.__resource_index = None
+      self.__relax_depths([page])  #Its URL may have been found at a lower depth while it was being crawled
+    if self.__partition is not None:
+      self.__partition.flush()
+    self._stats.increment("pages_crawled")
+    
+    if not restored:
+      if self._on_page is not None:
+        self._on_page(page)
+      page_sink = self.__page_sink
+      if page_sink is not None:
+        page_sink(page)
+    if self.__retention == RETAIN_LINKS:
+      page._css_urls = page._script_urls = page._img_urls = page._videos = page._audios = ()
+    
+  def start_crawling(self, url, threads = 1, max_page_depth = None, max_pages_to_crawl = None, crawler_delay = DEFAULT_CRAWLER_DELAY,
+                     engine = ENGINE_THREADS, checkpoint_path = None, checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL,
+                     previous_crawl = None, replay = False):
     ''' Starts crawling a website beginning from an URL. 
         Only pages within the same domain will considered for crawling, while pages outside it will be listed among the references of the single pages.
         
@@ -420,24 +3340,72 @@ class CrawlerHandler(object):
         :type max_page_depth: integer or None
         
         :param max_pages_to_crawl: The maximum number of pages to retrieve during crawling (if omitted, crawling will stop only  
-        when all the pages of the same domain reachable from the starting one will be crawled).
+        when all the pages of the same domain reachable from the starting one will be crawled). The pages are retrieved
+        shallowest first (and by score, see url_score in the constructor), and crawling stops as soon as the last one is retrieved.
         :type max_pages_to_crawl: integer or None
         
-        :param crawler_delay: To allow for polite crawling, a minimum delay between two page requests can be set (by default, 1.5 sec.s)  
+        :param crawler_delay: To allow for polite crawling, a minimum delay between two page requests to the same host can be set (by default, 1.5 sec.s)  
         :type crawler_delay: float or DEFAULT_CRAWLER_DELAY
+        
+        :param engine: How pages are retrieved: ENGINE_THREADS runs _threads_ Crawler threads, each blocking on one request at a time,
+        ENGINE_ASYNC keeps up to _threads_ requests in flight on a single event loop, and ENGINE_HYBRID runs _threads_ Crawler threads
+        that only retrieve pages, parsed by a pool of processes (see CrawlerHandler constructor). If omitted or invalid, ENGINE_THREADS is used.
+        :type engine: string or ENGINE_THREADS
+        
+        :param checkpoint_path: If set, the state of the crawling is saved to this file every _checkpoint_interval_ seconds,
+        and once crawling is over, so that it can be continued with resume_crawling (see checkpoint).
+        :type checkpoint_path: string or None
+        
+        :param checkpoint_interval: The number of seconds between two checkpoints.
+        :type checkpoint_interval: float or DEFAULT_CHECKPOINT_INTERVAL
+        
+        :param previous_crawl: The checkpoint of a previous crawl of the same site: pages are requested with conditional GETs
+        (If-None-Match/If-Modified-Since), and those that haven't changed reuse the links and resources found the previous time,
+        without being parsed again.
+        :type previous_crawl: string or None
+        
+        :param replay: If True, pages are read from the handler's response cache (see CrawlerHandler constructor) instead of 
+        being retrieved, without any network I/O: pages not in the cache are treated as pages that couldn't be retrieved.
+        :type replay: boolean
     '''
+    self._stats = threadLock.stats = CrawlStats()  #Only one site can be crawled at the same time
+    self.__formatted_urls = UrlCache(self.__url_cache_size)
+    self.__replay = replay and self._response_cache is not None
+    self._validators = {}
+    self.__previous_pages = self.__load_previous_crawl(previous_crawl)
 
-    #verify that the url provided is indeed reachable
+    #verify that the url provided is indeed reachable (its content is kept, so it won't be retrieved twice)
+    self.__prefetched_pages = {}
     try:
-      urlopen(url)
+      home_html = self._open_url(url)
+    except PageNotModified as not_modified:
+      home_html = not_modified  #Raised again when the home page is crawled
     except (URLError, Exception):
       self.__home_page_url = None
       return None
 
-    self._last_crawl_time = 0
-    self._queue = Queue()
-    self.__queued_pages_urls = {}  #Keeps track of the url pages already crawled, to avoid deadlock and endless circles
+    self.__init_crawl_state(url, max_page_depth, max_pages_to_crawl, crawler_delay)
+    self.__home_page_url = self.format_and_enqueue_url(url, '', 0)
+    if self.__home_page_url is not None:
+      self.__prefetched_pages[self.__home_page_url] = home_html  #Crawled under its formatted URL
+  
+    self.__run(threads, engine, checkpoint_path, checkpoint_interval)
+    return self.__home_page_url
+  
+  def __init_crawl_state(self, url, max_page_depth, max_pages_to_crawl, crawler_delay, credits = None):
+    ''' Resets the state of the crawling (url table, queue, site, dedup), before crawling a site from its home page.
+        :private:
+        
+        See start_crawling for the parameters, and PolitenessFrontier for credits.
+    '''
+    if self.__dedup == DEDUP_BLOOM:
+      self.__bloom_filter = BloomFilter(self.__bloom_capacity, self.__bloom_error_rate)
+    else:
+      self.__bloom_filter = None
     self.__queued_pages_hashs = {}  #Keeps track of the pages already crawled, by hashing their content
+    self.__near_duplicate_pages = {}  #Groups near duplicates by the fingerprint of the first one found
+    if self.__near_duplicate_distance is not None:
+      self._near_duplicates = NearDuplicateIndex(self.__near_duplicate_distance)
     
     try:
         max_page_depth = int(max_page_depth) 
@@ -450,12 +3418,13 @@ class CrawlerHandler(object):
     except TypeError:
         self.__max_pages_to_crawl = None
         
-    self._crawler_delay = crawler_delay
-    self._page_index = 0
+    self._page_ids = count()
     self._site = {}   #Map pages' ID to the real objects
-    self._url_to_page_id = {} #Map URLs to page IDs  
-    self._url_depth = {} #Depth level fpr a given url
-    self._queue = Queue()
+    self.__resource_index = None
+    self._url_table = UrlTable() #Depth level and page ID for every URL
+    self._queue = PolitenessFrontier(crawler_delay, memory_limit = self.__frontier_memory_limit,
+                                     spill_path = self.__frontier_spill_path, budget = self.__max_pages_to_crawl,
+                                     credits = credits)
     
     (self.__home_scheme, self.__home_domain, _, _ , _) = urlsplit(url)
  
@@ -463,9 +3432,625 @@ class CrawlerHandler(object):
 #    if home_scheme == 'https':
 #      home_scheme = 'http'
 
-    self.__home_page_url = self.format_and_enqueue_url(url, '', 0)
+  def iter_crawling(self, url, *args, **kwargs):
+    ''' Same as start_crawling (with the same parameters), but crawling goes on in the background, while the pages are yielded
+        as soon as they have been crawled (see on_page in the constructor), so that they can be processed meanwhile.
+        If the caller stops iterating, crawling is stopped (see stop_crawling).
+        
+        :param buffer_size: The number of pages crawled that can wait to be yielded: once it's full, the Crawler threads 
+        wait for the caller to take them (keyword only).
+        :type buffer_size: integer or DEFAULT_PAGE_BUFFER_SIZE
+        
+        :return: A generator of the pages crawled (see Page): its return value is lost, but the home page is available from
+        page_graph (if pages are retained).
+    '''
+    pages = Queue(max(1, kwargs.pop("buffer_size", DEFAULT_PAGE_BUFFER_SIZE)))
+    
+    def crawl():
+      try:
+        self.start_crawling(url, *args, **kwargs)
+      finally:
+        self.__page_sink = None
+        pages.put(None)
+    
+    self.__page_sink = pages.put
+    crawling = threading.Thread(target = crawl)
+    crawling.daemon = True
+    crawling.start()
+    try:
+      for page in iter(pages.get, None):
+        yield page
+    finally:
+      self.__page_sink = None
+      while crawling.is_alive():
+        self.stop_crawling()  #Again, until the new queue has been created, if crawling has just started
+        try:
+          pages.get(timeout = ASYNC_LOOP_TIMEOUT)  #Frees the Crawler threads waiting for room
+        except Empty:
+          pass
+      crawling.join()
+  
+  def stop_crawling(self):
+    ''' Stops the crawling in progress (f.i. from on_page): no other page is retrieved, but the ones being retrieved 
+        are still crawled, and start_crawling returns as soon as they are done.
+    '''
+    queue = self._queue
+    if queue is not None:
+      queue.stop()
+  
+  def page_node(self, page):
+    ''' The node of a page in the graph of the website (see page_graph): f.i. to process the pages passed to on_page.
+    
+        :param page: A page crawled.
+        :type page: Page
+    '''
+    return self.__graph_node(page, page._url)
+  
+  def checkpoint(self, path):
+    ''' Saves the state of the crawling to a file, from which it can be continued with resume_crawling.
+        It can be called while crawling: only the pages completely crawled are saved, while the URLs queued 
+        (or in the middle of being crawled) will be crawled again once resumed.
+        
+        :param path: The file to be written (it's replaced atomically, so a crash can't leave it half written).
+        :type path: string
+    '''
+    with threadLock:
+      table = self._url_table
+      urls = [(url, table.depth(url), table.is_queued(url_id)) for (url_id, url) in enumerate(table)]
+      pages = sorted(self._site.items())
+      dropped_pages = []
+      if self.__retention == RETAIN_NONE:
+        dropped_pages = [url for url in table if table.page_id(url) is not None]
+      page_hashes = dict((page_hash, list(page_urls)) for (page_hash, page_urls) in self.__queued_pages_hashs.iteritems())
+      validators = dict(self._validators)
+      near_duplicate_pages = dict((fingerprint, list(page_urls)) 
+                                  for (fingerprint, page_urls) in self.__near_duplicate_pages.iteritems())
+      bloom_filter = cPickle.dumps(self.__bloom_filter, cPickle.HIGHEST_PROTOCOL)
+    
+    crawled = set(page._url for (_, page) in pages)
+    crawled.update(dropped_pages)
+    pending_originals = True
+    while pending_originals:
+      pending_originals = False
+      for groups in (page_hashes, near_duplicate_pages):
+        for (key, page_urls) in groups.items():
+          if page_urls[0] not in crawled:
+            #The original page is still being crawled: its copies will be crawled again as well
+            del groups[key]
+            crawled.difference_update(page_urls)
+            pending_originals = True
+    for groups in (page_hashes, near_duplicate_pages):
+      for (key, page_urls) in groups.items():
+        groups[key] = [page_url for page_url in page_urls if page_url in crawled]
+    
+    state = {"version": CHECKPOINT_VERSION,
+             "home_page_url": self.__home_page_url,
+             "home_scheme": self.__home_scheme,
+             "home_domain": self.__home_domain,
+             "max_page_depth": self._max_page_depth,
+             "max_pages_to_crawl": self.__max_pages_to_crawl,
+             "urls": urls,
+             "pages": [(page._url, page._pack_content()) for (_, page) in pages if page._url in crawled],
+             "dropped_pages": [url for url in dropped_pages if url in crawled],
+             "page_hashes": page_hashes,
+             "near_duplicate_pages": near_duplicate_pages,
+             "validators": dict((url, validators[url]) for url in crawled if url in validators),
+             "bloom_filter": bloom_filter}
+    
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as checkpoint_file:
+      cPickle.dump(state, checkpoint_file, cPickle.HIGHEST_PROTOCOL)
+    try:
+      os.rename(temp_path, path)
+    except OSError: #pragma: no cover
+      #On Windows rename doesn't replace existing files
+      os.remove(path)
+      os.rename(temp_path, path)
+  
+  def resume_crawling(self, checkpoint, threads = 1, crawler_delay = DEFAULT_CRAWLER_DELAY, engine = ENGINE_THREADS,
+                      checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL):
+    ''' Continues a crawling from the state saved by checkpoint: the pages already crawled are restored without
+        being retrieved again, and only the remaining URLs are crawled. New checkpoints are saved to the same file.
+        
+        :param checkpoint: The path of the checkpoint file.
+        :type checkpoint: string
+        
+        See start_crawling for the other parameters.
+        
+        :return: The URL of the home page, or None if the checkpoint can't be read.
+    '''
+    try:
+      state = self.__read_checkpoint(checkpoint)
+    except Exception:
+      logging.exception("Can't resume crawling from %s" % checkpoint)
+      return None
+    
+    self.__prefetched_pages = {}
+    self.__previous_pages = {}
+    self.__replay = False
+    self.__formatted_urls = UrlCache(self.__url_cache_size)
+    self._validators = state["validators"]
+    self.__home_page_url = state["home_page_url"]
+    self.__home_scheme = state["home_scheme"]
+    self.__home_domain = state["home_domain"]
+    self._max_page_depth = state["max_page_depth"]
+    self.__max_pages_to_crawl = state["max_pages_to_crawl"]
+    self.__bloom_filter = cPickle.loads(state["bloom_filter"])
+    self.__queued_pages_hashs = state["page_hashes"]
+    self.__near_duplicate_pages = state["near_duplicate_pages"]
+    if self.__near_duplicate_distance is not None:
+      self._near_duplicates = NearDuplicateIndex(self.__near_duplicate_distance)
+      for fingerprint in self.__near_duplicate_pages:
+        self._near_duplicates.add(fingerprint)
+    budget = None
+    if self.__max_pages_to_crawl is not None:
+      #The pages restored are part of the budget, and so are the ones not retained
+      budget = self.__max_pages_to_crawl - len(state["pages"]) - len(state.get("dropped_pages", ()))
+    self._queue = PolitenessFrontier(crawler_delay, memory_limit = self.__frontier_memory_limit,
+                                     spill_path = self.__frontier_spill_path, budget = budget)
+    
+    self._url_table = UrlTable()
+    for (url, depth, queued) in state["urls"]:
+      url_id = self._url_table.add(url, depth)
+      if queued:
+        self._url_table.set_queued(url_id)
+    
+    #Pages are restored from their content, without retrieving them: their links are all already queued
+    self._page_ids = count()
+    self._site = {}
+    self.__resource_index = None
+    for (url, content) in state["pages"]:
+      self._store_page(Page(self._url_table.url(self._url_table.get_id(url)), self, content = content), restored = True)
+    for url in state.get("dropped_pages", ()):
+      self._url_table.set_page_id(url, next(self._page_ids))  #Crawled, but not retained
+    del state
+    
+    for (url_id, url) in enumerate(self._url_table):
+      if self._url_table.is_queued(url_id) and self._url_table.page_id(url) is None:
+        self._queue.put(url, self.__priority(url_id, self._url_table.depth(url)))
+    
+    self._stats = threadLock.stats = CrawlStats()  #Only the pages crawled after resuming are measured
+    self.__run(threads, engine, checkpoint, checkpoint_interval)
+    return self.__home_page_url
+  
+  def start_distributed_crawling(self, url, workers = 2, threads = 1, max_page_depth = None, max_pages_to_crawl = None,
+                                 crawler_delay = DEFAULT_CRAWLER_DELAY, engine = ENGINE_THREADS, address = ("localhost", 0),
+                                 authkey = None, local_workers = None, worker_parameters = None, workers_timeout = DEFAULT_WORKERS_TIMEOUT):
+    ''' Crawls a website with several worker processes, on this machine or on several ones: each worker owns 
+        a partition of the URLs (see url_partition), and it's the only one that queues, crawls and stores them.
+        The URLs found by a worker that are owned by other workers are forwarded to them in batches, through this
+        handler, which acts as the coordinator: it also checks the content of every page against the pages crawled 
+        by all the workers, detects when all of them are done, and finally merges their pages into its own site, 
+        so that page_graph, list_resources and the other methods see the whole site, just like after start_crawling.
+        
+        :param url: The starting point for the crawling.
+        :type url: string
+        
+        :param workers: The number of worker processes.
+        :type workers: integer or 2
+        
+        :param threads: The number of Crawler threads run by each worker.
+        :type threads: integer or 1
+        
+        :param max_page_depth: See start_crawling.
+        
+        :param max_pages_to_crawl: The maximum number of pages to retrieve, by all the workers together: the coordinator
+        keeps the count, and workers ask it for a page before retrieving each one.
+        :type max_pages_to_crawl: integer or None
+        
+        :param crawler_delay: The minimum delay between two page requests to the same host, across all the workers
+        (every worker keeps its own requests crawler_delay * workers seconds apart).
+        :type crawler_delay: float or DEFAULT_CRAWLER_DELAY
+        
+        :param engine: ENGINE_THREADS or ENGINE_HYBRID (ENGINE_ASYNC is not supported by workers, which use ENGINE_THREADS instead).
+        :type engine: string or ENGINE_THREADS
+        
+        :param address: The address the coordinator listens on for its workers (by default, a free port on localhost).
+        :type address: (host, port) pair
+        
+        :param authkey: The key the workers must use to connect (by default a random one, known only to the local workers).
+        :type authkey: string or None
+        
+        :param local_workers: The number of workers started on this machine (by default all of them): the others must be
+        started on other machines, by calling crawl_partition with the same address and authkey.
+        :type local_workers: integer or None
+        
+        :param worker_parameters: The parameters of the CrawlerHandler of each worker (it must be possible to pickle them);
+        near_duplicate_threshold is taken from this handler.
+        :type worker_parameters: dict or None
+        
+        :param workers_timeout: The number of seconds to wait for all the workers to connect: the crawl fails if they 
+        don't, or if a local worker exits before connecting.
+        :type workers_timeout: float or DEFAULT_WORKERS_TIMEOUT
+        
+        :return: The URL of the home page, or None if it can't be retrieved or a worker fails.
+    '''
+    self._stats = threadLock.stats = CrawlStats()
+    self.__formatted_urls = UrlCache(self.__url_cache_size)
+    self.__replay = False
+    self._validators = {}
+    self.__previous_pages = {}
+    self.__prefetched_pages = {}
+    try:
+      self._open_url(url)  #Just verifies that the home page is reachable
+    except Exception:
+      self.__home_page_url = None
+      return None
+    
+    workers = max(1, int(workers))
+    self.__init_crawl_state(url, max_page_depth, max_pages_to_crawl, crawler_delay)
+    self.__home_page_url = self.format_url(url, '')
+    if self.__home_page_url is None:
+      return None
+    
+    if engine == ENGINE_ASYNC:
+      logging.warning("Workers can't use engine %s, falling back to %s" % (engine, ENGINE_THREADS))
+      engine = ENGINE_THREADS
+    handler_parameters = {"near_duplicate_threshold": self.__near_duplicate_threshold}
+    handler_parameters.update(worker_parameters or {})
+    settings = [{"url": url, "threads": max(1, int(threads)), "max_page_depth": self._max_page_depth,
+                 "capped": self.__max_pages_to_crawl is not None, "crawler_delay": crawler_delay * workers, "engine": engine,
+                 "handler_parameters": handler_parameters} for _ in xrange(workers)]
+    
+    if authkey is None:
+      authkey = os.urandom(16)
+    listener = Listener(address, authkey = authkey)
+    processes = []
+    try:
+      for _ in xrange(workers if local_workers is None else min(workers, local_workers)):
+        process = multiprocessing.Process(target = crawl_partition, args = (listener.address, authkey))
+        process.start()  #Not a daemon: with the hybrid engine, workers start processes of their own
+        processes.append(process)
+      controls, requests = self.__accept_workers(listener, settings, processes, workers_timeout)
+      try:
+        results = self.__coordinate(controls, requests)
+      finally:
+        for connection in controls + requests:
+          connection.close()
+    except (EOFError, IOError, socket.error):
+      logging.exception("Distributed crawling of %s failed" % url)
+      for process in processes:
+        process.terminate()
+      self.__home_page_url = None
+      return None
+    finally:
+      listener.close()
+      for process in processes:
+        process.join()
+    
+    self.__merge_partitions(results)
+    return self.__home_page_url
+  
+  def __accept_workers(self, listener, settings, processes, timeout):
+    ''' Waits until every worker of a distributed crawl has opened its two connections (see CoordinatorLink), 
+        and assigns it its partition.
+        :private:
+        
+        :param settings: The settings of each worker.
+        :type settings: list
+        
+        :param processes: The local workers.
+        :type processes: list
+        
+        :param timeout: The number of seconds to wait for all the workers.
+        :type timeout: float
+        
+        :return: The control connections and the request connections, in the order of the workers' partitions.
+        
+        :raise IOError: If the workers don't connect in time, or if a local worker exits.
+    '''
+    workers = len(settings)
+    controls = []
+    requests = [None] * workers
+    
+    #Listener.accept can't time out: connections are accepted by a thread of their own, while this one keeps the time
+    accepted = Queue()
+    stopped = threading.Event()
+    def accept_connections():
+      try:
+        for _ in xrange(2 * workers):
+          connection = listener.accept()
+          if stopped.is_set():
+            connection.close()
+            return
+          accepted.put((connection, connection.recv()))
+      except Exception as e:
+        accepted.put((None, e))
+    acceptor = threading.Thread(target = accept_connections)
+    acceptor.daemon = True
+    acceptor.start()
+    
+    deadline = time() + timeout
+    try:
+      for _ in xrange(2 * workers):
+        while True:
+          try:
+            (connection, message) = accepted.get(timeout = PARTITION_POLL_INTERVAL)
+            break
+          except Empty:
+            exit_codes = [process.exitcode for process in processes if process.exitcode is not None]
+            if exit_codes:
+              raise IOError("A local worker exited with code %s" % exit_codes[0])
+            if time() > deadline:
+              raise IOError("Only %d workers out of %d connected in %s seconds" % (len(controls), workers, timeout))
+        if connection is None:
+          raise message
+        if message[0] == "control":
+          connection.send((len(controls), workers, settings[len(controls)]))
+          controls.append(connection)
+        else:
+          requests[message[1]] = connection
+    except Exception:
+      stopped.set()
+      if acceptor.is_alive() and isinstance(listener.address, tuple):
+        try:
+          socket.create_connection(listener.address[:2], timeout = 1).close()  #Wakes the thread up from accept
+        except socket.error:
+          pass
+      while not accepted.empty():
+        controls.append(accepted.get()[0])
+      for connection in controls + requests:
+        if connection is not None:
+          connection.close()
+      raise
+    return controls, requests
+  
+  def __coordinate(self, controls, requests):
+    ''' Routes the batches of URLs among the workers of a distributed crawl, and answers their requests
+        (for the pages they can retrieve, and for checking the content of their pages), until they all run out 
+        of pages to crawl: then they are stopped.
+        :private:
+        
+        Each worker says it is idle along with the number of batches it has processed: once every worker has processed 
+        all the batches sent to it and is idle, no URL can be queued anymore, since workers only forward URLs while
+        crawling, and the batches they forwarded were received before they said they were idle.
+        
+        :return: The results of the workers (see _crawl_partition).
+    '''
+    workers = len(controls)
+    outboxes = [Queue() for _ in xrange(workers)]
+    
+    #Each worker's messages are sent by a thread of its own, so that this loop always reads, and can't deadlock with 
+    #a worker whose own sends are blocked
+    def send_messages(connection, outbox):
+      for message in iter(outbox.get, None):
+        connection.send(message)
+    senders = [threading.Thread(target = send_messages, args = (controls[index], outboxes[index])) for index in xrange(workers)]
+    for sender in senders:
+      sender.daemon = True
+      sender.start()
+    
+    batches_sent = [0] * workers
+    batches_processed = [None] * workers  #As of the last time each worker was idle
+    def dispatch(owner, batch):
+      outboxes[owner].put(("links", batch))
+      batches_sent[owner] += 1
+    dispatch(url_partition(self.__home_page_url, workers), [(self.__home_page_url, 0, False)])
+    
+    credits = self.__max_pages_to_crawl  #The pages the workers can still retrieve
+    roles = dict((connection, index) for (index, connection) in enumerate(controls))
+    roles.update((connection, None) for connection in requests)
+    try:
+      while batches_processed != batches_sent:
+        for connection in select.select(roles.keys(), [], [])[0]:
+          message = connection.recv()
+          if roles[connection] is None and message[0] == "credit":
+            connection.send(credits > 0)
+            credits -= 1
+          elif roles[connection] is None:
+            (_, page_hash, page_url, fingerprint) = message
+            with threadLock:
+              connection.send(self.__add_page_hash(page_hash, page_url, fingerprint))
+          elif message[0] == "links":
+            dispatch(message[1], message[2])
+          else:
+            batches_processed[roles[connection]] = message[1]
+      
+      for outbox in outboxes:
+        outbox.put(("stop",))
+      results = []
+      for connection in controls:
+        message = connection.recv()
+        assert message[0] == "result"
+        results.append(message[1:])
+      return results
+    finally:
+      for outbox in outboxes:
+        outbox.put(None)
+      for sender in senders:
+        sender.join()
+  
+  def __merge_partitions(self, results):
+    ''' Merges the pages crawled by the workers of a distributed crawl into this handler's site: pages are restored
+        from their content, just like when crawling is resumed from a checkpoint.
+        :private:
+        
+        :param results: The results of the workers (see _crawl_partition).
+        :type results: list
+    '''
+    self._url_table = UrlTable()
+    for (urls, _, _, _) in results:
+      for (url, depth, queued) in urls:
+        url_id = self._url_table.add(url, depth)
+        if queued:
+          self._url_table.set_queued(url_id)
+    
+    self._queue = PolitenessFrontier(0, budget = 0)  #The links of the pages are all in the url table already: nothing is queued
+    self._page_ids = count()
+    self._site = {}
+    self.__resource_index = None
+    for (_, pages, validators, _) in results:
+      self._validators.update(validators)
+      for (url, content) in pages:
+        self._store_page(Page(self._url_table.url(self._url_table.get_id(url)), self, content = content))
+    
+    self._stats = threadLock.stats = CrawlStats()  #Only the workers' measures are kept
+    for (_, _, _, snapshot) in results:
+      self._stats.add(snapshot)
+  
+  def _crawl_partition(self, link):
+    ''' Runs a worker of a distributed crawl (see crawl_partition): the URLs of its partition sent by the coordinator are 
+        crawled by Crawler threads, until the coordinator stops it; then the worker sends back its pages.
+        
+        :param link: The connections to the coordinator.
+        :type link: CoordinatorLink
+    '''
+    settings = link.settings
+    self._stats = threadLock.stats = CrawlStats()
+    self.__formatted_urls = UrlCache(self.__url_cache_size)
+    self.__replay = False
+    self._validators = {}
+    self.__previous_pages = {}
+    self.__prefetched_pages = {}
+    credits = (lambda: link.request("credit")) if settings["capped"] else None  #The budget is kept by the coordinator
+    self.__init_crawl_state(settings["url"], settings["max_page_depth"], None, settings["crawler_delay"], credits)
+    self.__home_page_url = self.format_url(settings["url"], '')
+    self.__partition = link
+    self._concurrency = ConcurrencyController(settings["threads"]) if self.__adaptive_concurrency else None
+    
+    crawler_threads = self.__start_crawlers(settings["threads"], settings["engine"])
+    batches_processed = 0
+    idle_reported = None
+    try:
+      while True:
+        if link.poll(PARTITION_POLL_INTERVAL):
+          message = link.receive()
+          if message[0] == "stop":
+            break
+          self.__admit_batch(message[1])
+          batches_processed += 1
+        if idle_reported != batches_processed and self._queue.unfinished_tasks() == 0:
+          link.send(("idle", batches_processed))
+          idle_reported = batches_processed
+    finally:
+      self.__partition = None
+      self.__stop_crawlers(crawler_threads)
+      self._queue.close()
+      self._connection_pool.close()
+    
+    table = self._url_table
+    link.send(("result", [(url, table.depth(url), table.is_queued(url_id)) for (url_id, url) in enumerate(table)],
+               [(page._url, page._pack_content()) for page in self._site.itervalues()], self._validators, self._stats.snapshot()))
+  
+  def __admit_batch(self, batch):
+    ''' Enqueues a batch of URLs forwarded by the coordinator of a distributed crawl (see enqueue_urls).
+        :private:
+        
+        :param batch: A list of (URL, depth, new link) triples.
+        :type batch: list
+    '''
+    relaxed_pages = []
+    with threadLock:
+      for (page_url, depth, new_link) in batch:
+        self.__admit_url(page_url, depth, relaxed_pages, new_link)
+      self.__relax_depths(relaxed_pages)
+    self.__partition.flush()
+  
+  def __read_checkpoint(self, path):
+    ''' 
+        :private:
+        
+        :return: The state saved by checkpoint.
+    '''
+    with open(path, "rb") as checkpoint_file:
+      state = cPickle.load(checkpoint_file)
+    if state["version"] != CHECKPOINT_VERSION:
+      raise ValueError("Unsupported checkpoint version %s" % state["version"])
+    return state
+  
+  def __load_previous_crawl(self, checkpoint):
+    ''' Loads the pages of a previous crawl that can be requested with a conditional GET.
+        The copies of a page (see check_page_by_content) were stored with no content: they get the content and the hash 
+        of the first copy found, so that whichever copy is crawled first this time, the links of the page are followed.
+        :private:
+        
+        :return: A dict mapping their URLs to (content, content hash, (ETag, Last-Modified)) triples.
+    '''
+    if checkpoint is None:
+      return {}
+    try:
+      state = self.__read_checkpoint(checkpoint)
+    except Exception:
+      logging.exception("Can't load the previous crawl from %s: every page will be retrieved" % checkpoint)
+      return {}
+    
+    page_hashes = {}
+    originals = {}  #Maps the copies of each page to the first copy found
+    for (page_hash, page_urls) in state["page_hashes"].iteritems():
+      for url in page_urls:
+        page_hashes[url] = page_hash
+        originals[url] = page_urls[0]
+    for page_urls in state["near_duplicate_pages"].itervalues():
+      for url in page_urls[1:]:
+        originals.setdefault(url, page_urls[0])
+    contents = dict(state["pages"])
+    validators = state["validators"]
+    previous_pages = {}
+    for url in contents:
+      original_url = originals.get(url, url)
+      if original_url not in contents:
+        original_url = url
+      page_validators = validators.get(url, validators.get(original_url))  #A copy's own validators, if it had any
+      if page_validators is not None:
+        previous_pages[url] = (contents[original_url], page_hashes.get(original_url), page_validators)
+    return previous_pages
   
+  def __run(self, threads, engine, checkpoint_path, checkpoint_interval):
+    ''' Crawls all the URLs in the queue (and the ones found meanwhile) with the engine chosen.
+        :private:
+        
+        See start_crawling for the parameters.
+    '''
     threads = max(1, int(threads))
+    self._concurrency = ConcurrencyController(threads) if self.__adaptive_concurrency else None
+    
+    if checkpoint_path is not None:
+      crawling_over = threading.Event()
+      def save_checkpoints():
+        while not crawling_over.wait(checkpoint_interval):
+          try:
+            self.checkpoint(checkpoint_path)
+          except Exception:
+            logging.exception("Error saving checkpoint %s" % checkpoint_path)
+      checkpointer = threading.Thread(target = save_checkpoints)
+      checkpointer.daemon = True
+      checkpointer.start()
+    
+    try:
+      if engine == ENGINE_ASYNC:
+        self.__crawl_async(threads)
+      else:
+        self.__crawl_threads(threads, engine)
+    finally:
+      if checkpoint_path is not None:
+        crawling_over.set()
+        checkpointer.join()
+      self._queue.close()
+      self._connection_pool.close()
+    
+    if checkpoint_path is not None:
+      self.checkpoint(checkpoint_path)
+  
+  def __crawl_threads(self, threads, engine):
+    ''' Crawls the site with _threads_ Crawler threads (see start_crawling).
+        :private:
+    '''
+    crawler_threads = self.__start_crawlers(threads, engine)
+    self._queue.join()
+    
+    assert (self._queue.empty())
+    self.__stop_crawlers(crawler_threads)
+  
+  def __start_crawlers(self, threads, engine):
+    ''' Starts _threads_ Crawler threads (and the ParsePool of the hybrid engine), waiting for URLs in the queue.
+        :private:
+        
+        :return: The threads.
+    '''
+    if engine == ENGINE_HYBRID:
+      self._parse_pool = ParsePool(self, self.__parse_processes, self.__parse_batch_size)
+    elif engine != ENGINE_THREADS:
+      logging.warning("Unknown engine %s, falling back to %s" % (engine, ENGINE_THREADS))
     
     crawler_threads = []
     for i in xrange(threads):
@@ -473,24 +4058,103 @@ class CrawlerHandler(object):
       crawler.daemon = True #Mark the processes as deamons, so they will be terminated when program exits
       crawler_threads.append(crawler)
       crawler.start()
+    return crawler_threads
+  
+  def __stop_crawlers(self, crawler_threads):
+    ''' Stops the Crawler threads, once the queue is empty and all the pages have been crawled.
+        :private:
+    '''
+    #All the crawlers are now waiting on the empty queue: one STOP_CRAWLING each lets them return
+    for crawler in crawler_threads:
+      self._queue.put(STOP_CRAWLING)
+    for crawler in crawler_threads:
+      crawler.join()
+    if self._parse_pool is not None:
+      self._parse_pool.close()
+      self._parse_pool = None
+
+  def __crawl_async(self, max_connections):
+    ''' Crawls the site on a single asyncore event loop, keeping at most max_connections
+        requests in flight; each page is parsed as soon as its transfer is over.
+        :private:
+        
+        :param max_connections: The maximum number of concurrent requests.
+        :type max_connections: integer
+    '''
+    socket_map = {}
+    in_flight = [0]
+    fetch_start = {}
+    attempts = {}  #Maps the URLs whose requests failed for a transient reason to the retries sent so far
+    retries_due = []  #Heap of the (time, URL) pairs of the requests to be sent again
     
-    self._queue.join()
+    def fetch(page_url):
+      in_flight[0] += 1
+      fetch_start[page_url] = time()
+      AsyncFetcher(page_url, page_retrieved, socket_map, max_body_size = self._max_body_size,
+                   headers = self._request_headers(page_url), connect_timeout = self.__connect_timeout,
+                   read_timeout = self._read_timeout)
     
-    assert (self._queue.empty())
+    def page_retrieved(page_url, html, status, headers):
+      in_flight[0] -= 1
+      latency = time() - fetch_start.pop(page_url)
+      self._stats.observe(STATS_FETCH, latency)
+      transient = status is None or status in RETRY_STATUS_CODES
+      if self._concurrency is not None:
+        self._concurrency.record(latency, transient)
+      if transient and attempts.get(page_url, 0) < self.__retries:
+        delay = self.__retry_delay(attempts.get(page_url, 0), headers.get("retry-after"))
+        if delay is not None:
+          attempts[page_url] = attempts.get(page_url, 0) + 1
+          heappush(retries_due, (time() + delay, page_url))
+          self._stats.increment("retries")
+          return
+      attempts.pop(page_url, None)
+      if status == 304 and page_url in self.__previous_pages:
+        self._store_page(Page(page_url, self, content = self._not_modified_content(page_url)))
+      else:
+        if html is not None:
+          html = self.__decode_body(page_url, html, headers)
+        if html is not None:
+          self._store_validators(page_url, headers)
+          if self._response_cache is not None:
+            self._response_cache.put(page_url, html)
+        else:
+          self._stats.increment("fetch_errors")
+        self._store_page(Page(page_url, self, html, fetch = False))
+      self._queue.task_done()
     
-    #can kill any waiting thread right now, self._queue is the only shared resource and it's been released
-    for crawler in crawler_threads:
-      try:
-        crawler.quit()
-      except SystemExit:
-        pass
-      finally:
-        assert( not crawler.is_alive() )
-
-    return self.__home_page_url
-
-
-
+    while in_flight[0] > 0 or len(retries_due) > 0 or not self._queue.empty():
+      if self._concurrency is not None:
+        max_connections = self._concurrency.limit
+      while in_flight[0] < max_connections and len(retries_due) > 0 and retries_due[0][0] <= time():
+        fetch(heappop(retries_due)[1])
+      while in_flight[0] < max_connections:
+        try:
+          page_url = self._queue.get_nowait() #Only URLs whose host can be crawled right away
+        except Empty:
+          break
+        if urlsplit(page_url)[0] in ASYNC_SCHEMES and not page_url in self.__prefetched_pages and not self.__replay:
+          fetch(page_url)
+        else:
+          #Local resources (f.i. file:// URLs) are read synchronously, as well as the home page already retrieved
+          #and the pages replayed from the response cache
+          self._store_page(Page(page_url, self))
+          self._queue.task_done()
+      
+      if socket_map:
+        asyncore.loop(ASYNC_LOOP_TIMEOUT, False, socket_map, 1)
+        now = time()
+        for fetcher in socket_map.values():
+          if fetcher.check_timeout(now):
+            self._stats.increment("timeouts")
+      elif in_flight[0] == 0 and (len(retries_due) > 0 or not self._queue.empty()):
+        start = time()
+        waits = [retries_due[0][0] - start] if len(retries_due) > 0 else []
+        if not self._queue.empty():
+          waits.append(self._queue.wait_time() or 0)
+        sleep(max(0, min(waits)))
+        self._stats.observe(STATS_QUEUE_WAIT, time() - start)
+  
   def list_resources(self, page_url = None):
     '''Starting from the home page (or from the page provided), lists all the resources used 
        in it and in all the pages on the same domain reachable from the home page
@@ -502,37 +4166,29 @@ class CrawlerHandler(object):
     '''     
     if page_url is None:
       page_url = self.__home_page_url
-    elif not page_url in self._url_to_page_id:  #Checks that the page has actually been crawled
+    page_id = self._url_table.page_id(page_url)
+    if page_id not in self._site:  #Checks that the page has actually been crawled (and retained)
       return {"images": set(), "css": set(), "scripts": set()}  #Otherwise return an empty set
     
-    pages_visited = {}
-    
-    def recursive_list(page, img_set, css_set, script_set):
-      '''Recursively lists all the resources used by the current page and all the linked pages
-      '''
-      
-      try:
-        img_set = img_set | page._img_urls
-        css_set = css_set | page._css_urls
-        script_set = script_set | page._script_urls
-      except: #pragma: no cover
-        return img_set, css_set, script_set
-      
-      
-      for link_url in page._links:
-        try:
-          link_page_id = self._url_to_page_id[link_url]
-          if not link_page_id in pages_visited:
-            pages_visited[link_page_id] = True
-            img_set, css_set, script_set = recursive_list(self._site[link_page_id], img_set, css_set, script_set)
-        except KeyError: #pragma: no cover
-          pass
-    
-      return img_set, css_set, script_set
-     
-    pages_visited[self._url_to_page_id[page_url]] = True  
-    img_set, css_set, script_set = recursive_list(self._site[self._url_to_page_id[page_url]], set(), set(), set())
-    return {"images": img_set, "css": css_set, "scripts": script_set}
+    resource_index = self.__resource_index
+    if resource_index is None:
+      resource_index = self.__resource_index = self.__build_resource_index()
+    images, css, scripts = resource_index.resources(page_id)
+    return {"images": set(images), "css": set(css), "scripts": set(scripts)}
+  
+  def __build_resource_index(self):
+    ''' Indexes the resources and the links of the pages crawled so far.
+        :private:
+    '''
+    with threadLock:
+      site = dict(self._site)
+    resources = {}
+    links = {}
+    for (page_id, page) in site.iteritems():
+      resources[page_id] = (page._img_urls, page._css_urls, page._script_urls)
+      linked_ids = (self._url_table.page_id(link_url) for link_url in page._links)
+      links[page_id] = [linked_id for linked_id in linked_ids if linked_id in site]
+    return ResourceIndex(resources, links)
 
   
   def page_graph(self, page_url = None):
@@ -543,63 +4199,172 @@ class CrawlerHandler(object):
        if a page limit or a depth limit have been specified) 
        :type page_url: string or self.__home_page_url
     '''     
-    if page_url is None:
-      page_url = self.__home_page_url  #Mark the first page as visited
-    elif not page_url in self._url_to_page_id:  #Checks that the page has actually been crawled
+    if page_url is not None and self._url_table.page_id(page_url) not in self._site:  #Checks that the page has actually been crawled
       return []  #Otherwise return an empty set
+    return dict(self.iter_page_graph(page_url))
+  
+  def iter_page_graph(self, page_url = None):
+    '''Same as page_graph, but yields the (url, node) pairs of the graph one by one, visiting the pages in breadth-first order
+       (followed by the copies of pages found elsewhere): the graph is never kept in memory as a whole.
+       
+       :param page_url: See page_graph.
+       :type page_url: string or self.__home_page_url
+    '''
+    if page_url is None:
+      page_url = self.__home_page_url
+    page_id = self._url_table.page_id(page_url)
+    if page_id not in self._site:  #Not crawled, or not retained
+      return
+    
+    #Copies of a page are reported with the content of the first one found, with relative urls resolved against their own url
+    originals = self.__originals()
     
-    pages_visited = {}
-    
-    def transform_video_urls(video, page_url):
-      ''' Transform each urls for a video from relative to absolute 
-          :param video: the video object to modify
-          :type video: dictionary
-          :param page_url: The url of the base page
-          :type page_url: string
-      '''
-      video = deepcopy(video) #Need to deepcopy it in order to support multiple istances of the same page located at different urls
-      video[VIDEO_URLS_TAG] = map(lambda url: urljoin(page_url, url), video[VIDEO_URLS_TAG])
-      if VIDEO_POSTER_TAG in video:
-        video[VIDEO_POSTER_TAG] = urljoin(page_url, video[VIDEO_POSTER_TAG])
-      return video
-    
-    def process_page(page, page_url):
-      return  { "links": page._links, "depth": page._depth, 
-                "resources":  {"images": map(lambda url: urljoin(page_url, url), page._img_urls), 
-                               "videos": [transform_video_urls(video, page_url) for video in page._videos if len(video[VIDEO_URLS_TAG]) > 0], 
-                               "audios": [map(lambda url: urljoin(page_url, url), audio) for audio in page._audios if len(audio) > 0]
-                              }
-              } 
-      
-    def recursive_graph(page, pages_set):
-      '''Recursively lists all the resources used by the current page and all the linked pages
-      '''
-      #try:
-      pages_set[page._url] = process_page(page, page._url)
-      #except: #pragma: no cover
-      #  return pages_set
+    visited = bytearray(max(self._site) + 1)
+    visited[page_id] = 1
+    pages = deque([self._site[page_id]])
+    while len(pages) > 0:
+      page = pages.popleft()
+      original_url = originals.pop(page._url, None)
+      if original_url is None:
+        yield page._url, self.__graph_node(page, page._url)
+      else:
+        yield page._url, self.__graph_node(self._site[self._url_table.page_id(original_url)], page._url)
       
       for link_url in page._links:
-        try:
-          link_page_id = self._url_to_page_id[link_url]
-          if not link_page_id in pages_visited:
-            pages_visited[link_page_id] = True
-            pages_set = recursive_graph(self._site[link_page_id], pages_set)
-        except KeyError:
-          pass
+        link_page_id = self._url_table.page_id(link_url)
+        if link_page_id is not None and link_page_id in self._site and not visited[link_page_id]:
+          visited[link_page_id] = 1
+          pages.append(self._site[link_page_id])
     
-      return pages_set
+    for (url, original_url) in originals.iteritems():
+      yield url, self.__graph_node(self._site[self._url_table.page_id(original_url)], url)
+  
+  def link_graph(self):
+    ''' The links among all the pages crawled (and retained), as a compact graph that can be analysed much faster 
+        than page_graph (see LinkGraph). Just like in page_graph, copies of a page have the same links as the first one found.
+        
+        :return: The graph of the pages, in the order of their IDs.
+        :rtype: LinkGraph
+    '''
+    with threadLock:
+      site = dict(self._site)
+    originals = self.__originals()
+    page_ids = array('i', sorted(site))
+    nodes = dict(izip(page_ids, count()))  #Maps page IDs to nodes
+    urls = []
+    offsets = array('i', [0])
+    targets = array('i')
+    for page_id in page_ids:
+      page = site[page_id]
+      urls.append(page._url)
+      original_url = originals.get(page._url)
+      if original_url is not None:
+        page = site.get(self._url_table.page_id(original_url), page)
+      for link_url in page._links:
+        node = nodes.get(self._url_table.page_id(link_url))
+        if node is not None:
+          targets.append(node)
+      offsets.append(len(targets))
+    return LinkGraph(urls, page_ids, offsets, targets, nodes.get(self._url_table.page_id(self.__home_page_url)))
+  
+  def __originals(self):
+    ''' 
+        :private:
+        
+        :return: A dict mapping the URL of each copy of a page to the URL of the first copy found.
+    '''
+    originals = {}
+    for url_list in self.__queued_pages_hashs.values() + self.__near_duplicate_pages.values():
+      for url in url_list[1:]:
+        originals[url] = url_list[0]
+    return originals
+  
+  def write_page_graph(self, output, page_url = None):
+    '''Streams the graph of the website to a JSON Lines file: one object per page, with its url, links, depth and resources
+       (see page_graph), written as soon as it is visited.
+       
+       :param output: The path of the file, or a file object opened for writing.
+       :type output: string or file
+       
+       :param page_url: See page_graph.
+       :type page_url: string or self.__home_page_url
+       
+       :return: The number of pages written.
+    '''
+    if not hasattr(output, "write"):
+      with open(output, "w") as output_file:
+        return self.write_page_graph(output_file, page_url)
     
-    pages_visited[self._url_to_page_id[page_url]] = True  #Mark the first page as visited
-    graph = recursive_graph(self._site[self._url_to_page_id[page_url]], {})
+    pages_written = 0
+    for (url, node) in self.iter_page_graph(page_url):
+      node["url"] = url
+      output.write(json.dumps(node, default = sorted))  #Sets are written as sorted lists
+      output.write("\n")
+      pages_written += 1
+    return pages_written
+  
+  def stats(self):
+    '''The instrumentation of the last crawl (or of the crawl in progress): where the time went and what was crawled.
     
-    #Now we need to add duplicates for identical copies of pages found
-    for url_list in self.__queued_pages_hashs.values():
-      if len(url_list) > 1:
-        main_url = url_list[0]
-        for url in url_list[1:]:
-          #remap the urls; it needs to parse again the page because only relative urls need to be changed
-          graph[url] = process_page(self._site[self._url_to_page_id[main_url]], url)
-          
-    return graph
+       :return: A dict with two keys:
+         -  "phases" maps each phase measured (see the STATS_* constants) to a dict with the number of measures ("count"),
+            the total time in seconds ("seconds") and a cumulative histogram ("buckets": a list of (upper bound, count) pairs);
+         -  "counters" maps the name of each counter (f.i. "pages_crawled", "bytes_fetched", "duplicate_pages") to its value
+            ("bytes_fetched" counts the bytes received, and "bytes_decoded" the same bytes once decoded: see the compression parameter of the constructor).
+    '''
+    return self._stats.snapshot()
+  
+  def prometheus_stats(self):
+    '''The same stats returned by stats(), in the Prometheus text exposition format: the time spent in each phase 
+       is the histogram pycrawler_phase_seconds (labeled by phase), and each counter becomes pycrawler_<name>_total.
+       
+       :return: A string.
+    '''
+    stats = self.stats()
+    lines = ["# HELP pycrawler_phase_seconds Time spent in each phase of the crawl.",
+             "# TYPE pycrawler_phase_seconds histogram"]
+    for (phase, histogram) in sorted(stats["phases"].iteritems()):
+      for (upper_bound, count) in histogram["buckets"]:
+        upper_bound = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+        lines.append('pycrawler_phase_seconds_bucket{phase="%s",le="%s"} %d' % (phase, upper_bound, count))
+      lines.append('pycrawler_phase_seconds_sum{phase="%s"} %r' % (phase, histogram["seconds"]))
+      lines.append('pycrawler_phase_seconds_count{phase="%s"} %d' % (phase, histogram["count"]))
+    for (counter, value) in sorted(stats["counters"].iteritems()):
+      lines.append("# TYPE pycrawler_%s_total counter" % counter)
+      lines.append("pycrawler_%s_total %d" % (counter, value))
+    return "\n".join(lines) + "\n"
+  
+  def __graph_node(self, page, page_url):
+    '''The node of the graph for a page, with relative urls resolved against page_url.
+       :private:
+    '''
+    join = self.__join_url
+    videos = []
+    for (urls, poster) in page._videos:
+      if len(urls) > 0:
+        video = {VIDEO_URLS_TAG: [join(page_url, url) for url in urls]}
+        if poster is not None:
+          video[VIDEO_POSTER_TAG] = join(page_url, poster)
+        videos.append(video)
+    return  { "links": set(page._links), "depth": page._depth, 
+              "resources":  {"images": [join(page_url, url) for url in page._img_urls], 
+                             "videos": videos, 
+                             "audios": [[join(page_url, url) for url in audio] for audio in page._audios if len(audio) > 0]
+                            }
+            } 
+  
+  def __join_url(self, page_url, url):
+    '''Resolves an url found on a page against the page's url, remembering the urls already resolved (see UrlCache).
+       Its hits and misses are counted apart from the ones of format_url, so that exporting doesn't change the crawl's.
+       :private:
+    '''
+    key = (resolution_base(page_url, url), url)
+    joined_url = self.__joined_urls.get(key)
+    if joined_url is URL_CACHE_MISS:
+      self._stats.increment("join_cache_misses")
+      joined_url = urljoin(page_url, url)
+      self.__joined_urls.put(key, joined_url)
+    else:
+      self._stats.increment("join_cache_hits")
+    return joined_url
     
\ No newline at end of file
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+'''
+   Benchmarks for PyCrawler that can be reproduced offline.
+
+   A local HTTP server generates a synthetic site, whose shape is entirely
+   determined by a few parameters (and by a random seed):
+    * The number of pages;
+    * The fan-out, i.e. the number of links on each page;
+    * The depth, i.e. the number of levels below the home page;
+    * The ratio of pages that are exact duplicates of another page;
+    * The size of the body of each page;
+    * A latency injected before each response;
+    * The content encoding (gzip or deflate) used for the clients that accept it.
+
+   The site is crawled with every configuration of start_crawling and every
+   number of threads requested, each run in a separate process, and for each
+   run pages/sec, the median and 99th percentile of the fetch latency (as
+   measured by the server, from the request to the last byte of the response),
+   the peak RSS, the CPU time per page, the time per page spent in each
+   phase of the crawl (see CrawlerHandler.stats) and the bytes per page
+   received and decoded are reported.
+
+   The report is a JSON document with sorted keys and results in a fixed
+   order, so that the reports of two versions can be diffed.
+
+   Usage: python pycrawler_benchmark.py --pages 1000 --threads 1,4,16 --content-encoding gzip --output report.json
+'''
+
+
+from pycrawler import CrawlerHandler, ENGINE_THREADS, ENGINE_ASYNC, ENGINE_HYBRID, PARSER_REGEX, DEDUP_BLOOM
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer
+from multiprocessing import Process, Queue
+from Queue import Empty
+from traceback import format_exc
+from random import Random
+from time import time, sleep
+import threading
+import resource
+import logging
+import json
+import zlib
+import gzip
+from cStringIO import StringIO
+
+
+BENCHMARK_FORMAT = 1
+
+#Each configuration is a (name, CrawlerHandler parameters, start_crawling parameters) triple
+DEFAULT_CONFIGURATIONS = [("threads", {}, {"engine": ENGINE_THREADS}),
+                          ("threads-streaming", {"chunk_size": 4096}, {"engine": ENGINE_THREADS}),
+                          ("async", {}, {"engine": ENGINE_ASYNC}),
+                          ("hybrid", {}, {"engine": ENGINE_HYBRID}),
+                          ("regex-parser", {"parser_backend": PARSER_REGEX}, {"engine": ENGINE_THREADS}),
+                          ("bloom-dedup", {"dedup": DEDUP_BLOOM}, {"engine": ENGINE_THREADS}),
+                          ("uncompressed", {"compression": False}, {"engine": ENGINE_THREADS})]
+DEFAULT_THREADS = [1, 4, 16]
+
+FILLER_TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore. "
+
+
+class SyntheticSite(object):
+  '''
+    A site generated out of a few parameters: the home page links to the first level, and every level
+    to the next one, so that all the pages are reachable and each one is exactly at the depth of its level.
+
+    :param pages: The number of pages, home page included.
+
+    :param fan_out: The number of links on each page (pages linking a level larger than their own
+    link at least as many pages as needed to reach all of it).
+
+    :param depth: The number of levels below the home page, all the same size.
+
+    :param duplicate_ratio: The ratio of pages whose content is the same as another page on the same level
+    (at least one page per level is always an original).
+
+    :param body_size: The minimum size of each page, in bytes.
+
+    :param latency: The time, in seconds, the server waits before answering each request.
+
+    :param seed: The seed of the random generator: the same parameters always generate the same site.
+
+    :param content_encoding: If set ("gzip" or "deflate"), pages are compressed for the clients that accept it.
+  '''
+
+  def __init__(self, pages = 1000, fan_out = 10, depth = 4, duplicate_ratio = 0.1, body_size = 4096, latency = 0., seed = 0,
+               content_encoding = None):
+    if pages < 1 or depth < 1 or fan_out < 1:
+      raise ValueError("A site needs at least one page, one level and one link per page")
+    if content_encoding not in (None, "gzip", "deflate"):
+      raise ValueError("Unsupported content encoding %s" % content_encoding)
+
+    self.pages = pages
+    self.fan_out = fan_out
+    self.depth = depth
+    self.duplicate_ratio = duplicate_ratio
+    self.body_size = body_size
+    self.latency = latency
+    self.seed = seed
+    self.content_encoding = content_encoding
+    self.__latencies = []
+    self.__latencies_lock = threading.Lock()
+
+    random = Random(seed)
+    levels = [[0]]
+    level_size = max(1, (pages - 1 + depth - 1) // depth)
+    for first_page in xrange(1, pages, level_size):
+      levels.append(range(first_page, min(pages, first_page + level_size)))
+
+    originals = {}
+    for level in levels[1:]:
+      duplicates = random.sample(level[1:], int(len(level[1:]) * duplicate_ratio))
+      level_originals = sorted(set(level) - set(duplicates))
+      for page in duplicates:
+        originals[page] = random.choice(level_originals)
+
+    links = [[] for _ in xrange(pages)]
+    for (level, next_level) in zip(levels, levels[1:] + [None]):
+      level_originals = [page for page in level if page not in originals]
+      if next_level is None:
+        next_level = range(pages)  #The last level links back to the rest of the site
+      else:
+        #Every page of the next level is linked from an original page of this level
+        for (i, page) in enumerate(next_level):
+          links[level_originals[i % len(level_originals)]].append(page)
+      for page in level:
+        while len(links[page]) < min(fan_out, len(next_level)):
+          link = random.choice(next_level)
+          if link not in links[page]:
+            links[page].append(link)
+
+    self.__bodies = []
+    for page in xrange(pages):
+      html = "<html><head><title>Page %d</title><link rel='stylesheet' href='/site.css'></head><body>" % page
+      html += "".join("<a href='/%d.html'>Page %d</a>" % (link, link) for link in links[page])
+      html += "<img src='/img_%d.jpg'>" % page
+      html += "<p>%s</p></body></html>" % (FILLER_TEXT * max(0, (body_size - len(html)) // len(FILLER_TEXT) + 1))
+      self.__bodies.append(html)
+    for (page, original) in originals.iteritems():
+      self.__bodies[page] = self.__bodies[original]
+    #Compressed once and for all, so that the server's latency doesn't include compression
+    self.__encoded_bodies = [encode(body, content_encoding) for body in self.__bodies] if content_encoding else None
+
+  def parameters(self):
+    '''
+        :return: The parameters the site was generated from.
+    '''
+    return {"pages": self.pages, "fan_out": self.fan_out, "depth": self.depth, "duplicate_ratio": self.duplicate_ratio,
+            "body_size": self.body_size, "latency": self.latency, "seed": self.seed, "content_encoding": self.content_encoding}
+
+  def body(self, path, encoded = False):
+    '''
+        :param path: The path of a page (f.i. /12.html).
+
+        :param encoded: If True, the content is returned compressed with the site's content encoding (if any).
+
+        :return: The content of the page, or None if there is no such page.
+    '''
+    try:
+      page = int(path.lstrip("/").split(".html")[0])
+    except ValueError:
+      return None
+    if 0 <= page < self.pages and path == "/%d.html" % page:
+      return self.__encoded_bodies[page] if encoded and self.content_encoding else self.__bodies[page]
+    else:
+      return None
+
+  def record_latency(self, latency):
+    with self.__latencies_lock:
+      self.__latencies.append(latency)
+
+  def pop_latencies(self):
+    '''
+        :return: The time needed to serve each request since the last call, sorted.
+    '''
+    with self.__latencies_lock:
+      latencies, self.__latencies = self.__latencies, []
+    return sorted(latencies)
+
+
+def encode(body, content_encoding):
+  ''' Compresses a body as a server would, for a Content-Encoding header.
+
+      :param content_encoding: Either "gzip" or "deflate" (a zlib stream).
+  '''
+  if content_encoding == "deflate":
+    return zlib.compress(body)
+  output = StringIO()
+  gzip_file = gzip.GzipFile(fileobj = output, mode = "wb", mtime = 0)  #The same site always sends the same bytes
+  gzip_file.write(body)
+  gzip_file.close()
+  return output.getvalue()
+
+
+def serve_site(site):
+  ''' Serves a synthetic site from a local HTTP server running in a daemon thread.
+
+      :param site: The site to serve.
+      :type site: SyntheticSite
+
+      :return: A (server, home page URL) pair.
+  '''
+
+  class SiteRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #Keep-alive connections
+    disable_nagle_algorithm = True #Headers and body are written separately
+
+    def do_GET(self):
+      start = time()
+      if site.latency > 0:
+        sleep(site.latency)
+      encoded = site.content_encoding is not None and site.content_encoding in self.headers.get("Accept-Encoding", "")
+      body = site.body(self.path.split("?")[0], encoded)
+      if body is None:
+        self.send_response(404)
+        body = ""
+      else:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        if encoded:
+          self.send_header("Content-Encoding", site.content_encoding)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      site.record_latency(time() - start)
+
+    def log_message(self, *args):
+      pass
+
+  class SiteServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+      pass  #Crawlers may drop connections on purpose
+
+  server = SiteServer(("localhost", 0), SiteRequestHandler)
+  server_thread = threading.Thread(target = server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  return server, "http://localhost:%d/0.html" % server.server_address[1]
+
+
+def percentile(values, p):
+  ''' Nearest-rank percentile.
+
+      :param values: A sorted list.
+
+      :param p: The percentile, between 0 and 100.
+
+      :return: The smallest value such that at least p% of the values are not greater than it (0 for an empty list).
+  '''
+  if not values:
+    return 0.
+  rank = max(1, int(-(-len(values) * p // 100)))
+  return values[rank - 1]
+
+
+def __crawl(url, threads, handler_parameters, crawling_parameters, results):
+  ''' Crawls the site in the current process, and puts in results the number of pages crawled,
+      the time elapsed, the CPU time used, the peak RSS (of this process and of its children, if any),
+      the time spent in each phase and the bytes received and decoded.
+      If the crawl fails, puts the traceback instead (measures and tracebacks are tagged with True and False).
+      :private:
+  '''
+  logging.getLogger().setLevel(logging.CRITICAL)
+  try:
+    handler = CrawlerHandler(**handler_parameters)
+    start = time()
+    handler.start_crawling(url, threads, None, None, 0, **crawling_parameters)
+  except Exception:
+    results.put((False, format_exc()))
+    return
+  elapsed = time() - start
+  usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+  stats = handler.stats()
+  phases = dict((phase, histogram["seconds"]) for (phase, histogram) in stats["phases"].iteritems())
+  transfer = (stats["counters"].get("bytes_fetched", 0), stats["counters"].get("bytes_decoded", 0))
+  results.put((True, len(handler._site), elapsed, sum(u.ru_utime + u.ru_stime for u in usage), max(u.ru_maxrss for u in usage), 
+               phases, transfer))
+
+
+def run_benchmark(site, url, threads, handler_parameters = {}, crawling_parameters = {}):
+  ''' Crawls a synthetic site already served, in a separate process so that its memory and CPU usage
+      can be measured on their own.
+
+      :param site: The site.
+      :type site: SyntheticSite
+
+      :param url: The home page of the site (see serve_site).
+
+      :param threads: The number of threads (or concurrent requests) used for crawling.
+
+      :param handler_parameters: The parameters passed to CrawlerHandler.
+
+      :param crawling_parameters: The parameters passed to start_crawling (crawler_delay is always 0).
+
+      :return: A dict with the measures taken.
+
+      :raise RuntimeError: If the crawl fails, or if its process dies.
+  '''
+  site.pop_latencies()
+  results = Queue()
+  process = Process(target = __crawl, args = (url, threads, handler_parameters, crawling_parameters, results))
+  process.start()
+  while True:
+    try:
+      result = results.get(timeout = 1)
+      break
+    except Empty:
+      if not process.is_alive():
+        raise RuntimeError("The crawling process exited with code %s" % process.exitcode)
+  process.join()
+  if not result[0]:
+    raise RuntimeError("The crawl failed:\n%s" % result[1])
+  pages, elapsed, cpu_time, peak_rss, phases, (bytes_received, bytes_decoded) = result[1:]
+  latencies = site.pop_latencies()
+
+  return {"threads": threads,
+          "pages_crawled": pages,
+          "seconds": round(elapsed, 3),
+          "pages_per_second": round(pages / elapsed, 1) if elapsed > 0 else None,
+          "fetch_latency_ms": {"p50": round(percentile(latencies, 50) * 1000, 3),
+                               "p99": round(percentile(latencies, 99) * 1000, 3)},
+          "peak_rss_kb": peak_rss,
+          "cpu_ms_per_page": round(cpu_time * 1000 / pages, 3) if pages > 0 else None,
+          "phase_ms_per_page": dict((phase, round(seconds * 1000 / pages, 3)) for (phase, seconds) in phases.iteritems())
+                               if pages > 0 else None,
+          "bytes_per_page": {"received": bytes_received // pages, "decoded": bytes_decoded // pages} if pages > 0 else None}
+
+
+def run_suite(site, configurations = DEFAULT_CONFIGURATIONS, threads = DEFAULT_THREADS):
+  ''' Crawls a synthetic site with every configuration and every number of threads.
+
+      :param site: The site to crawl.
+      :type site: SyntheticSite
+
+      :param configurations: A list of (name, CrawlerHandler parameters, start_crawling parameters) triples.
+
+      :param threads: The numbers of threads to try each configuration with.
+
+      :return: The report, as a dict that can be serialized to JSON.
+  '''
+  server, url = serve_site(site)
+  try:
+    results = []
+    for (name, handler_parameters, crawling_parameters) in configurations:
+      for thread_count in threads:
+        result = run_benchmark(site, url, thread_count, handler_parameters, crawling_parameters)
+        result["configuration"] = name
+        results.append(result)
+  finally:
+    server.shutdown()
+    server.server_close()
+  return {"format": BENCHMARK_FORMAT, "site": site.parameters(), "results": results}
+
+
+def write_report(report, output):
+  ''' Writes a report in a stable format, that can be diffed with the report of another version.
+
+      :param output: A file-like object.
+  '''
+  json.dump(report, output, indent = 2, sort_keys = True, separators = (",", ": "))
+  output.write("\n")
+
+
+def main(): #pragma: no cover
+  import argparse
+  import sys
+
+  parser = argparse.ArgumentParser(description = "Crawls synthetic sites served locally and reports the crawler's performance")
+  parser.add_argument("--pages", type = int, default = 1000)
+  parser.add_argument("--fan-out", type = int, default = 10)
+  parser.add_argument("--depth", type = int, default = 4)
+  parser.add_argument("--duplicates", type = float, default = 0.1, help = "Ratio of duplicate pages")
+  parser.add_argument("--body-size", type = int, default = 4096, help = "Bytes per page")
+  parser.add_argument("--latency", type = float, default = 0., help = "Seconds injected before each response")
+  parser.add_argument("--seed", type = int, default = 0)
+  parser.add_argument("--content-encoding", choices = ("gzip", "deflate"), help = "Compression of the pages (default: none)")
+  parser.add_argument("--threads", default = ",".join(map(str, DEFAULT_THREADS)), help = "Comma separated list")
+  parser.add_argument("--configurations", default = ",".join(name for (name, _, _) in DEFAULT_CONFIGURATIONS),
+                      help = "Comma separated list")
+  parser.add_argument("--output", help = "Report file (default: standard output)")
+  args = parser.parse_args()
+
+  site = SyntheticSite(args.pages, args.fan_out, args.depth, args.duplicates, args.body_size, args.latency, args.seed,
+                       args.content_encoding)
+  names = args.configurations.split(",")
+  configurations = [configuration for configuration in DEFAULT_CONFIGURATIONS if configuration[0] in names]
+  report = run_suite(site, configurations, [int(t) for t in args.threads.split(",")])
+  if args.output is None:
+    write_report(report, sys.stdout)
+  else:
+    with open(args.output, "w") as output:
+      write_report(report, output)
+
+
+if __name__ == '__main__':
+  main()
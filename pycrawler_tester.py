@@ -5,11 +5,32 @@ Created on 05/gen/2013
 
 @author: mlarocca
 '''
-from pycrawler import CrawlerHandler
-from urlparse import urlunsplit
+from pycrawler_benchmark import SyntheticSite, serve_site, run_benchmark, run_suite, write_report, percentile, encode
+from pycrawler import CrawlerHandler, Crawler, ENGINE_ASYNC, ENGINE_THREADS, ENGINES, PageParser, PARSER_BACKENDS, PARSER_REGEX, \
+                      PolitenessFrontier, ENGINE_HYBRID, UrlTable, BloomFilter, DEDUP_BLOOM, ResponseCache, \
+                      SimHash, NearDuplicateIndex, hamming_distance, ResourceIndex, Page, VIDEO_URLS_TAG, VIDEO_POSTER_TAG, \
+                      CrawlStats, TimedLock, UrlCache, URL_CACHE_MISS, resolution_base, STATS_FETCH, STATS_PARSE, STATS_DEDUP, STATS_ENQUEUE, STATS_LOCK_WAIT, \
+                      pattern_score, in_links_score, ContentDecoder, decode_chunks, url_partition, \
+                      RETAIN_ALL, RETAIN_LINKS, RETAIN_NONE, LinkGraph, ConcurrencyController, is_transient, ConnectionPool, \
+                      parse_retry_after
+from urlparse import urlunsplit, urlsplit, urljoin
+from urllib2 import urlopen, URLError, HTTPError
 from random import random
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingTCPServer
+from Queue import Empty
+import threading
 import logging
+import socket
 import os
+from email.utils import formatdate
+import sys
+import json
+import zlib
+from array import array
+from time import time, sleep
+from tempfile import mkstemp, mkdtemp
+from shutil import rmtree
 
 '''UNIT + INTEGRATION TESTING'''
 
@@ -43,6 +64,1080 @@ def test_page_graph(url, threads = 1, max_page_depth = None, max_pages_to_crawl
   return pages_set_2
   #At least some resource should be found   
    
+def crawl_chain(length, max_page_depth = None):
+  '''Crawls a site made of a chain of _length_ pages, each one with an image, replaying it from a response cache.
+  
+     :return: The handler.
+  '''
+  cache_path = mkdtemp()
+  cache = ResponseCache(cache_path)
+  for i in xrange(length):
+    cache.put("http://chain.test/%d.html" % i, "<a href='%d.html'>Next</a><img src='%d.jpg'>" % (i + 1, i))
+  handler = CrawlerHandler(response_cache = cache)
+  handler.start_crawling("http://chain.test/0.html", 1, max_page_depth, None, 0, replay = True)
+  cache.close()
+  rmtree(cache_path)
+  return handler
+  
+def serve_tests_folder():
+  '''Serves the tests folder from a local HTTP server running in a daemon thread.
+  
+     :return: The base URL of the server
+  '''
+  tests_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+  
+  class TestsRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #Keep-alive connections
+    
+    def translate_path(self, path):
+      return os.path.join(tests_folder, *urlsplit(path)[2].split("/"))
+    
+    def send_head(self):
+      #Conditional GETs: ETags are made out of the modification time of the files
+      path = self.translate_path(self.path)
+      if os.path.isfile(path):
+        last_modified = self.date_time_string(os.stat(path).st_mtime)
+        if (self.headers.get("If-None-Match") == '"%s"' % last_modified or 
+            self.headers.get("If-Modified-Since") == last_modified):
+          self.send_response(304)
+          self.end_headers()
+          return None
+      return SimpleHTTPRequestHandler.send_head(self)
+    
+    def send_header(self, keyword, value):
+      SimpleHTTPRequestHandler.send_header(self, keyword, value)
+      if keyword == "Last-Modified":
+        SimpleHTTPRequestHandler.send_header(self, "ETag", '"%s"' % value)
+    
+    def log_message(self, *args):
+      pass
+  
+  ThreadingTCPServer.daemon_threads = True
+  server = ThreadingTCPServer(("localhost", 0), TestsRequestHandler)
+  server.handle_error = lambda request, client_address: None  #Crawlers may drop connections on purpose
+  server_thread = threading.Thread(target = server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  return "http://localhost:%d" % server.server_address[1]
+
+def normalize(graph):
+  '''Turns every list and set in a page graph into a sorted list, so that graphs can be compared
+     regardless of the order in which pages and resources were found.
+  '''
+  if isinstance(graph, dict):
+    return {key: normalize(value) for (key, value) in graph.items()}
+  elif isinstance(graph, (list, set)):
+    return sorted(normalize(value) for value in graph)
+  else:
+    return graph
+
+def test_async_engine(base_url):
+  url = base_url + "/test_B.html"
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  async_handler = CrawlerHandler()
+  assert async_handler.start_crawling(url, 3, None, None, 0, ENGINE_ASYNC) == url
+  assert normalize(handler.page_graph()) == normalize(async_handler.page_graph())
+  assert handler.list_resources() == async_handler.list_resources()
+  #Unreachable pages are listed as in the threaded engine
+  assert base_url + "/missing_file.html" in async_handler.page_graph()
+  
+def test_connection_pool(base_url):
+  url = base_url + "/test_B.html"
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  pool = handler._connection_pool
+  #The home page is retrieved only once, and connections are reused (the server only closes them after 404 errors)
+  assert pool.requests_sent == len(handler.page_graph())
+  assert pool.connections_opened < pool.requests_sent
+  
+  #Idle connections are not reused after the timeout 
+  handler = CrawlerHandler(pool_size = 2, pool_idle_timeout = 0)
+  handler.start_crawling(url, 1, None, None, 0)
+  assert handler._connection_pool.connections_opened == handler._connection_pool.requests_sent
+  
+def test_streaming(url):
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  #Tiny chunks split tags and attributes across different calls to the parser 
+  streaming_handler = CrawlerHandler(chunk_size = 7)
+  streaming_handler.start_crawling(url, 1, None, None, 0)
+  assert normalize(handler.page_graph()) == normalize(streaming_handler.page_graph())
+  assert handler.list_resources() == streaming_handler.list_resources()
+
+def test_max_body_size(url):
+  test_D_url = urljoin(url, "test_D/test_D.html")
+  for handler, engine in ((CrawlerHandler(max_body_size = 400), ENGINE_THREADS), 
+                          (CrawlerHandler(chunk_size = 64, max_body_size = 400), ENGINE_THREADS),
+                          (CrawlerHandler(max_body_size = 400), ENGINE_ASYNC)):
+    handler.start_crawling(url, 2, None, None, 0, engine)
+    graph = handler.page_graph()
+    #test_D.html is larger than 400 bytes: it's listed, but it can't be crawled
+    assert len(graph[test_D_url]["links"]) == 0
+    assert not urljoin(url, "test_D/test_C.html") in graph
+  
+class ParsedPage(object):
+  '''Holds the fields filled by a PageParser, to test parsers without crawling.
+  '''
+  def __init__(self):
+    self._links_found = set()
+    self._css_urls = set()
+    self._script_urls = set()
+    self._img_urls = set()
+    self._videos = []
+    self._audios = []
+  
+  def fields(self):
+    return (self._links_found, self._css_urls, self._script_urls, self._img_urls, self._videos, self._audios)
+
+def parse_html(html, parser_class, chunk_size = None):
+  page = ParsedPage()
+  parser = parser_class(page, None)
+  chunk_size = chunk_size or len(html)
+  for i in xrange(0, len(html), chunk_size):
+    parser.feed(html[i: i + chunk_size])
+  return page.fields()
+
+def tests_files():
+  tests_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+  for folder, _, file_names in os.walk(tests_folder):
+    for file_name in file_names:
+      if file_name.endswith(".html"):
+        with open(os.path.join(folder, file_name)) as f:
+          yield f.read()
+
+def test_parser_backends(url):
+  #Every backend fills the same fields, however the page is split in chunks
+  for html in tests_files():
+    expected = parse_html(html, PageParser)
+    for parser_class in PARSER_BACKENDS.values():
+      for chunk_size in (None, 1, 7):
+        assert parse_html(html, parser_class, chunk_size) == expected
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  for regex_handler in (CrawlerHandler(parser_backend = PARSER_REGEX), CrawlerHandler(chunk_size = 5, parser_backend = PARSER_REGEX)):
+    regex_handler.start_crawling(url, 1, None, None, 0)
+    assert normalize(handler.page_graph()) == normalize(regex_handler.page_graph())
+    assert handler.list_resources() == regex_handler.list_resources()
+  
+  #Whatever is split by a chunk boundary: comments, declarations and quoted '>' inside tags
+  html = ("<!DOCTYPE html><html><head><link rel='stylesheet' href='a.css'><script src='s.js'>if (a < b) {}</script>"
+          "<style>a > b { color: red }</style></head><body>"
+          "<!-- <a href='commented.html'>x</a> <link href='commented.css'> -->"
+          "<?php echo 1 ?><![CDATA[ <a href='cdata.html'> ]]><!bogus <img src='bogus.png'>"
+          "<a title='1 > 0' href='quoted.html'>q</a><img alt=\"a>b\" src='i.png'>"
+          "<a href='b.html' onclick='if (a > b) return;'>b</a><!-- <img src='c.png'> --  >"
+          "<video poster='p.jpg'><source src='v.mp4'></video><audio><source src='a.ogg'></audio>"
+          "<form method='get' action='search.html'></form></body></html>")
+  expected = parse_html(html, PageParser)
+  assert "quoted.html" in expected[0] and not "commented.html" in expected[0]
+  for parser_class in PARSER_BACKENDS.values():
+    for boundary in xrange(1, len(html)):
+      page = ParsedPage()
+      parser = parser_class(page, None)
+      parser.feed(html[:boundary])
+      parser.feed(html[boundary:])
+      assert page.fields() == expected, boundary
+  
+def test_crawlers_shutdown(url):
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 10, None, None, 0)
+  #All the crawler threads returned as soon as crawling was over
+  assert not any(isinstance(thread, Crawler) for thread in threading.enumerate())
+  
+def test_politeness(base_url):
+  delay = 0.1
+  frontier = PolitenessFrontier(delay)
+  for url in ("http://a.com/1", "http://a.com/2", "http://b.com/1", "http://a.com/3", "http://b.com/2"):
+    frontier.put(url)
+  start = time()
+  last_request = {}
+  for _ in xrange(5):
+    url = frontier.get()
+    host = urlsplit(url)[1]
+    #Requests to the same host are at least _delay_ seconds apart
+    assert time() - last_request.get(host, -delay) >= delay * 0.99
+    last_request[host] = time()
+    frontier.task_done()
+  assert frontier.empty()
+  #Meanwhile, the other host is crawled: 3 requests to a.com in a row take 2 delays
+  assert time() - start < 3 * delay
+  
+  #Crawling a single host, the delay is enforced however many threads are run
+  handler = CrawlerHandler()
+  start = time()
+  handler.start_crawling(base_url + "/test_B.html", 5, None, None, delay / 2)
+  assert time() - start >= (len(handler.page_graph()) - 1) * delay / 2 
+  
+def test_hybrid_engine(url):
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  for hybrid_handler in (CrawlerHandler(parse_processes = 2, parse_batch_size = 3), 
+                         CrawlerHandler(parse_processes = 1, parse_batch_size = 1, parser_backend = PARSER_REGEX)):
+    hybrid_handler.start_crawling(url, 2, None, None, 0, ENGINE_HYBRID)
+    assert normalize(handler.page_graph()) == normalize(hybrid_handler.page_graph())
+    assert handler.list_resources() == hybrid_handler.list_resources()
+  
+def test_url_dedup(url):
+  table = UrlTable()
+  url_id = table.add("http://a.com/x", 3)
+  assert table.add("http://a.com/x", 5) == url_id and table.depth("http://a.com/x") == 3
+  table.add("http://a.com/x", 1)
+  assert table.depth("http://a.com/x") == 1 and len(table) == 1
+  assert table.page_id("http://a.com/x") is None and not table.is_queued(url_id)
+  table.set_page_id("http://a.com/x", 0)
+  table.set_queued(url_id)
+  assert table.page_id("http://a.com/x") == 0 and table.is_queued(url_id)
+  assert table.url(url_id) is table.url(table.get_id("http://a.com/x"))
+  
+  bloom = BloomFilter(1000, 0.01)
+  urls = ["http://a.com/%d" % i for i in xrange(1000)]
+  for u in urls:
+    bloom.add(u)
+  assert all(u in bloom for u in urls)
+  false_positives = sum(1 for i in xrange(10000) if ("http://b.com/%d" % i) in bloom)
+  assert false_positives < 300
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  bloom_handler = CrawlerHandler(dedup = DEDUP_BLOOM, bloom_capacity = 100)
+  bloom_handler.start_crawling(url, 1, None, None, 0)
+  assert normalize(handler.page_graph()) == normalize(bloom_handler.page_graph())
+  assert handler.list_resources() == bloom_handler.list_resources()
+  #Only the URLs actually queued are interned
+  assert len(bloom_handler._url_table) <= len(handler._url_table)
+  
+def test_frontier_spill(url):
+  handle, spill_path = mkstemp()
+  os.close(handle)
+  frontier = PolitenessFrontier(0, memory_limit = 3, spill_path = spill_path)
+  urls = ["http://%s.com/%d" % (host, i) for i in xrange(10) for host in ("a", "b")]
+  for u in urls:
+    frontier.put(u)
+  assert frontier.qsize() == 20 and frontier.spilled_size() == 17
+  found = [frontier.get(False) for _ in xrange(20)]
+  assert frontier.empty() and frontier.spilled_size() == 0
+  for host in ("a", "b"):
+    #Each host's URLs are still handed out in order
+    assert [u for u in found if host in u] == [u for u in urls if host in u]
+  frontier.close()
+  assert not os.path.exists(spill_path)
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  spill_handler = CrawlerHandler(frontier_memory_limit = 1)
+  spill_handler.start_crawling(url, 1, None, None, 0)
+  assert normalize(handler.page_graph()) == normalize(spill_handler.page_graph())
+  
+def test_checkpoint(url):
+  handle, checkpoint_path = mkstemp()
+  os.close(handle)
+  
+  class InterruptedHandler(CrawlerHandler):
+    '''Takes a checkpoint as soon as 3 pages have been crawled
+    '''
+    def _store_page(self, page):
+      CrawlerHandler._store_page(self, page)
+      if len(self._site) == 3:
+        self.checkpoint(checkpoint_path)
+  
+  class CountingHandler(CrawlerHandler):
+    '''Keeps track of the pages retrieved
+    '''
+    retrieved = []
+    def _iter_url(self, page_url):
+      self.retrieved.append(page_url)
+      return CrawlerHandler._iter_url(self, page_url)
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  InterruptedHandler().start_crawling(url, 1, None, None, 0)
+  
+  resumed_handler = CountingHandler()
+  assert resumed_handler.resume_crawling(checkpoint_path, 1, 0) == url
+  assert normalize(handler.page_graph()) == normalize(resumed_handler.page_graph())
+  assert handler.list_resources() == resumed_handler.list_resources()
+  #Pages crawled before the checkpoint are not retrieved again
+  assert 0 < len(resumed_handler.retrieved) <= len(handler._site) - 3
+  
+  #Once crawling is over, the final checkpoint has nothing left to crawl
+  CrawlerHandler().start_crawling(url, 1, None, None, 0, checkpoint_path = checkpoint_path)
+  resumed_handler = CountingHandler()
+  resumed_handler.retrieved = []
+  resumed_handler.resume_crawling(checkpoint_path, 2, 0)
+  assert resumed_handler.retrieved == []
+  assert normalize(handler.page_graph()) == normalize(resumed_handler.page_graph())
+  
+  os.remove(checkpoint_path)
+  assert CrawlerHandler().resume_crawling(checkpoint_path) is None
+  
+def test_recrawl(url):
+  handle, checkpoint_path = mkstemp()
+  os.close(handle)
+  
+  class RecrawlHandler(CrawlerHandler):
+    '''Keeps track of the pages that hadn't changed
+    '''
+    def _not_modified_content(self, page_url):
+      self.not_modified.append(page_url)
+      return CrawlerHandler._not_modified_content(self, page_url)
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0, checkpoint_path = checkpoint_path)
+  crawled = len(handler._validators)
+  assert crawled > 0
+  
+  for (engine, chunk_size) in ((ENGINE_THREADS, None), (ENGINE_THREADS, 64), (ENGINE_ASYNC, None), (ENGINE_HYBRID, None)):
+    recrawl_handler = RecrawlHandler(chunk_size = chunk_size)
+    recrawl_handler.not_modified = []
+    recrawl_handler.start_crawling(url, 1, None, None, 0, engine, previous_crawl = checkpoint_path)
+    #Every page answers 304, and copies are still detected by their content hash
+    assert sorted(recrawl_handler.not_modified) == sorted(handler._validators)
+    assert normalize(handler.page_graph()) == normalize(recrawl_handler.page_graph())
+    assert handler.list_resources() == recrawl_handler.list_resources()
+    #Validators survive a crawl made only of conditional GETs
+    assert recrawl_handler._validators == handler._validators
+  
+  #A page whose validators don't match is retrieved and parsed again
+  changed_url = urljoin(url, "test_C.html")
+  recrawl_handler._store_validators(changed_url, {"etag": '"old"'})
+  recrawl_handler.checkpoint(checkpoint_path)
+  recrawl_handler = RecrawlHandler()
+  recrawl_handler.not_modified = []
+  recrawl_handler.start_crawling(url, 1, None, None, 0, previous_crawl = checkpoint_path)
+  assert len(recrawl_handler.not_modified) == crawled - 1 and changed_url not in recrawl_handler.not_modified
+  assert normalize(handler.page_graph()) == normalize(recrawl_handler.page_graph())
+  
+  #Starting from a copy, it's found before the page it copies: the links of the page are still followed
+  handler.checkpoint(checkpoint_path)
+  copy_url = urljoin(url, "test_1_copy.html")
+  copy_handler = CrawlerHandler()
+  copy_handler.start_crawling(copy_url, 1, None, None, 0)
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    recrawl_handler = RecrawlHandler()
+    recrawl_handler.not_modified = []
+    recrawl_handler.start_crawling(copy_url, 1, None, None, 0, engine, previous_crawl = checkpoint_path)
+    assert copy_url in recrawl_handler.not_modified
+    assert normalize(copy_handler.page_graph()) == normalize(recrawl_handler.page_graph())
+  assert len(copy_handler.page_graph()) > 1
+  os.remove(checkpoint_path)
+  
+def test_response_cache(url):
+  cache_path = mkdtemp()
+  cache = ResponseCache(cache_path, 20)
+  cache.put("http://a.com/1", "0123456789")
+  cache.put("http://a.com/2", "0123456789")  #Same body, stored once
+  assert len(cache) == 2 and cache.size() == 10
+  cache.put("http://a.com/3", "abcdefghij")
+  assert cache.get("http://a.com/1") == "0123456789"  #Now the most recently used
+  cache.put("http://a.com/4", "ABCDEFGHIJ")
+  assert cache.get("http://a.com/3") is None and cache.size() == 20
+  cache.put("http://a.com/5", "0123456789" * 3)  #Too large to be cached
+  assert cache.get("http://a.com/5") is None and cache.get("http://a.com/2") == "0123456789"
+  assert sum(len(files) for (_, _, files) in os.walk(os.path.join(cache_path, "bodies"))) == 2
+  cache.close()
+  #The cache can be reopened
+  cache = ResponseCache(cache_path, 20)
+  assert len(cache) == 3 and cache.size() == 20 and cache.get("http://a.com/4") == "ABCDEFGHIJ"
+  cache.close()
+  rmtree(cache_path)
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    cache_path = mkdtemp()
+    cache = ResponseCache(cache_path)
+    CrawlerHandler(response_cache = cache).start_crawling(url, 1, None, None, 0, engine)
+    for parser_backend in PARSER_BACKENDS:
+      replay_handler = CrawlerHandler(response_cache = cache, parser_backend = parser_backend)
+      assert replay_handler.start_crawling(url, 1, None, None, 0, engine, replay = True) == url
+      assert replay_handler._connection_pool.requests_sent == 0  #No network I/O at all
+      assert normalize(handler.page_graph()) == normalize(replay_handler.page_graph())
+      assert handler.list_resources() == replay_handler.list_resources()
+    cache.close()
+    rmtree(cache_path)
+  
+def test_near_duplicates(url):
+  fingerprints = {}
+  for name in ("article_1.html", "article_2.html", "other.html"):
+    html = urlopen(urljoin(url, name)).read()
+    fingerprints[name] = SimHash(html).fingerprint()
+    simhash = SimHash()
+    for i in xrange(0, len(html), 10):
+      simhash.update(html[i: i + 10])
+    assert simhash.fingerprint() == fingerprints[name]
+  assert hamming_distance(fingerprints["article_1.html"], fingerprints["article_2.html"]) <= 8
+  assert hamming_distance(fingerprints["article_1.html"], fingerprints["other.html"]) > 16
+  
+  index = NearDuplicateIndex(3)
+  index.add(fingerprints["other.html"])
+  assert index.find(fingerprints["other.html"] ^ 0b10110) == fingerprints["other.html"]
+  assert index.find(fingerprints["other.html"] ^ 0b11110) is None
+  
+  article_1, article_2 = urljoin(url, "article_1.html"), urljoin(url, "article_2.html")
+  sponsors = set([urljoin(url, "sponsor_1.html"), urljoin(url, "sponsor_2.html")])
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  assert sponsors <= set(handler.page_graph())
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    for chunk_size in (None, 64):
+      handler = CrawlerHandler(chunk_size = chunk_size, near_duplicate_threshold = 0.85)
+      handler.start_crawling(url, 1, None, None, 0, engine)
+      graph = handler.page_graph()
+      #Near duplicates are mapped to the first copy found, and their links aren't followed
+      assert graph[article_1] == graph[article_2] and len(sponsors & set(graph)) == 1
+      assert urljoin(url, "other.html") in graph
+  
+def test_resource_index(url):
+  resources = dict((i, (set(["img_%d.jpg" % i]), set(), set(["script_%d.js" % i]))) for i in xrange(4))
+  index = ResourceIndex(resources, {0: [1], 1: [2], 2: [1, 3], 3: []})
+  assert index.resources(0)[0] == set(["img_0.jpg", "img_1.jpg", "img_2.jpg", "img_3.jpg"])
+  assert index.resources(1)[2] == set(["script_1.js", "script_2.js", "script_3.js"])
+  assert index.resources(2) is index.resources(1)  #Same component, same cached result
+  assert index.resources(3) == (set(["img_3.jpg"]), set(), set(["script_3.js"]))
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  for page in handler._site.values():
+    #Compares every page with a plain visit of the site
+    expected = {"images": set(), "css": set(), "scripts": set()}
+    visited = set([page.page_ID])
+    stack = [page]
+    while stack:
+      current = stack.pop()
+      expected["images"].update(current._img_urls)
+      expected["css"].update(current._css_urls)
+      expected["scripts"].update(current._script_urls)
+      for link_url in current._links:
+        link_page_id = handler._url_table.page_id(link_url)
+        if link_page_id is not None and link_page_id not in visited:
+          visited.add(link_page_id)
+          stack.append(handler._site[link_page_id])
+    assert handler.list_resources(page._url) == expected
+  
+  #Link chains longer than the recursion limit
+  handler = crawl_chain(2000)
+  assert len(handler.list_resources()["images"]) == 2000
+  assert len(handler.list_resources("http://chain.test/1500.html")["images"]) == 500
+  
+def test_compact_page(url):
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  graph = handler.page_graph()
+  images = {}
+  for page in handler._site.values():
+    assert not hasattr(page, "__dict__")
+    assert type(page._links) == type(page._img_urls) == type(page._videos) == tuple
+    for link_url in page._links:
+      assert link_url is handler._url_table.url(handler._url_table.get_id(link_url))  #Shared with the url table
+    for img_url in page._img_urls:
+      assert images.setdefault(img_url, img_url) is img_url  #Interned across pages
+  
+  #Pages restored from their packed content are the same
+  for page in handler._site.values():
+    copy = Page(page._url, handler, content = page._pack_content())
+    assert (copy._url, copy._depth) == (page._url, page._depth)
+    for field in Page.__slots__[3:]:
+      assert sorted(getattr(copy, field)) == sorted(getattr(page, field))
+  assert handler.page_graph() == graph
+  
+def test_page_graph_export(url):
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  graph = handler.page_graph()
+  pages = handler.iter_page_graph()
+  assert pages.next()[0] == url  #Pages are yielded lazily, starting from the home page
+  urls = [url] + [page_url for (page_url, _) in pages]
+  assert len(urls) == len(set(urls)) == len(graph)
+  assert dict(handler.iter_page_graph()) == graph
+  assert dict(handler.iter_page_graph(urls[1])) == handler.page_graph(urls[1])
+  assert list(handler.iter_page_graph(url + "missing")) == []
+  
+  handle, export_path = mkstemp()
+  os.close(handle)
+  assert handler.write_page_graph(export_path) == len(graph)
+  with open(export_path) as export_file:
+    for line in export_file:
+      node = json.loads(line)
+      page_url = node.pop("url")
+      assert normalize(node) == normalize(graph[page_url])
+  os.remove(export_path)
+  
+  #Link chains longer than the recursion limit
+  handler = crawl_chain(2000)
+  depths = [node["depth"] for (_, node) in handler.iter_page_graph()]
+  assert depths == range(2001)  #Breadth-first order
+  
+def test_benchmark():
+  site = SyntheticSite(60, 4, 3, 0.2, 1024)
+  assert site.body("/59.html") is not None and site.body("/60.html") is None
+  assert len(site.body("/1.html")) >= 1024
+  #The same parameters always generate the same site
+  assert all(site.body("/%d.html" % i) == SyntheticSite(60, 4, 3, 0.2, 1024).body("/%d.html" % i) for i in xrange(60))
+  
+  server, url = serve_site(site)
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  server.shutdown()
+  server.server_close()
+  assert len(handler._site) == 60
+  assert max(node["depth"] for node in handler.page_graph().values()) == 3
+  assert len(set(site.body("/%d.html" % i) for i in xrange(60))) == 60 - 3 * 3  #20% of each level but its first page
+  
+  assert percentile([], 50) == 0 and percentile([1, 2, 3, 4], 50) == 2 and percentile(range(1, 101), 99) == 99
+  report = run_suite(site, [("threads", {}, {}), ("async", {}, {"engine": ENGINE_ASYNC})], [1, 2])
+  assert report["site"] == site.parameters()
+  assert [(result["configuration"], result["threads"]) for result in report["results"]] == \
+         [("threads", 1), ("threads", 2), ("async", 1), ("async", 2)]
+  for result in report["results"]:
+    assert result["pages_crawled"] == 60 and result["pages_per_second"] > 0
+    assert 0 < result["fetch_latency_ms"]["p50"] <= result["fetch_latency_ms"]["p99"]
+    assert result["phase_ms_per_page"]["fetch"] > 0 and result["phase_ms_per_page"]["parse"] > 0
+  
+  #A crawl that fails is reported instead of blocking the benchmark
+  server, url = serve_site(site)
+  try:
+    run_benchmark(site, url, 1, {}, {"no_such_parameter": True})
+    assert False
+  except RuntimeError as e:
+    assert "no_such_parameter" in str(e)
+  finally:
+    server.shutdown()
+    server.server_close()
+  
+  handle, report_path = mkstemp()
+  os.close(handle)
+  with open(report_path, "w") as report_file:
+    write_report(report, report_file)
+  with open(report_path) as report_file:
+    assert json.load(report_file) == report
+  os.remove(report_path)
+  
+def test_stats(url):
+  stats = CrawlStats()
+  def record():
+    for i in xrange(1000):
+      stats.observe(STATS_FETCH, 0.002)
+      stats.increment("pages_crawled")
+  threads = [threading.Thread(target = record) for _ in xrange(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  snapshot = stats.snapshot()
+  assert snapshot["counters"] == {"pages_crawled": 4000}
+  fetch = snapshot["phases"][STATS_FETCH]
+  assert fetch["count"] == 4000 and abs(fetch["seconds"] - 8) < 1e-6
+  assert [count for (upper_bound, count) in fetch["buckets"] if upper_bound < 0.002] == [0] * 4
+  assert fetch["buckets"][-1] == (float("inf"), 4000)
+  
+  #Only waiting for a lock held by another thread is recorded
+  lock = TimedLock()
+  lock.stats = CrawlStats()
+  with lock:
+    pass
+  assert lock.stats.snapshot()["phases"] == {}
+  lock.acquire()
+  assert not lock.acquire(False)
+  releaser = threading.Timer(0.05, lock.release)
+  releaser.start()
+  with lock:
+    pass
+  assert lock.stats.snapshot()["phases"][STATS_LOCK_WAIT]["seconds"] >= 0.04
+  
+  for engine in ENGINES:
+    handler = CrawlerHandler()
+    handler.start_crawling(url, 2, None, None, 0, engine)
+    stats = handler.stats()
+    counters = stats["counters"]
+    assert counters["pages_crawled"] == len(handler._site) == counters["urls_enqueued"]
+    assert counters["duplicate_pages"] == 1 and counters["bytes_fetched"] > 0
+    phases = stats["phases"]
+    assert phases[STATS_FETCH]["count"] == len(handler._site)  #Failed requests too
+    assert phases[STATS_DEDUP]["count"] == len(handler._site) - counters["fetch_errors"]
+    assert phases[STATS_PARSE]["count"] == phases[STATS_DEDUP]["count"] - counters["duplicate_pages"]
+    assert 0 < phases[STATS_ENQUEUE]["count"] <= len(handler._site) + 1  #A batch per page, plus the home page
+  
+    metrics = {}
+    for line in handler.prometheus_stats().splitlines():
+      if not line.startswith("#"):
+        name, value = line.rsplit(" ", 1)
+        metrics[name] = float(value)
+    assert metrics["pycrawler_pages_crawled_total"] == len(handler._site)
+    for phase in (STATS_FETCH, STATS_PARSE, STATS_DEDUP, STATS_ENQUEUE):
+      assert metrics['pycrawler_phase_seconds_bucket{phase="%s",le="+Inf"}' % phase] == phases[phase]["count"]
+      assert metrics['pycrawler_phase_seconds_count{phase="%s"}' % phase] == phases[phase]["count"]
+  
+def test_url_admission():
+  handler = crawl_chain(6, 3)
+  assert handler.format_url("4.html", "/") == "http://chain.test/4.html"
+  assert handler.format_url("http://elsewhere.test/4.html", "/") is None
+  table = handler._url_table
+  assert not table.is_queued(table.get_id("http://chain.test/4.html"))  #Too deep
+  urls = ["http://chain.test/5.html", "http://chain.test/2.html", "http://chain.test/1.html"]
+  admitted = handler.enqueue_urls(urls, 1)
+  assert admitted == urls and admitted[1] is table.url(table.get_id(urls[1]))
+  #The depth of the pages crawled is lowered along the links, and pages that were too deep are queued
+  assert [node["depth"] for (_, node) in handler.iter_page_graph()] == [0, 1, 1, 2]
+  assert table.depth("http://chain.test/4.html") == 3 and table.is_queued(table.get_id("http://chain.test/4.html"))
+  
+  #Depths don't depend on the order in which many threads happen to crawl the pages
+  server, url = serve_site(SyntheticSite(300, 5, 4, 0.1, 512, 0.001))
+  reference = CrawlerHandler()
+  reference.start_crawling(url, 1, None, None, 0)
+  depths = dict((page_url, node["depth"]) for (page_url, node) in reference.page_graph().iteritems())
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    handler = CrawlerHandler()
+    handler.start_crawling(url, 32, None, None, 0, engine)
+    assert dict((page_url, node["depth"]) for (page_url, node) in handler.page_graph().iteritems()) == depths
+    assert sorted(handler._site) == range(len(handler._site))  #Page IDs are unique and contiguous
+    handler = CrawlerHandler()
+    handler.start_crawling(url, 32, 2, None, 0, engine)
+    assert sorted(handler.page_graph()) == sorted(page_url for page_url in depths if depths[page_url] <= 2)
+  server.shutdown()
+  server.server_close()
+  
+def test_url_cache(url):
+  for base in ("", "/", "/a/b.html", "b.html", "http://host", "http://host/a/b.html", "file:///root/b.html"):
+    for href in ("", "c.html", "../c.html", "/c.html", "//other/c.html", "http://other/c.html", "?q=1", "#top", "c?q#f"):
+      assert urljoin(resolution_base(base, href), href) == urljoin(base, href)
+  assert resolution_base("/a/b.html", "c.html") == resolution_base("/a/d.html", "c.html") == "/a/"
+  
+  cache = UrlCache(10)
+  for i in xrange(5):
+    cache.put(i, str(i))
+  assert cache.get(0) == "0"
+  for i in xrange(5, 100):
+    cache.put(i, str(i))
+    assert len(cache) <= 10
+    if i < 9:
+      assert cache.get(0) == "0"  #Recently used entries are kept...
+  assert cache.get(1) is URL_CACHE_MISS  #...while the least recently used are evicted
+  
+  server, site_url = serve_site(SyntheticSite(100, 10, 3, 0, 512))
+  handler = CrawlerHandler()
+  handler.start_crawling(site_url, 1, None, None, 0)
+  counters = handler.stats()["counters"]
+  assert counters["url_cache_hits"] > counters["url_cache_misses"]  #Links are shared by most pages
+  assert "join_cache_hits" not in counters and "join_cache_misses" not in counters
+  handler.page_graph()
+  #Exporting has counters of its own
+  assert handler.stats()["counters"]["url_cache_hits"] == counters["url_cache_hits"]
+  assert handler.stats()["counters"]["url_cache_misses"] == counters["url_cache_misses"]
+  assert handler.stats()["counters"]["join_cache_misses"] > 0
+  server.shutdown()
+  server.server_close()
+  
+  #The same graph, whether links are remembered or not
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 1, None, None, 0)
+  uncached_handler = CrawlerHandler(url_cache_size = 1)
+  uncached_handler.start_crawling(url, 1, None, None, 0)
+  assert normalize(handler.page_graph()) == normalize(uncached_handler.page_graph())
+  assert handler.list_resources() == uncached_handler.list_resources()
+  
+def test_priority_frontier(url):
+  frontier = PolitenessFrontier(0)
+  for (u, priority) in (("http://a.com/3", 3), ("http://a.com/1", 1), ("http://b.com/2", 2), ("http://a.com/0", 0), ("http://b.com/1", 1)):
+    frontier.put(u, priority)
+  assert frontier.reprioritize("http://a.com/3", 0) and not frontier.reprioritize("http://b.com/2", 5)
+  found = [frontier.get(False) for _ in xrange(5)]
+  #The best URLs first, whatever their host, and in the order they were queued when they are as good
+  assert found == ["http://a.com/0", "http://a.com/3", "http://a.com/1", "http://b.com/1", "http://b.com/2"]
+  assert frontier.empty() and not frontier.reprioritize("http://a.com/0", -1)
+  for _ in found:
+    frontier.task_done()
+  frontier.join()
+  
+  #Once the budget is spent, the URLs still queued (or queued later) are dropped
+  frontier = PolitenessFrontier(0, budget = 2)
+  for i in xrange(4):
+    frontier.put("http://a.com/%d" % i, i)
+  assert frontier.get(False) == "http://a.com/0" and frontier.qsize() == 3
+  assert frontier.get(False) == "http://a.com/1" and frontier.empty()
+  frontier.put("http://a.com/4", 0)
+  assert frontier.empty()
+  frontier.task_done()
+  frontier.task_done()
+  frontier.join()
+  
+  #A budget shared with other queues is asked for a page each time
+  credits = [2]
+  def take_credit():
+    credits[0] -= 1
+    return credits[0] >= 0
+  frontier = PolitenessFrontier(0, credits = take_credit)
+  for i in xrange(4):
+    frontier.put("http://a.com/%d" % i, i)
+  assert [frontier.get(False) for _ in xrange(2)] == ["http://a.com/0", "http://a.com/1"]
+  try:
+    frontier.get(False)
+    assert False
+  except Empty:
+    pass
+  assert frontier.empty() and frontier.unfinished_tasks() == 2
+  frontier.put("http://a.com/4", 0)
+  assert frontier.empty()
+  
+  #Among the pages at the same depth, the ones with the highest score are crawled
+  path = urlsplit(url)[2].rsplit("/", 1)[0]
+  for favourite in ("test_2.html", "test_C.html"):
+    handler = CrawlerHandler(url_score = pattern_score([(favourite, 1)]))
+    handler.start_crawling(url, 4, None, 2, 0)
+    assert sorted(handler.page_graph()) == sorted([url, urlunsplit(("file", path, favourite, '', ''))])
+  handler = CrawlerHandler(url_score = in_links_score)
+  handler.start_crawling(url, 4, None, None, 0)
+  assert normalize(handler.page_graph()) == normalize(test_page_graph(url, 1))
+  table = handler._url_table
+  assert table.in_links(table.get_id(url)) == 1  #Only test_A links the home page
+  #test_B, test_C and test_1 link test_2 (test_1_copy too, but the links of copies aren't followed)
+  assert table.in_links(table.get_id(urlunsplit(("file", path, "test_2.html", '', '')))) == 3
+  
+  #Capped crawls retrieve exactly the pages allowed, the shallowest ones, and stop right away
+  site = SyntheticSite(300, 5, 4, 0.1, 512, 0.001)
+  server, site_url = serve_site(site)
+  reference = CrawlerHandler()
+  reference.start_crawling(site_url, 1, None, None, 0)
+  depths = dict((page_url, node["depth"]) for (page_url, node) in reference.page_graph().iteritems())
+  site.pop_latencies()
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    handler = CrawlerHandler()
+    handler.start_crawling(site_url, 16, None, 50, 0, engine)
+    crawled = handler.page_graph()
+    assert len(crawled) == 50 and len(site.pop_latencies()) == 50
+    assert max(depths[page_url] for page_url in crawled) <= min(depths[page_url] for page_url in depths if page_url not in crawled)
+  server.shutdown()
+  server.server_close()
+  
+def test_compression():
+  body = "<html><body>%s</body></html>" % "".join("<a href='/%d.html'>Page %d</a>" % (i, i) for i in xrange(500))
+  for (encoding, encoded) in (("gzip", encode(body, "gzip")), ("deflate", encode(body, "deflate")), 
+                              ("deflate", zlib.compress(body)[2:-4]), (None, body)):  #Some servers send raw deflate
+    sizes = [0, 0]
+    chunks = (encoded[i: i + 7] for i in xrange(0, len(encoded), 7))
+    assert "".join(decode_chunks(chunks, {"content-encoding": encoding}, sizes)) == body
+    assert sizes == [len(encoded), len(body)]
+  for (encoding, encoded) in (("br", body), ("gzip", body), ("gzip", encode(body, "gzip")[:20] + "corrupted")):
+    try:
+      decoder = ContentDecoder(encoding)
+      list(decoder.decode(encoded))
+      assert False
+    except URLError:
+      pass
+  #A small chunk received is inflated a bounded slice at a time
+  bomb = encode("\0" * (4 << 20), "gzip")
+  sizes = [0, 0]
+  chunks = decode_chunks(iter([bomb]), {"content-encoding": "gzip"}, sizes, 1024)
+  assert len(next(chunks)) == 1024 and sizes == [len(bomb), 1024]
+  assert max(len(chunk) for chunk in chunks) == 1024 and sizes == [len(bomb), 4 << 20]
+  
+  for content_encoding in ("gzip", "deflate"):
+    server, url = serve_site(SyntheticSite(100, 5, 3, 0.1, 4096, content_encoding = content_encoding))
+    reference = CrawlerHandler(compression = False)
+    reference.start_crawling(url, 1, None, None, 0)
+    counters = reference.stats()["counters"]
+    assert counters["bytes_fetched"] == counters["bytes_decoded"]
+    for (handler, engine) in ((CrawlerHandler(), ENGINE_THREADS), (CrawlerHandler(chunk_size = 512), ENGINE_THREADS),
+                              (CrawlerHandler(), ENGINE_ASYNC)):
+      handler.start_crawling(url, 4, None, None, 0, engine)
+      assert normalize(handler.page_graph()) == normalize(reference.page_graph())
+      counters = handler.stats()["counters"]
+      #Pages are hashed once decoded, so duplicates are still found
+      assert counters.get("duplicate_pages") == reference.stats()["counters"].get("duplicate_pages")
+      assert counters["bytes_decoded"] == reference.stats()["counters"]["bytes_decoded"]
+      assert counters["bytes_fetched"] * 5 < counters["bytes_decoded"]
+    #The size limit applies to the decoded body
+    assert CrawlerHandler(max_body_size = 2048).start_crawling(url, 1, None, None, 0) is None
+    server.shutdown()
+    server.server_close()
+
+def test_distributed_crawl(url):
+  for partitions in (1, 3, 7):
+    assert url_partition(url, partitions) == url_partition(unicode(url), partitions) < partitions
+  
+  server, site_url = serve_site(SyntheticSite(150, 5, 4, 0.1, 256))
+  for (start_url, max_page_depth) in ((url, None), (site_url, None), (site_url, 2)):
+    reference = CrawlerHandler()
+    home_url = reference.start_crawling(start_url, 1, max_page_depth, None, 0)
+    handler = CrawlerHandler()
+    assert handler.start_distributed_crawling(start_url, 3, 2, max_page_depth, None, 0) == home_url
+    assert normalize(handler.page_graph()) == normalize(reference.page_graph())
+    assert handler.list_resources() == reference.list_resources()
+    counters = handler.stats()["counters"]
+    assert counters["pages_crawled"] == reference.stats()["counters"]["pages_crawled"]
+    assert counters.get("duplicate_pages") == reference.stats()["counters"].get("duplicate_pages")
+    assert counters["urls_forwarded"] > 0
+  
+  #The pages allowed are shared by all the workers: capped crawls retrieve as many as start_crawling
+  for (workers, max_pages_to_crawl) in ((3, 30), (4, 67), (3, 2)):
+    handler = CrawlerHandler()
+    handler.start_distributed_crawling(site_url, workers, 2, None, max_pages_to_crawl, 0)
+    assert handler.stats()["counters"]["pages_crawled"] == max_pages_to_crawl
+  #...even when the pages of some partitions run out before their share does
+  flat_server, flat_url = serve_site(SyntheticSite(68, 67, 1, 0, 256))
+  handler = CrawlerHandler()
+  handler.start_distributed_crawling(flat_url, 4, 2, None, 67, 0)
+  assert handler.stats()["counters"]["pages_crawled"] == 67
+  flat_server.shutdown()
+  flat_server.server_close()
+  #Workers that never connect
+  start = time()
+  assert CrawlerHandler().start_distributed_crawling(site_url, 2, 1, None, None, 0, local_workers = 1, workers_timeout = 0.5) is None
+  assert time() - start < 5
+  server.shutdown()
+  server.server_close()
+  
+  assert CrawlerHandler().start_distributed_crawling("http://localhost:1/missing.html", 2, 1, None, None, 0) is None
+
+def test_page_streaming(url):
+  reference = CrawlerHandler()
+  reference.start_crawling(url, 1, None, None, 0)
+  graph = normalize(reference.page_graph())
+  
+  for (retention, engine) in ((RETAIN_ALL, ENGINE_THREADS), (RETAIN_LINKS, ENGINE_THREADS), (RETAIN_NONE, ENGINE_THREADS), 
+                              (RETAIN_NONE, ENGINE_ASYNC), (RETAIN_NONE, ENGINE_HYBRID)):
+    pages = {}
+    def on_page(page):
+      pages[page.url] = normalize({page.url: handler.page_node(page)})[page.url]
+    handler = CrawlerHandler(on_page = on_page, retention = retention)
+    handler.start_crawling(url, 4, None, None, 0, engine)
+    #Every page is handed over as soon as it's crawled (copies with no content)
+    assert sorted(pages) == sorted(graph)
+    for (page_url, node) in pages.iteritems():
+      assert node == graph[page_url] or node["links"] == []
+    if retention == RETAIN_ALL:
+      assert normalize(handler.page_graph()) == graph
+    elif retention == RETAIN_LINKS:
+      assert dict((page_url, node["links"]) for (page_url, node) in normalize(handler.page_graph()).iteritems()) == \
+             dict((page_url, node["links"]) for (page_url, node) in graph.iteritems())
+      assert handler.list_resources() == {"images": set(), "css": set(), "scripts": set()}
+    else:
+      assert len(handler._site) == 0 and handler.page_graph() == {}
+      assert handler.stats()["counters"]["pages_crawled"] == len(graph)
+  
+  handler = CrawlerHandler()
+  assert sorted(page.url for page in handler.iter_crawling(url, 2, None, None, 0, buffer_size = 1)) == sorted(graph)
+  assert normalize(handler.page_graph()) == graph
+  
+  #Pages that aren't retained aren't crawled again once resumed, nor handed over again
+  handle, checkpoint_path = mkstemp()
+  os.close(handle)
+  CrawlerHandler(retention = RETAIN_NONE).start_crawling(url, 1, None, None, 0, checkpoint_path = checkpoint_path)
+  pages = []
+  resumed_handler = CrawlerHandler(on_page = pages.append, retention = RETAIN_NONE)
+  resumed_handler.resume_crawling(checkpoint_path, 2, 0)
+  assert pages == [] and resumed_handler.stats()["counters"].get("pages_crawled", 0) == 0
+  
+  #Nor do they leave room for more pages than the ones left to crawl
+  class InterruptedHandler(CrawlerHandler):
+    '''Takes a checkpoint as soon as 3 pages have been crawled
+    '''
+    stored = 0
+    def _store_page(self, page, restored = False):
+      CrawlerHandler._store_page(self, page, restored)
+      self.stored += 1
+      if self.stored == 3:
+        self.checkpoint(checkpoint_path)
+  assert len(graph) > 5
+  InterruptedHandler(retention = RETAIN_NONE).start_crawling(url, 1, None, 5, 0)
+  pages = []
+  resumed_handler = CrawlerHandler(on_page = pages.append, retention = RETAIN_NONE)
+  resumed_handler.resume_crawling(checkpoint_path, 1, 0)
+  assert len(pages) == resumed_handler.stats()["counters"]["pages_crawled"] == 2
+  os.remove(checkpoint_path)
+  
+  #Crawling stops as soon as the caller stops iterating
+  server, site_url = serve_site(SyntheticSite(300, 5, 4, 0.1, 256))
+  handler = CrawlerHandler(retention = RETAIN_NONE)
+  for (i, page) in enumerate(handler.iter_crawling(site_url, 4, None, None, 0, buffer_size = 2)):
+    if i == 5:
+      break
+  assert handler.stats()["counters"]["pages_crawled"] < 100
+  assert not any(isinstance(thread, Crawler) for thread in threading.enumerate())
+  server.shutdown()
+  server.server_close()
+
+def test_link_graph(url):
+  #0 -> 1 -> 2 -> 0, 2 -> 3 (no links), and 4 <-> 5 apart
+  graph = LinkGraph(list("abcdef"), array('i', range(6)), array('i', [0, 1, 2, 4, 4, 5, 6]), array('i', [1, 2, 0, 3, 5, 4]), 0)
+  assert len(graph) == 6 and graph.links_count() == 6
+  assert list(graph.successors(2)) == [0, 3] and list(graph.predecessors(0)) == [2] and graph.node("d") == 3
+  assert list(graph.out_degrees()) == [1, 1, 2, 0, 1, 1]
+  assert list(graph.in_degrees()) == [1, 1, 1, 1, 1, 1]
+  assert list(graph.depths()) == [0, 1, 2, 3, -1, -1]
+  assert list(graph.depths(4)) == [-1, -1, -1, -1, 0, 1]
+  assert list(graph.components()) == [0, 0, 0, 0, 1, 1]
+  ranks = graph.pagerank()
+  assert abs(sum(ranks) - 1) < 1e-9
+  assert abs(ranks[4] - ranks[5]) < 1e-9 and ranks[0] < ranks[1] < ranks[2] and ranks[3] < ranks[2]
+  #On a cycle every page is equally important
+  ranks = LinkGraph(list("abc"), array('i', range(3)), array('i', [0, 1, 2, 3]), array('i', [1, 2, 0])).pagerank()
+  assert all(abs(rank - 1. / 3) < 1e-9 for rank in ranks)
+  assert len(LinkGraph([], array('i'), array('i', [0]), array('i')).pagerank()) == 0
+  
+  handler = CrawlerHandler()
+  handler.start_crawling(url, 4, None, None, 0)
+  page_graph = handler.page_graph()
+  graph = handler.link_graph()
+  assert sorted(graph.urls) == sorted(page_graph) and graph.urls[graph.root] == url
+  depths = graph.depths()
+  for (node, page_url) in enumerate(graph.urls):
+    assert set(graph.urls[linked] for linked in graph.successors(node)) == page_graph[page_url]["links"] & set(page_graph)
+    assert depths[node] == page_graph[page_url]["depth"]
+  assert set(graph.components()) == set([0])
+
+def test_home_page_prefetch():
+  server, url = serve_site(SyntheticSite(20, 3, 2, 0, 64))
+  for home_url in (url, url + "#top"):
+    handler = CrawlerHandler()
+    assert handler.start_crawling(home_url, 1, None, None, 0) == url
+    #The home page is retrieved once, even if its URL had to be formatted
+    assert handler._connection_pool.requests_sent == len(handler.page_graph())
+  server.shutdown()
+  server.server_close()
+
+def test_timeouts_and_retries():
+  failures = {}  #Maps the paths of the flaky pages to the failures still to be answered
+  requested = {}  #Maps each path to the requests received
+  retry_after = {}  #Maps the paths of the flaky pages to the Retry-After header of their failures
+  
+  class UnreliableRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pages = {"/": "<a href='/flaky.html'>flaky</a> <a href='/slow.html'>slow</a>", 
+             "/flaky.html": "<a href='/ok.html'>ok</a>", "/slow.html": "", "/ok.html": "", "/closing.html": "",
+             "/patient.html": "<a href='/ok.html'>ok</a>"}
+    
+    def do_GET(self):
+      requested[self.path] = requested.get(self.path, 0) + 1
+      if self.path == "/closing.html":
+        self.close_connection = 1  #Without telling the client
+      if self.path == "/slow.html":
+        sleep(1)
+      if failures.get(self.path, 0) > 0:
+        failures[self.path] -= 1
+        self.send_response(503)
+        if self.path in retry_after:
+          self.send_header("Retry-After", retry_after[self.path])
+        body = ""
+      else:
+        self.send_response(200)
+        body = self.pages[self.path]
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    
+    def log_message(self, *args):
+      pass
+  
+  ThreadingTCPServer.daemon_threads = True
+  server = ThreadingTCPServer(("localhost", 0), UnreliableRequestHandler)
+  server.handle_error = lambda request, client_address: None
+  server_thread = threading.Thread(target = server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  url = "http://localhost:%d/" % server.server_address[1]
+  
+  assert is_transient(URLError(socket.timeout("timed out"))) and is_transient(HTTPError(url, 503, "", None, None))
+  assert not is_transient(HTTPError(url, 404, "", None, None)) and not is_transient(URLError("Page larger than 10 bytes"))
+  
+  #Requests on connections dropped by the server are sent again, but the ones that time out aren't
+  pool = ConnectionPool(read_timeout = 0.2)
+  pool.fetch(url + "closing.html")
+  assert pool.fetch(url + "ok.html") == "" and requested.pop("/ok.html") == 1 and pool.connections_opened == 2
+  try:
+    pool.fetch(url + "slow.html")
+    assert False
+  except URLError as e:
+    assert isinstance(e.reason, socket.timeout)
+  sleep(1)
+  assert requested.pop("/slow.html") == 1
+  pool.close()
+  
+  #Retries wait for the delay between two requests to the same host, and for as long as the server asks
+  assert parse_retry_after("2") == 2 and parse_retry_after(None) == 0 and parse_retry_after("soon") == 0
+  assert 8 <= parse_retry_after(formatdate(time() + 10, usegmt = True)) <= 10
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    for (crawler_delay, header, crawled) in ((0.5, None, True), (0, "1", True), (0, "1000", False)):
+      failures["/ok.html"] = 1
+      if header is None:
+        retry_after.pop("/ok.html", None)
+      else:
+        retry_after["/ok.html"] = header
+      handler = CrawlerHandler(retry_backoff = 0.01)
+      start = time()
+      handler.start_crawling(url + "patient.html", 1, None, None, crawler_delay, engine)
+      counters = handler.stats()["counters"]
+      assert counters.get("retries", 0) == (1 if crawled else 0) and counters.get("fetch_errors", 0) == (0 if crawled else 1)
+      assert (time() - start >= max(2 * crawler_delay, float(header or 0))) == crawled and time() - start < 5
+  retry_after.clear()
+  
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC):
+    for (retries, crawled) in ((2, True), (1, False)):
+      failures["/flaky.html"] = 2
+      handler = CrawlerHandler(read_timeout = 0.2, retries = retries, retry_backoff = 0.01)
+      start = time()
+      handler.start_crawling(url, 2, None, None, 0, engine)
+      #The slow page is given up, once retried, long before the server would answer
+      assert time() - start < 1
+      assert (url + "ok.html" in handler.page_graph()) == crawled
+      counters = handler.stats()["counters"]
+      assert counters["timeouts"] == retries + 1 and counters["retries"] == 2 * retries
+  
+  #A server that doesn't answer at all
+  listener = socket.socket()
+  listener.bind(("localhost", 0))
+  listener.listen(5)
+  handler = CrawlerHandler(read_timeout = 0.2, retries = 0)
+  assert handler.start_crawling("http://localhost:%d/" % listener.getsockname()[1], 1, None, None, 0) is None
+  assert handler.stats()["counters"]["timeouts"] == 1
+  listener.close()
+  server.shutdown()
+  server.server_close()
+
+def test_adaptive_concurrency():
+  controller = ConcurrencyController(4)
+  assert controller.limit == 1
+  assert controller.record(0.1, False) == 2  #One more request per round
+  controller.record(0.1, False)
+  assert controller.record(0.1, False) == 3
+  for _ in xrange(3):
+    controller.record(0.1, False)
+  assert controller.limit == 4
+  for _ in xrange(4):
+    controller.record(0.1, False)
+  assert controller.limit == 4  #Never beyond the maximum
+  for failed in (True, False, False, False):
+    controller.record(0.1, failed)
+  assert controller.limit == 2  #Halved when errors are too many
+  controller.record(0.5, False)
+  assert controller.record(0.5, False) == 1  #...or when latency grows
+  
+  #Threads wait for their turn
+  controller = ConcurrencyController(2)
+  controller.acquire()
+  acquired = threading.Event()
+  def acquire():
+    controller.acquire()
+    acquired.set()
+  waiting = threading.Thread(target = acquire)
+  waiting.start()
+  assert not acquired.wait(0.1)
+  controller.release()
+  assert acquired.wait(1)
+  waiting.join()
+  
+  server, url = serve_site(SyntheticSite(100, 5, 3, 0.1, 256, latency = 0.002))
+  reference = CrawlerHandler()
+  reference.start_crawling(url, 1, None, None, 0)
+  for engine in (ENGINE_THREADS, ENGINE_ASYNC, ENGINE_HYBRID):
+    handler = CrawlerHandler(adaptive_concurrency = True)
+    handler.start_crawling(url, 8, None, None, 0, engine)
+    assert normalize(handler.page_graph()) == normalize(reference.page_graph())
+    assert 1 < handler._concurrency.limit <= 8
+  server.shutdown()
+  server.server_close()
+  
 def test():
   handler = CrawlerHandler()
   assert handler.start_crawling("www.news.ycombinator.com", 30, None, 20, 0) is None
@@ -80,6 +1175,49 @@ def test():
   assert(graph[url1] == graph[url2])  
   assert len(graph[url_B]["resources"]["videos"]) == 2
   print graph[url_B]["resources"]["audios"]
+  
+  async_handler = CrawlerHandler()
+  async_handler.start_crawling(url_B, 5, None, None, 0, ENGINE_ASYNC)
+  assert normalize(async_handler.page_graph()) == normalize(test_page_graph(url_B, 1))
+  
+  base_url = serve_tests_folder()
+  test_async_engine(base_url)
+  test_connection_pool(base_url)
+  
+  test_streaming(url_B)
+  test_streaming(base_url + "/test_B.html")
+  test_max_body_size(url1)
+  test_max_body_size(base_url + "/test_1.html")
+  test_parser_backends(url_B)
+  test_crawlers_shutdown(url_B)
+  test_politeness(base_url)
+  test_hybrid_engine(url_B)
+  test_hybrid_engine(base_url + "/test_B.html")
+  test_url_dedup(url_B)
+  test_url_dedup(base_url + "/test_B.html")
+  test_frontier_spill(url_B)
+  test_checkpoint(url_B)
+  test_checkpoint(base_url + "/test_B.html")
+  test_recrawl(base_url + "/test_B.html")
+  test_response_cache(base_url + "/test_B.html")
+  test_near_duplicates(base_url + "/near_duplicates/index.html")
+  test_resource_index(url_B)
+  test_page_graph_export(url_B)
+  test_compact_page(url_B)
+  test_benchmark()
+  test_stats(base_url + "/test_B.html")
+  test_url_admission()
+  test_url_cache(url_B)
+  test_priority_frontier(url_B)
+  test_compression()
+  test_distributed_crawl(url_B)
+  test_page_streaming(url_B)
+  test_page_streaming(base_url + "/test_B.html")
+  test_link_graph(url_B)
+  test_home_page_prefetch()
+  test_timeouts_and_retries()
+  test_adaptive_concurrency()
+  test_url_cache(base_url + "/test_B.html")
   #assert graph[url_B]["resources"]["audios"] == set(['audio_test3.ogg', 'audio_test3.mp4'])
 '''END OF TESTING'''
 
@@ -87,7 +1225,128 @@ def test():
 
 '''PROFILING'''
 def __profile_run(): #pragma: no cover
-  test_crawler("http://techland.time.com/2012/09/19/nasa-actually-working-on-faster-than-light-warp-drive/", 5, None, 100)
+  #A synthetic site served locally, so that profiles can be compared (see pycrawler_benchmark for the full suite)
+  server, url = serve_site(SyntheticSite(pages = 500, latency = 0.005))
+  test_crawler(url, 5, None, None)
+  server.shutdown()
+  server.server_close()
+  
+def compare_parsers(repetitions = 2000): #pragma: no cover
+  '''Prints the throughput of each parser backend on a page made of all the tests pages
+  '''
+  text = "\n<div class='text'><p>Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit</p></div>\n" * 10
+  html = text.join(tests_files()) * repetitions
+  for name, parser_class in PARSER_BACKENDS.items():
+    start = time()
+    parse_html(html, parser_class, 16384)
+    elapsed = time() - start
+    print "%s: %.2f MB/s" % (name, len(html) / elapsed / 2 ** 20)
+  
+def __url_memory(structure, urls): #pragma: no cover
+  '''Stores _urls_ in _structure_ the way the crawler does, and prints the peak memory of the process
+  '''
+  import resource
+  urls = ["http://www.example.com/section-%d/page-%d.html" % (i % 100, i) for i in xrange(urls)]
+  start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if structure == "dicts":
+    queued, depths, page_ids = {}, {}, {}
+    for i, u in enumerate(urls):
+      depths[u] = 1
+      queued[u] = True
+      page_ids[u] = i
+  elif structure == "table":
+    table = UrlTable()
+    for i, u in enumerate(urls):
+      table.set_queued(table.add(u, 1))
+      table.set_page_id(u, i)
+  else:
+    bloom = BloomFilter(len(urls))
+    for u in urls:
+      bloom.add(u)
+  del urls
+  print "%s: %d KB" % (structure, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+def compare_url_memory(urls = 1000000): #pragma: no cover
+  '''Prints the memory needed to remember _urls_ URLs with plain dicts, with a UrlTable and with a Bloom filter
+     (each measure is taken in a separate process)
+  '''
+  from multiprocessing import Process
+  for structure in ("dicts", "table", "bloom"):
+    process = Process(target = __url_memory, args = (structure, urls))
+    process.start()
+    process.join()
+    
+def __page_size(obj, seen):
+  '''Size of _obj_ and of all the objects it references, each one counted once (across calls sharing _seen_)
+  '''
+  size = 0
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen or obj is None or type(obj) in (int, bool):
+      continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+    if isinstance(obj, dict):
+      stack.extend(obj.keys())
+      stack.extend(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      stack.extend(obj)
+    elif hasattr(obj, "__slots__"):
+      stack.extend(getattr(obj, field) for field in obj.__slots__)
+    elif hasattr(obj, "__dict__"):
+      stack.append(obj.__dict__)
+  return size
+  
+def compare_page_memory(pages = 5000, links = 20): #pragma: no cover
+  '''Prints the bytes per crawled page of a synthetic site, replayed from a response cache, both for the pages kept
+     by the crawler and for the same pages stored as they used to be (a __dict__ with sets, lists and dicts, and a
+     private copy of every URL parsed)
+  '''
+  cache_path = mkdtemp()
+  cache = ResponseCache(cache_path)
+  for i in xrange(pages):
+    html = "".join("<a href='%d.html'>Link</a>" % ((i * 7 + j * 13) % pages) for j in xrange(links))
+    html += "<img src='logo.png'><img src='photo_%d.jpg'><script src='site.js'></script>" % i
+    html += "<link rel='stylesheet' href='site.css'><video poster='poster.jpg'><source src='clip_%d.mp4'></video>" % (i % 10)
+    cache.put("http://synthetic.test/%d.html" % i, html)
+  handler = CrawlerHandler(response_cache = cache)
+  handler.start_crawling("http://synthetic.test/0.html", 1, None, None, 0, replay = True)
+  cache.close()
+  rmtree(cache_path)
+  
+  copy = lambda url: (url + " ")[:-1]
+  legacy = []
+  for page in handler._site.values():
+    fields = {"page_ID": page.page_ID, "_depth": page._depth, "_url": page._url, "domain": page.domain, "path": page.path,
+              "_Page__handler": handler, "_links": set(page._links), "_links_found": [copy(url) for url in page._links],
+              "_img_urls": set(map(copy, page._img_urls)), "_css_urls": set(map(copy, page._css_urls)),
+              "_script_urls": set(map(copy, page._script_urls)), "_audios": [map(copy, audio) for audio in page._audios],
+              "_videos": [{VIDEO_URLS_TAG: map(copy, urls), VIDEO_POSTER_TAG: poster and copy(poster)} for (urls, poster) in page._videos]}
+    legacy.append(fields)
+  
+  #The handler and the URLs in its url table are shared by both representations
+  shared = set([id(handler)])
+  shared.update(id(url) for url in handler._url_table)
+  print "before: %d bytes/page" % (__page_size(legacy, set(shared)) / len(legacy))
+  print "after: %d bytes/page" % (__page_size(handler._site.values(), set(shared)) / len(legacy))
+    
+def replay_crawl(url, cache_path, threads = 1, repetitions = 5): #pragma: no cover
+  '''Prints the throughput of parsing and graph building on a snapshot of a site: the site is retrieved
+     into the response cache at _cache_path_ only the first time, and then replayed from disk
+  '''
+  cache = ResponseCache(cache_path)
+  if len(cache) == 0:
+    CrawlerHandler(response_cache = cache).start_crawling(url, threads, None, None)
+  for name in PARSER_BACKENDS:
+    handler = CrawlerHandler(response_cache = cache, parser_backend = name)
+    start = time()
+    for _ in xrange(repetitions):
+      handler.start_crawling(url, threads, None, None, 0, replay = True)
+      handler.page_graph()
+    elapsed = time() - start
+    print "%s: %.1f pages/s" % (name, len(handler._site) * repetitions / elapsed)
+  cache.close()
   
 def profile(): #pragma: no cover
   import cProfile